@@ -1,14 +1,646 @@
-from flask import Flask, request, jsonify, abort
+import base64
+import binascii
+import datetime
+import os
+import re
+
+import click
+from flask import Flask, request, jsonify, abort, json, Response, stream_with_context, current_app
 from flask_cors import CORS
 
-from models import setup_db, Actor, Movie
-from auth import AuthError, requires_auth
+from sqlalchemy import select, func, and_, or_, Date
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from models import setup_db, db, Actor, Movie, roles, get_collection_version, on_mutation, on_staged_mutation, \
+    get_stats, reconcile_stats, tombstones, tombstone_horizon, prune_tombstones
+from auth import AuthError, requires_auth, check_permissions
+from rate_limit import Overloaded
+from response_cache import create_response_cache
+from metrics import init_metrics, phase, route_label, COALESCED_REQUESTS
+from events import ChangeEvents, stream_events
+from importer import FORMATS, import_file, validate_values
+from singleflight import SingleFlight
+
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 100))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 1000))
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 10000))
+MIN_SEARCH_LENGTH = 3
+
+SORTABLE_COLUMNS = {
+    'actors': ('id', 'name'),
+    'movies': ('id', 'title', 'release_date')
+}
+
+response_cache = create_response_cache()
+on_mutation(response_cache.invalidate)
+in_flight_reads = SingleFlight()
+
+change_events = ChangeEvents()
+on_mutation(change_events.publish)
+on_staged_mutation(change_events.stage)
+
+ACTOR_FIELDS = ('name', 'age', 'gender')
+MOVIE_FIELDS = ('title', 'release_date')
+
+# the columns format_row reads, selected as plain rows by the read routes
+ROW_FIELDS = {
+    'actors': ('id',) + ACTOR_FIELDS,
+    'movies': ('id',) + MOVIE_FIELDS
+}
+
+
+def missing_field(data, fields):
+    for field in fields:
+        if field not in data:
+            return field
+    return None
+
+
+def get_batch_items():
+    '''
+    Reads the items of a batch request, sent either as a JSON array or as
+    newline delimited JSON (Content-Type: application/x-ndjson). Lines
+    that aren't valid JSON are kept as None so they can be reported.
+    '''
+    if not request.data:
+        abort(400)
+
+    if request.mimetype == 'application/x-ndjson':
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)
+    else:
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            abort(400)
+
+    if len(items) > MAX_BATCH_SIZE:
+        abort(400)
+
+    return items
+
+
+def batch_insert(model, fields):
+    '''
+    Validates every item of a batch request with the same rules as the
+    single item routes, inserts the valid ones in one transaction and
+    returns a result per item.
+    '''
+    items = get_batch_items()
+
+    date_fields = [field for field in fields if isinstance(model.__table__.c[field].type, Date)]
+    results = []
+    rows = []
+    for index, item in enumerate(items):
+        # an item the database would reject must not fail the whole batch
+        values, error = validate_values(item, fields, date_fields)
+        if error:
+            results.append({'index': index, 'success': False, 'error': error})
+            continue
+
+        results.append({'index': index, 'success': True})
+        rows.append(dict(zip(fields, values)))
+
+    ids = model.insert_many(rows) if rows else []
+
+    inserted = iter(ids)
+    for result in results:
+        if result['success']:
+            result['id'] = next(inserted)
+
+    return jsonify({
+        'success': True,
+        'inserted': len(ids),
+        'results': results
+    })
+
+
+def encode_cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        return json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        abort(400)
+
+
+def parse_date(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        abort(400)
+
+
+def like_pattern(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def search_text(query, column, args, name):
+    '''
+    Applies ?<name>= (case-insensitive substring, served by a trigram
+    index) and ?<name>_prefix= (case-insensitive prefix, served by a
+    lower(column) text_pattern_ops index) to a query.
+    '''
+    contains = args.get(name)
+    if contains is not None:
+        if len(contains) < MIN_SEARCH_LENGTH:
+            abort(400)
+        query = query.filter(column.ilike('%' + like_pattern(contains) + '%'))
+
+    prefix = args.get(name + '_prefix')
+    if prefix is not None:
+        if not prefix:
+            abort(400)
+        query = query.filter(func.lower(column).like(like_pattern(prefix.lower()) + '%'))
+
+    return query
+
+
+def filter_actors(query, args):
+    query = search_text(query, Actor.name, args, 'name')
+
+    gender = args.get('gender')
+    if gender is not None:
+        query = query.filter(Actor.gender == gender)
+
+    return query
+
+
+def filter_movies(query, args):
+    query = search_text(query, Movie.title, args, 'title')
+
+    release_date_from = args.get('release_date_from')
+    if release_date_from is not None:
+        query = query.filter(Movie.release_date >= parse_date(release_date_from))
+
+    release_date_to = args.get('release_date_to')
+    if release_date_to is not None:
+        query = query.filter(Movie.release_date <= parse_date(release_date_to))
+
+    return query
+
+
+def get_sort(model, args):
+    '''
+    Reads ?sort=<column> or ?sort=-<column> (descending). Only columns
+    with an index that can serve the keyset order are allowed.
+    '''
+    sort = args.get('sort', 'id')
+    name = sort[1:] if sort.startswith('-') else sort
+    if name not in SORTABLE_COLUMNS[model.__tablename__]:
+        abort(400)
+    return getattr(model, name), sort.startswith('-')
+
+
+def after_cursor(model, column, descending, cursor):
+    '''
+    Builds the keyset condition for the rows after `cursor` in
+    ORDER BY column, id (both ascending or both descending), with NULLs
+    last when ascending and first when descending as Postgres does.
+    '''
+    if column.key == 'id':
+        if not isinstance(cursor, int):
+            abort(400)
+        return model.id < cursor if descending else model.id > cursor
+
+    if not isinstance(cursor, list) or len(cursor) != 2 or not isinstance(cursor[1], int):
+        abort(400)
+    value, id = cursor
+    if value is not None and isinstance(column.type, Date):
+        value = parse_date(value)
+
+    if descending:
+        if value is None:
+            return or_(and_(column.is_(None), model.id < id), column.isnot(None))
+        return or_(column < value, and_(column == value, model.id < id))
+
+    if value is None:
+        return and_(column.is_(None), model.id > id)
+    return or_(column > value, and_(column == value, model.id > id), column.is_(None))
+
+
+def page_query(model, query, args, limit):
+    '''
+    Applies ?sort= and ?cursor= to a query and limits it to one page (plus
+    one row to tell whether there is a next page). Returns the query and
+    the sort column.
+    '''
+    column, descending = get_sort(model, args)
+
+    cursor = args.get('cursor')
+    if cursor:
+        query = query.filter(after_cursor(model, column, descending, decode_cursor(cursor)))
+
+    if column.key == 'id':
+        order_by = [model.id.desc() if descending else model.id]
+    elif descending:
+        order_by = [column.desc().nullsfirst(), model.id.desc()]
+    else:
+        order_by = [column.asc().nullslast(), model.id]
+
+    return query.order_by(*order_by).limit(limit + 1), column
+
+
+def row_query(model, fields=None):
+    '''
+    Selects the columns format_row reads (or only `fields`, and the id) as
+    plain rows, skipping ORM instances and the identity map.
+    '''
+    if fields is None:
+        fields = ROW_FIELDS[model.__tablename__]
+    if 'id' not in fields:
+        fields = ('id',) + fields
+    return model.query.with_entities(*[getattr(model, field) for field in fields])
+
+
+def get_fields(model):
+    '''
+    Reads ?fields=id,name (a sparse fieldset) and checks every name is a
+    field of the model. Returns the fields to select and emit, all of
+    them when there is no ?fields=.
+    '''
+    fields = ROW_FIELDS[model.__tablename__]
+    requested = request.args.get('fields')
+    if requested is None:
+        return fields
+
+    names = requested.split(',')
+    if not all(name in fields for name in names):
+        abort(400)
+    return tuple(field for field in fields if field in names)
+
+
+def format_fields(model, row, fields):
+    if fields == ROW_FIELDS[model.__tablename__]:
+        return model.format_row(row)
+    return {field: getattr(row, field) for field in fields}
+
+
+def related_rows(model, column, other_column, ids):
+    '''
+    Loads the formatted rows of `model` linked through roles to each of
+    `ids` (`column` is the roles column of `ids`) in one query, as
+    {id: [rows ordered by id]}.
+    '''
+    related = {id: [] for id in ids}
+    if not ids:
+        return related
+
+    rows = row_query(model) \
+        .add_columns(column) \
+        .join(roles, other_column == model.id) \
+        .filter(column.in_(ids)) \
+        .order_by(model.id)
+    for row in rows:
+        related[row[-1]].append(model.format_row(row))
+    return related
+
+
+def get_limit():
+    limit = request.args.get('limit', str(DEFAULT_PAGE_SIZE))
+    # isdigit() also accepts digits like '²' that int() can't parse
+    if not (limit.isascii() and limit.isdecimal()) or int(limit) < 1:
+        abort(400)
+    return min(int(limit), MAX_PAGE_SIZE)
+
+
+def paginate(model, query=None):
+    '''
+    Keyset pagination. Reads ?limit=, ?cursor= and ?sort= from the
+    request and returns (rows, next_cursor). Every page is a single
+    WHERE (sort, id) > :cursor ORDER BY sort, id LIMIT n, so deep pages
+    cost the same as the first one.
+    '''
+    limit = get_limit()
+
+    if query is None:
+        query = row_query(model)
+    query, column = page_query(model, query, request.args, limit)
+    # the next cursor needs the sort value even if ?fields= left it out
+    if column.key not in [selected['name'] for selected in query.column_descriptions]:
+        query = query.add_columns(column)
+
+    rows = query.all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        if column.key == 'id':
+            next_cursor = encode_cursor(last.id)
+        else:
+            value = getattr(last, column.key)
+            if isinstance(value, datetime.date):
+                value = value.isoformat()
+            next_cursor = encode_cursor([value, last.id])
+
+    return rows, next_cursor
+
+
+def decode_change_token(token):
+    '''
+    Returns the (change_version, id, synced_at) position of a changes
+    token: the last change sent, and when the sync it continues started.
+    '''
+    position = decode_cursor(token)
+    if isinstance(position, list) and len(position) == 2:
+        # a token from before changes were ordered by version; start over
+        abort(410)
+    if not isinstance(position, list) or len(position) != 3 \
+            or not all(isinstance(value, int) for value in position[:2]):
+        abort(400)
+    try:
+        return position[0], position[1], datetime.datetime.fromisoformat(position[2])
+    except (TypeError, ValueError):
+        abort(400)
+
+
+def encode_change_token(change_version, id, synced_at):
+    return encode_cursor([change_version, id, synced_at.isoformat()])
+
+
+def changes(model):
+    '''
+    Returns the rows of a table created or updated, and the ids deleted,
+    since the ?since= token, oldest first, at most ?limit= of them, and
+    the token to ask for the next changes with. Changes are ordered by
+    (change_version, id), read from the (change_version, id) and
+    tombstone indexes, so a sync costs the number of changes, not the
+    size of the table.
+
+    Only changes up to the collection version read first are returned.
+    Versions commit in order (see collection_versions), so all of those
+    have committed, and a write still in flight gets a later version and
+    is returned by a later call. Reads go to the primary so no replica lag
+    can skip a change either.
+    '''
+    limit = get_limit()
+    since = request.args.get('since')
+    position = decode_change_token(since) if since else None
+    if position and position[2] < tombstone_horizon():
+        abort(410)
+
+    db.session().pin_primary()
+    version, _ = get_collection_version(model.__tablename__)
+
+    updated = row_query(model).add_columns(model.change_version) \
+        .filter(model.change_version <= version)
+    deleted = select([tombstones.c.id, tombstones.c.change_version]) \
+        .where(tombstones.c.collection == model.__tablename__) \
+        .where(tombstones.c.change_version <= version)
+    if position:
+        change_version, id, _ = position
+        updated = updated.filter(or_(model.change_version > change_version,
+                                     and_(model.change_version == change_version, model.id > id)))
+        deleted = deleted.where(or_(tombstones.c.change_version > change_version,
+                                    and_(tombstones.c.change_version == change_version, tombstones.c.id > id)))
+
+    updated = updated.order_by(model.change_version, model.id).limit(limit + 1)
+    deleted = deleted.order_by(tombstones.c.change_version, tombstones.c.id).limit(limit + 1)
+
+    found = sorted([(row.change_version, row.id, row) for row in updated]
+                   + [(row.change_version, row.id, None) for row in db.session.execute(deleted)],
+                   key=lambda change: change[:2])
+    has_more = len(found) > limit
+    found = found[:limit]
+
+    if has_more:
+        # the tombstones a sync needs are those of deletes since it started
+        started_at = position[2] if position else datetime.datetime.utcnow()
+        next_token = encode_change_token(*found[-1][:2], started_at)
+    else:
+        # everything up to `version` has been sent; ids start at 1
+        next_token = encode_change_token(version + 1, 0, datetime.datetime.utcnow())
+
+    return {
+        'success': True,
+        model.__tablename__: [model.format_row(row) for *_, row in found if row is not None],
+        'deleted': [id for _, id, row in found if row is None],
+        'next_token': next_token,
+        'has_more': has_more
+    }
+
+
+def get_include(allowed):
+    '''
+    Reads ?include= and checks it names the one relationship a list route
+    can embed. Returns True if it should be included.
+    '''
+    include = request.args.get('include')
+    if include is None:
+        return False
+    if include != allowed:
+        abort(400)
+    return True
+
+
+def collections_version(*names):
+    '''
+    Combines the version stamps of several collections into one ETag and
+    Last-Modified, for responses that embed rows of more than one table.
+    '''
+    etag = []
+    last_modified = None
+    for name in names:
+        version, updated_at = get_collection_version(name)
+        etag.append(f'{name}-{version}')
+        if updated_at and (last_modified is None or updated_at > last_modified):
+            last_modified = updated_at
+    return '-'.join(etag), last_modified
+
+
+def get_ids(key):
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get(key), list):
+        abort(400)
+
+    ids = data[key]
+    if not all(isinstance(id, int) for id in ids) or len(ids) > MAX_BATCH_SIZE:
+        abort(400)
+    return ids
+
+
+def round_up_to_second(moment):
+    '''
+    HTTP dates have whole seconds. Rounding up, not down, means a write
+    later in the same second is never mistaken for no change.
+    '''
+    rounded = moment.replace(microsecond=0)
+    if rounded < moment:
+        rounded += datetime.timedelta(seconds=1)
+    return rounded
+
+
+def not_modified(etag, last_modified=None):
+    '''
+    Checks the request's If-None-Match / If-Modified-Since headers against
+    the given validators and returns a 304 response if they match, or None
+    if the full response has to be built.
+    '''
+    if request.if_none_match:
+        matched = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and last_modified:
+        matched = round_up_to_second(last_modified) <= request.if_modified_since
+    else:
+        matched = False
+
+    if matched:
+        return with_validators(Response(status=304), etag, last_modified)
+    return None
+
+
+NOT_ASCII = re.compile(b'[\x7f-\xff]+')
+
+
+def escape_not_ascii(match):
+    return json.dumps(match.group().decode('utf-8')).encode()[1:-1]
+
+
+def dump_json(data):
+    '''
+    Serialises a response body with orjson, byte for byte the same as
+    jsonify: sorted keys, compact separators, non-ASCII escaped, dates
+    as HTTP dates and a trailing newline. Falls back to jsonify when
+    orjson isn't installed or the app's JSON settings differ from the
+    defaults (e.g. pretty printing in debug mode).
+    '''
+    config = current_app.config
+    with phase('serialization'):
+        if orjson is None or current_app.debug or config['JSONIFY_PRETTYPRINT_REGULAR'] \
+                or not config['JSON_SORT_KEYS'] or not config['JSON_AS_ASCII']:
+            return jsonify(data).get_data()
+
+        body = orjson.dumps(data, default=current_app.json_encoder().default,
+                            option=orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+        return NOT_ASCII.sub(escape_not_ascii, body) + b'\n'
+
+
+def json_response(data):
+    return Response(dump_json(data), mimetype='application/json')
+
+
+def cached_json(payload, version, tags, build):
+    '''
+    Returns a JSON response whose body comes from the response cache. The
+    body is cached per path, query string, permission set and `version`,
+    and build() is only called to make it on a miss. Identical requests
+    arriving while it is made wait for it and share the body.
+
+    Only the body is shared: every request reads `version` itself, so one
+    that arrives after a write never gets a body made before it.
+    '''
+    key = response_cache.key(request.path, request.args, payload.get('permissions', []), version)
+    body, shared = in_flight_reads.do(
+        key, lambda: response_cache.get_or_build(key, tags, lambda: dump_json(build())))
+    if shared:
+        COALESCED_REQUESTS.labels(route_label()).inc()
+    return Response(body, mimetype='application/json')
+
+
+def with_validators(response, etag, last_modified=None, weak=True):
+    response.set_etag(etag, weak=weak)
+    if last_modified:
+        # a Last-Modified in the future isn't allowed (RFC 7232 2.2.1), and a
+        # write can still follow in the current second: such a copy is only
+        # ever revalidated by its ETag
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        response.last_modified = min(round_up_to_second(last_modified), now)
+    return response
+
+
+def if_match_version(name, id):
+    '''
+    Returns the row version the request's If-Match header requires, or
+    None if there is no If-Match header (or it is *). A tag that isn't a
+    version of this row can never match, so that fails with 412 at once.
+    '''
+    if not request.if_match or request.if_match.star_tag:
+        return None
+
+    prefix = f'{name}-{id}-'
+    for tag in request.if_match.as_set():
+        version = tag[len(prefix):]
+        if tag.startswith(prefix) and version.isascii() and version.isdecimal():
+            return int(version)
+    abort(412)
+
+
+def abort_not_found_or_conflict(model, id, version):
+    if version is None or model.get_version(id) is None:
+        abort(404)
+    abort(412)
+
+
+def export(model):
+    '''
+    Streams every row of a table as newline delimited JSON. Rows are read
+    through a server-side cursor EXPORT_CHUNK_SIZE at a time and written
+    out a chunk at a time, so memory stays flat whatever the table size.
+    '''
+    def generate():
+        query = row_query(model).order_by(model.id).yield_per(EXPORT_CHUNK_SIZE)
+
+        chunk = []
+        for row in query:
+            chunk.append(json.dumps(model.format_row(row)))
+            if len(chunk) >= EXPORT_CHUNK_SIZE:
+                yield '\n'.join(chunk) + '\n'
+                chunk = []
+
+        if chunk:
+            yield '\n'.join(chunk) + '\n'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
 
 
 def create_app(test_config=None):
     app = Flask(__name__)
     setup_db(app)
     CORS(app)
+    init_metrics(app)
+    with app.app_context():
+        change_events.init_engine(db.engine)
+
+    @app.cli.command('reconcile-stats')
+    def reconcile_stats_command():
+        '''Recounts the /stats counts and corrects any drift.'''
+        drift = reconcile_stats()
+        if drift is None:
+            print('Another reconciliation is running')
+        else:
+            print(f'Corrected {len(drift)} counts: {drift}' if drift else 'No drift found')
+
+    @app.cli.command('import-data')
+    @click.argument('collection', type=click.Choice(['actors', 'movies']))
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--format', type=click.Choice(FORMATS), help='Defaults to csv for .csv files, ndjson otherwise.')
+    def import_data_command(collection, path, format):
+        '''Loads a CSV or NDJSON file of actors or movies with COPY.'''
+        model, fields = (Actor, ACTOR_FIELDS) if collection == 'actors' else (Movie, MOVIE_FIELDS)
+        try:
+            report = import_file(model, fields, path, format)
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+        print(report.summary())
+
+    @app.cli.command('prune-tombstones')
+    def prune_tombstones_command():
+        '''Deletes the tombstones older than TOMBSTONE_RETENTION_DAYS.'''
+        print(f'Deleted {prune_tombstones()} tombstones')
 
     @app.route('/', methods=['GET'])
     def welcome_page():
@@ -24,17 +656,114 @@ def create_app(test_config=None):
     @app.route('/actors', methods=['GET'])
     @requires_auth('get:actors')
     def get_all_actors(payload):
-        actors = Actor.query.all()
+        fields = get_fields(Actor)
+        include_movies = get_include('movies')
+        if include_movies:
+            check_permissions('get:movies', payload)
+        if include_movies:
+            etag, last_modified = collections_version('actors', 'movies')
+        else:
+            etag, last_modified = collections_version('actors')
+        cached = not_modified(etag, last_modified)
+        if cached:
+            return cached
+
+        def build():
+            actors, next_cursor = paginate(Actor, filter_actors(row_query(Actor, fields), request.args))
+            if include_movies:
+                movies = related_rows(Movie, roles.c.actor_id, roles.c.movie_id, [actor.id for actor in actors])
+
+            all_actors = []
+            for actor in actors:
+                formatted = format_fields(Actor, actor, fields)
+                if include_movies:
+                    formatted['movies'] = movies[actor.id]
+                all_actors.append(formatted)
+
+            return {
+                'success': True,
+                'actors': all_actors,
+                'next_cursor': next_cursor
+            }
+
+        tags = ['actors', 'movies'] if include_movies else ['actors']
+        return with_validators(cached_json(payload, etag, tags, build), etag, last_modified)
+
+    @app.route('/actors/<int:id>', methods=['GET'])
+    @requires_auth('get:actors')
+    def get_actor(payload, id):
+        version = Actor.get_version(id)
+        if version is None:
+            abort(404)
+
+        etag = f'actors-{id}-{version}'
+        cached = not_modified(etag)
+        if cached:
+            return cached
+
+        fields = get_fields(Actor)
+
+        def build():
+            actor = row_query(Actor, fields).filter(Actor.id == id).first()
+            if actor is None:
+                abort(404)
+            return {
+                'success': True,
+                'actor': format_fields(Actor, actor, fields)
+            }
+
+        return with_validators(cached_json(payload, etag, [f'actors:{id}'], build), etag, weak=False)
+
+    @app.route('/actors/<int:id>/movies', methods=['GET'])
+    @requires_auth('get:movies')
+    def get_actor_movies(payload, id):
+        if Actor.get_version(id) is None:
+            abort(404)
 
-        all_actors = []
-        for actor in actors:
-            all_actors.append(actor.format())
+        movies = row_query(Movie) \
+            .filter(Movie.id.in_(select([roles.c.movie_id]).where(roles.c.actor_id == id))) \
+            .order_by(Movie.id)
+
+        return json_response({
+            'success': True,
+            'actor_id': id,
+            'movies': [Movie.format_row(movie) for movie in movies]
+        })
+
+    @app.route('/actors/<int:id>/movies', methods=['POST'])
+    @requires_auth('patch:actors')
+    def link_actor_movies(payload, id):
+        movie_ids = get_ids('movie_ids')
+        if Actor.get_version(id) is None:
+            abort(404)
 
         return jsonify({
             'success': True,
-            'actors': all_actors
+            'linked': Actor.link_movies(id, movie_ids)
         })
 
+    @app.route('/actors/<int:id>/movies', methods=['DELETE'])
+    @requires_auth('patch:actors')
+    def unlink_actor_movies(payload, id):
+        movie_ids = get_ids('movie_ids')
+        if Actor.get_version(id) is None:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'unlinked': Actor.unlink_movies(id, movie_ids)
+        })
+
+    @app.route('/actors/changes', methods=['GET'])
+    @requires_auth('get:actors')
+    def get_actor_changes(payload):
+        return json_response(changes(Actor))
+
+    @app.route('/actors/export', methods=['GET'])
+    @requires_auth('get:actors')
+    def export_actors(payload):
+        return export(Actor)
+
     @app.route('/actors', methods=['POST'])
     @requires_auth('post:actors')
     def add_new_actor(payload):
@@ -43,35 +772,33 @@ def create_app(test_config=None):
         else:
             abort(400)
 
-        if not 'name' in data:
-            print('Please provide a name')
-            abort(403)
-
-        if not 'age' in data:
-            print('Please provide a age')
-            abort(403)
-
-        if not 'gender' in data:
-            print('Please provide a gender')
+        field = missing_field(data, ACTOR_FIELDS)
+        if field:
             abort(403)
 
         name = data['name']
         age = data['age']
         gender = data['gender']
 
-        actor = Actor(name=name, age=age, gender=gender)
-        actor.insert()
+        actor = Actor.insert_one({'name': name, 'age': age, 'gender': gender})
 
         return jsonify({
             'success': True,
-            'actor': actor.format()
+            'actor': Actor.format_row(actor)
         })
 
+    @app.route('/actors/batch', methods=['POST'])
+    @requires_auth('post:actors')
+    def add_new_actors(payload):
+        return batch_insert(Actor, ACTOR_FIELDS)
+
     @app.route('/actors/<int:id>', methods=['DELETE'])
     @requires_auth('delete:actors')
     def delete_actor(payload, id):
-        actor = Actor.query.get_or_404(id)
-        actor.delete()
+        version = if_match_version('actors', id)
+        if Actor.delete_by_id(id, version) is None:
+            abort_not_found_or_conflict(Actor, id, version)
+
         return jsonify({
             'success': True,
             'deleted_id': id
@@ -89,41 +816,140 @@ def create_app(test_config=None):
         age = data.get('age', None)
         gender = data.get('gender', None)
 
-        actor = Actor.query.get_or_404(id)
+        values = {}
 
         if name:
-            actor.name = name
+            values['name'] = name
 
         if age:
-            actor.age = age
+            values['age'] = age
 
         if gender:
-            actor.gender = gender
+            values['gender'] = gender
 
-        actor.update()
+        version = if_match_version('actors', id)
+        actor = Actor.update_by_id(id, values, version)
+        if actor is None:
+            abort_not_found_or_conflict(Actor, id, version)
 
-        return jsonify({
+        return with_validators(jsonify({
             'success': True,
-            'actor': actor.format()
-        })
+            'actor': Actor.format_row(actor)
+        }), f'actors-{id}-{actor.version}', weak=False)
 
     # ROUTES FOR MOVIES
 
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
     def get_all_movies(payload):
-        movies = Movie.query.all()
+        fields = get_fields(Movie)
+        include_actors = get_include('actors')
+        if include_actors:
+            check_permissions('get:actors', payload)
+        if include_actors:
+            etag, last_modified = collections_version('movies', 'actors')
+        else:
+            etag, last_modified = collections_version('movies')
+        cached = not_modified(etag, last_modified)
+        if cached:
+            return cached
+
+        def build():
+            movies, next_cursor = paginate(Movie, filter_movies(row_query(Movie, fields), request.args))
+            if include_actors:
+                actors = related_rows(Actor, roles.c.movie_id, roles.c.actor_id, [movie.id for movie in movies])
 
-        all_movies = []
-        for movie in movies:
-            all_movies.append(movie.format())
+            all_movies = []
+            for movie in movies:
+                formatted = format_fields(Movie, movie, fields)
+                if include_actors:
+                    formatted['actors'] = actors[movie.id]
+                all_movies.append(formatted)
+
+            return {
+                'movies': all_movies,
+                'next_cursor': next_cursor,
+                'success': True
+            }
+
+        tags = ['movies', 'actors'] if include_actors else ['movies']
+        return with_validators(cached_json(payload, etag, tags, build), etag, last_modified)
+
+    @app.route('/movies/<int:id>', methods=['GET'])
+    @requires_auth('get:movies')
+    def get_movie(payload, id):
+        version = Movie.get_version(id)
+        if version is None:
+            abort(404)
+
+        etag = f'movies-{id}-{version}'
+        cached = not_modified(etag)
+        if cached:
+            return cached
+
+        fields = get_fields(Movie)
+
+        def build():
+            movie = row_query(Movie, fields).filter(Movie.id == id).first()
+            if movie is None:
+                abort(404)
+            return {
+                'success': True,
+                'movie': format_fields(Movie, movie, fields)
+            }
+
+        return with_validators(cached_json(payload, etag, [f'movies:{id}'], build), etag, weak=False)
+
+    @app.route('/movies/<int:id>/actors', methods=['GET'])
+    @requires_auth('get:actors')
+    def get_movie_actors(payload, id):
+        if Movie.get_version(id) is None:
+            abort(404)
+
+        actors = row_query(Actor) \
+            .filter(Actor.id.in_(select([roles.c.actor_id]).where(roles.c.movie_id == id))) \
+            .order_by(Actor.id)
+
+        return json_response({
+            'success': True,
+            'movie_id': id,
+            'actors': [Actor.format_row(actor) for actor in actors]
+        })
+
+    @app.route('/movies/<int:id>/actors', methods=['POST'])
+    @requires_auth('patch:movies')
+    def link_movie_actors(payload, id):
+        actor_ids = get_ids('actor_ids')
+        if Movie.get_version(id) is None:
+            abort(404)
 
-        print(all_movies)
         return jsonify({
-            'movies': all_movies,
-            'success': True
+            'success': True,
+            'linked': Movie.link_actors(id, actor_ids)
         })
 
+    @app.route('/movies/<int:id>/actors', methods=['DELETE'])
+    @requires_auth('patch:movies')
+    def unlink_movie_actors(payload, id):
+        actor_ids = get_ids('actor_ids')
+        if Movie.get_version(id) is None:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'unlinked': Movie.unlink_actors(id, actor_ids)
+        })
+
+    @app.route('/movies/changes', methods=['GET'])
+    @requires_auth('get:movies')
+    def get_movie_changes(payload):
+        return json_response(changes(Movie))
+
+    @app.route('/movies/export', methods=['GET'])
+    @requires_auth('get:movies')
+    def export_movies(payload):
+        return export(Movie)
+
     @app.route('/movies', methods=['POST'])
     @requires_auth('post:movies')
     def add_new_movie(payload):
@@ -132,30 +958,32 @@ def create_app(test_config=None):
         else:
             abort(400)
 
-        if not 'title' in data:
-            print('Please provide a title')
-            abort(403)
-
-        if not 'release_date' in data:
-            print('Please provide a release date')
+        field = missing_field(data, MOVIE_FIELDS)
+        if field:
             abort(403)
 
         title = data['title']
         release_date = data['release_date']
 
-        movie = Movie(title=title, release_date=release_date)
-        movie.insert()
+        movie = Movie.insert_one({'title': title, 'release_date': release_date})
 
         return jsonify({
             'success': True,
-            'movie': movie.format()
+            'movie': Movie.format_row(movie)
         })
 
+    @app.route('/movies/batch', methods=['POST'])
+    @requires_auth('post:movies')
+    def add_new_movies(payload):
+        return batch_insert(Movie, MOVIE_FIELDS)
+
     @app.route('/movies/<int:id>', methods=['DELETE'])
     @requires_auth('delete:movies')
     def delete_movie(payload, id):
-        movie = Movie.query.get_or_404(id)
-        movie.delete()
+        version = if_match_version('movies', id)
+        if Movie.delete_by_id(id, version) is None:
+            abort_not_found_or_conflict(Movie, id, version)
+
         return jsonify({
             'success': True,
             'deleted_id': id
@@ -169,23 +997,62 @@ def create_app(test_config=None):
         else:
             abort(400)
 
-        movie = Movie.query.get_or_404(id)
-
         title = data.get('title', None)
         release_date = data.get('release_date', None)
 
+        values = {}
+
         if title:
-            movie.title = title
+            values['title'] = title
 
         if release_date:
-            movie.release_date = release_date
+            values['release_date'] = release_date
 
-        movie.update()
+        version = if_match_version('movies', id)
+        movie = Movie.update_by_id(id, values, version)
+        if movie is None:
+            abort_not_found_or_conflict(Movie, id, version)
 
-        return jsonify({
+        return with_validators(jsonify({
             'success': True,
-            'movie': movie.format()
-        })
+            'movie': Movie.format_row(movie)
+        }), f'movies-{id}-{movie.version}', weak=False)
+
+    # STATS
+
+    @app.route('/stats', methods=['GET'])
+    @requires_auth('get:actors')
+    def get_all_stats(payload):
+        check_permissions('get:movies', payload)
+
+        etag, last_modified = collections_version('actors', 'movies')
+        cached = not_modified(etag, last_modified)
+        if cached:
+            return cached
+
+        stats = get_stats()
+        return with_validators(json_response({
+            'success': True,
+            'actors': sum(stats['actors_by_gender'].values()),
+            'movies': sum(stats['movies_by_release_year'].values()),
+            **stats
+        }), etag, last_modified)
+
+    # EVENTS
+
+    @app.route('/events', methods=['GET'])
+    @requires_auth(('get:actors', 'get:movies'), in_flight=False)
+    def get_events(payload):
+        collections = [name for name in ('actors', 'movies') if f'get:{name}' in payload['permissions']]
+        subscription = change_events.broker.subscribe(collections)
+        if subscription is None:
+            abort(503)
+
+        response = Response(stream_events(subscription), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        response.call_on_close(lambda: change_events.broker.unsubscribe(subscription))
+        return response
 
     # SETTING UP ERROR HANDLING
 
@@ -221,6 +1088,41 @@ def create_app(test_config=None):
             "message": "not found"
         }), 404
 
+    @app.errorhandler(410)
+    def gone(error):
+        return jsonify({
+            "success": False,
+            "error": 410,
+            "message": "gone"
+        }), 410
+
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        return jsonify({
+            "success": False,
+            "error": 412,
+            "message": "precondition failed"
+        }), 412
+
+    @app.errorhandler(503)
+    def unavailable(error):
+        return jsonify({
+            "success": False,
+            "error": 503,
+            "message": "service unavailable"
+        }), 503
+
+    @app.errorhandler(Overloaded)
+    def handle_overloaded(ex):
+        response = jsonify({
+            "success": False,
+            "error": ex.status_code,
+            "message": ex.message
+        })
+        response.status_code = ex.status_code
+        response.headers['Retry-After'] = str(ex.retry_after)
+        return response
+
     @app.errorhandler(AuthError)
     def handle_auth_error(ex):
         response = jsonify(ex.error)
@@ -1,13 +1,31 @@
 import os
-import json
-from flask import request, _request_ctx_stack, abort
+from flask import request, _request_ctx_stack, abort, make_response
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
+
+from jwks import JWKSKeyStore
+from token_cache import TokenCache
+from metrics import phase
+from rate_limit import create_admission
 
 AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 ALGORITHMS = ['RS256']
 API_AUDIENCE = os.environ['API_AUDIENCE']
+JWKS_URL = os.environ.get('JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 600))
+JWKS_MIN_REFRESH_INTERVAL = int(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+TOKEN_CACHE_MAX_TTL = int(os.environ.get('TOKEN_CACHE_MAX_TTL', 300))
+
+jwks_store = JWKSKeyStore(JWKS_URL,
+                          ttl=JWKS_CACHE_TTL,
+                          min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL)
+
+token_cache = TokenCache(maxsize=TOKEN_CACHE_SIZE,
+                         max_ttl=TOKEN_CACHE_MAX_TTL,
+                         key_version=jwks_store.current_version)
+
+admission = create_admission()
 
 # AuthError Exception
 '''
@@ -67,46 +85,34 @@ def get_token_auth_header():
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-    #print(jwks)
-    unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
+    with phase('jwt'):
+        unverified_header = jwt.get_unverified_header(token)
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    with phase('jwks'):
+        rsa_key = jwks_store.get_key(unverified_header['kid'])
     if rsa_key:
         try:
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
-            )
-            return payload
+            with phase('jwt'):
+                payload = jwt.decode(
+                    token,
+                    rsa_key,
+                    algorithms=ALGORITHMS,
+                    audience=API_AUDIENCE,
+                    issuer='https://' + AUTH0_DOMAIN + '/'
+                )
 
         except jwt.ExpiredSignatureError:
-            print('EXPIRED')
             raise AuthError({
                 'code': 'token_expired',
                 'description': 'Token expired.'
             }, 401)
 
         except jwt.JWTClaimsError:
-            print('CLAIMS')
             raise AuthError({
                 'code': 'invalid_claims',
                 'description': 'Incorrect claims. Please, check the audience and issuer.'
@@ -116,6 +122,14 @@ def verify_decode_jwt(token):
                 'code': 'invalid_header',
                 'description': 'Unable to parse authentication token.'
             }, 400)
+
+        # rate limits are kept per subject, a token without one can't be told apart
+        if not payload.get('sub'):
+            raise AuthError({
+                'code': 'invalid_claims',
+                'description': 'Token has no subject.'
+            }, 401)
+        return payload
     raise AuthError({
         'code': 'invalid_header',
         'description': 'Unable to find the appropriate key.'
@@ -126,20 +140,49 @@ def check_permissions(permission, payload):
     if 'permissions' not in payload:
         abort(400)
 
-    if permission not in payload['permissions']:
+    # a tuple of permissions allows any one of them
+    allowed = permission if isinstance(permission, tuple) else (permission,)
+    if not any(name in payload['permissions'] for name in allowed):
         abort(403)
 
     return True
 
 
-def requires_auth(permission=''):
+def authorize(permission):
+    with phase('header'):
+        token = get_token_auth_header()
+    with phase('jwt'):
+        payload = token_cache.get(token)
+    if payload is None:
+        payload = verify_decode_jwt(token)
+        token_cache.set(token, payload)
+    with phase('permissions'):
+        check_permissions(permission, payload)
+        admission.check_rate(payload['sub'], permission)
+    return payload
+
+
+def requires_auth(permission='', in_flight=True):
+    '''
+    Authorizes the request, then calls the view with the token payload.
+    The request holds a place among the requests in flight until its
+    response is sent, streamed bodies included. Routes with
+    in_flight=False are left out of MAX_IN_FLIGHT: long-lived streams
+    that are capped on their own, like /events.
+    '''
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            if not in_flight:
+                return f(authorize(permission), *args, **kwargs)
+
+            admission.enter()
+            try:
+                response = make_response(f(authorize(permission), *args, **kwargs))
+            except BaseException:
+                admission.leave()
+                raise
+            return admission.leave_after(response)
 
         return wrapper
 
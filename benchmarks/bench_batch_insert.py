@@ -0,0 +1,78 @@
+'''
+Compares the rows/sec of POST /actors (one actor per request) with
+POST /actors/batch (many actors per request, one transaction).
+
+Uses the same environment as test_app.py (DATABASE_URL, JWT_PRODUCER).
+The actors it creates are deleted again at the end.
+
+    python benchmarks/bench_batch_insert.py --rows 2000 --batch-size 500
+'''
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# admission control would turn the benchmark's own requests away
+os.environ['RATE_LIMIT'] = 'none'
+os.environ['MAX_IN_FLIGHT'] = '0'
+
+from app import create_app
+from models import Actor
+
+
+def single_inserts(client, headers, rows):
+    ids = []
+    for i in range(rows):
+        res = client.post('/actors',
+                          data=json.dumps({'name': f'Bench Actor {i}', 'age': '30', 'gender': 'Female'}),
+                          headers=headers)
+        ids.append(json.loads(res.data)['actor']['id'])
+    return ids
+
+
+def batch_inserts(client, headers, rows, batch_size):
+    ids = []
+    for start in range(0, rows, batch_size):
+        items = [{'name': f'Bench Actor {i}', 'age': '30', 'gender': 'Female'}
+                 for i in range(start, min(start + batch_size, rows))]
+        res = client.post('/actors/batch', data=json.dumps(items), headers=headers)
+        ids.extend(result['id'] for result in json.loads(res.data)['results'])
+    return ids
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    app = create_app()
+    client = app.test_client()
+    headers = {'Content-Type': 'application/json',
+               'Authorization': 'Bearer ' + os.environ['JWT_PRODUCER']}
+
+    single_ids, single_time = timed(single_inserts, client, headers, args.rows)
+    batch_ids, batch_time = timed(batch_inserts, client, headers, args.rows, args.batch_size)
+
+    print(f'single: {args.rows} rows in {single_time:.2f}s, {args.rows / single_time:.0f} rows/sec')
+    print(f'batch:  {args.rows} rows in {batch_time:.2f}s, {args.rows / batch_time:.0f} rows/sec '
+          f'(batch size {args.batch_size})')
+    print(f'speedup: {single_time / batch_time:.1f}x')
+
+    # through the write path, so tombstones, /stats and the versions follow
+    with app.test_request_context('/actors', method='DELETE'):
+        for id in single_ids + batch_ids:
+            Actor.delete_by_id(id)
+
+
+if __name__ == '__main__':
+    main()
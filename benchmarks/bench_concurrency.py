@@ -0,0 +1,71 @@
+'''
+Load test of a running server: sends requests at increasing numbers of
+concurrent clients and reports throughput and latency at each level, to
+show how many requests one process keeps in flight.
+
+Start a single worker with the worker class to measure, e.g.
+
+    WEB_CONCURRENCY=1 GUNICORN_WORKER_CLASS=sync RATE_LIMIT=none MAX_IN_FLIGHT=0 gunicorn app:app
+    WEB_CONCURRENCY=1 GUNICORN_WORKER_CLASS=gevent RATE_LIMIT=none MAX_IN_FLIGHT=0 gunicorn app:app
+
+then run
+
+    python benchmarks/bench_concurrency.py --url http://127.0.0.1:8000 --concurrency 1 10 50 100
+
+With sync workers throughput stops growing at one request in flight;
+with gevent workers it keeps growing until the database pool or the CPU
+is saturated. Uses JWT_ASSISTANT for the Authorization header.
+'''
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+
+def fetch(url, headers):
+    start = time.perf_counter()
+    try:
+        with urlopen(Request(url, headers=headers)) as response:
+            response.read()
+            ok = response.status == 200
+    except HTTPError:
+        ok = False
+    return time.perf_counter() - start, ok
+
+
+def percentile(latencies, fraction):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+
+def run(url, headers, concurrency, requests):
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        start = time.perf_counter()
+        results = list(executor.map(lambda _: fetch(url, headers), range(requests)))
+        elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _ in results)
+    errors = sum(1 for _, ok in results if not ok)
+    print(f'concurrency {concurrency:4d}: {requests / elapsed:8.1f} req/s, '
+          f'p50 {percentile(latencies, 0.5) * 1000:7.1f} ms, '
+          f'p99 {percentile(latencies, 0.99) * 1000:7.1f} ms, '
+          f'{errors} errors')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--path', default='/actors?limit=10')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50, 100])
+    parser.add_argument('--requests', type=int, default=20,
+                        help='requests per concurrent client at each level')
+    args = parser.parse_args()
+
+    headers = {'Authorization': 'Bearer ' + os.environ['JWT_ASSISTANT']}
+    for concurrency in args.concurrency:
+        run(args.url + args.path, headers, concurrency, concurrency * args.requests)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+'''
+Compares the rows/sec of single-row inserts from many concurrent threads,
+each committing on its own and with GROUP_COMMIT, and prints the sizes
+of the batches that were committed together.
+
+Uses DATABASE_URL like test_app.py, ideally a Postgres database, where
+every commit waits for its WAL flush. The actors it creates are deleted
+again at the end.
+
+    python benchmarks/bench_group_commit.py --threads 32 --rows 4000
+'''
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# admission control would turn the benchmark's own requests away
+os.environ['RATE_LIMIT'] = 'none'
+os.environ['MAX_IN_FLIGHT'] = '0'
+
+import models
+from app import create_app
+from group_commit import GroupCommit
+from models import db, Actor, bump_collection_versions, notify_mutation, stage_mutation
+
+
+def run(app, threads, rows):
+    def insert(i):
+        with app.test_request_context('/actors', method='POST'):
+            # the id is read before the session is gone; commit expires the ORM instance
+            id = Actor.insert_one({'name': f'Bench Actor {i}', 'age': '30', 'gender': 'Female'}).id
+            db.session.remove()
+            return id
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        ids = list(executor.map(insert, range(rows)))
+    return ids, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--max-batch', type=int, default=models.GROUP_COMMIT_MAX_BATCH)
+    parser.add_argument('--max-wait-ms', type=float, default=models.GROUP_COMMIT_MAX_WAIT_MS)
+    args = parser.parse_args()
+
+    app = create_app()
+
+    models.group_commit = None
+    single_ids, single_time = run(app, args.threads, args.rows)
+
+    with app.app_context():
+        group_commit = GroupCommit(db.engine, bump_collection_versions, notify_mutation, stage=stage_mutation,
+                                   max_batch=args.max_batch, max_wait=args.max_wait_ms / 1000)
+    models.group_commit = group_commit
+    group_ids, group_time = run(app, args.threads, args.rows)
+    models.group_commit = None
+
+    print(f'single commits: {args.rows} rows in {single_time:.2f}s, {args.rows / single_time:.0f} rows/sec')
+    print(f'group commit:   {args.rows} rows in {group_time:.2f}s, {args.rows / group_time:.0f} rows/sec '
+          f'({args.threads} threads, max batch {args.max_batch}, max wait {args.max_wait_ms} ms)')
+    print(f'speedup: {single_time / group_time:.1f}x')
+
+    stats = group_commit.stats()
+    print(f'{stats["commits"]} commits, {stats["failed_commits"]} failed, '
+          f'{args.rows / max(stats["commits"], 1):.1f} rows per commit on average')
+    print('batch size  commits')
+    for size, count in stats['batch_sizes'].items():
+        print(f'{size:>10}  {count}')
+
+    # through the write path, so tombstones, /stats and the versions follow
+    with app.test_request_context('/actors', method='DELETE'):
+        for id in single_ids + group_ids:
+            Actor.delete_by_id(id)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+'''
+Self-contained benchmark of every route of the API. It needs no Auth0
+tenant and no pre-issued tokens:
+
+- a local JWKS is served and tokens are minted for the assistant,
+  director and producer roles (see local_auth.py)
+- the database at --database-url is seeded with --rows actors and
+  movies, each actor cast in --casts movies
+- the server is started with gunicorn, and every route is driven at
+  each --concurrency level in turn, reads first, deletes last; the
+  /events stream is timed until its first line
+
+Throughput and p50/p95/p99 latency are printed for every route and
+saved as JSON to --output, with the commit they were measured on.
+Pass an earlier result as --compare to see what changed.
+
+Use a dedicated database: --reset drops and recreates every table.
+Write routes need Postgres (they use RETURNING).
+
+    python benchmarks/bench_routes.py --database-url postgresql://localhost/bench \\
+        --reset --rows 100000 --concurrency 1 10 50 --requests 500 --output results.json
+'''
+import argparse
+import base64
+import datetime
+import http.client
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from local_auth import LocalAuth
+
+SEED_CHUNK_SIZE = 10000
+
+'''
+Route
+One benchmarked route: `role` is the token it is called with and
+request(rows) returns the (method, path, body) of the next call. Heavy
+routes (the exports) are only run with --heavy. A `stream` (/events)
+never ends, so it is timed to its first line and then disconnected.
+'''
+Route = namedtuple('Route', ['name', 'role', 'request', 'heavy', 'stream'], defaults=[False])
+
+
+def routes():
+    ids = {'actors': itertools.count(), 'movies': itertools.count()}
+
+    def any_id(rows):
+        return random.randint(1, rows)
+
+    def last_id(collection, rows):
+        # deletes work down from the last seeded row, one row per call
+        return rows - next(ids[collection])
+
+    def some_ids(rows):
+        return random.sample(range(1, rows + 1), min(3, rows))
+
+    def actor(n):
+        return {'name': f'Bench Actor {n}', 'age': str(20 + n % 60), 'gender': random.choice(['Female', 'Male'])}
+
+    def movie(n):
+        return {'title': f'Bench Movie {n}', 'release_date': '2020-05-12'}
+
+    def since(rows):
+        # a position among the seeded rows, which all have the first version
+        return encode_cursor([0, any_id(rows), datetime.datetime.utcnow().isoformat()])
+
+    return [
+        Route('GET /', None, lambda rows: ('GET', '/', None), False),
+        Route('GET /metrics', None, lambda rows: ('GET', '/metrics', None), False),
+
+        Route('GET /actors', 'assistant', lambda rows: ('GET', '/actors', None), False),
+        Route('GET /actors?cursor', 'assistant',
+              lambda rows: ('GET', f'/actors?limit=20&cursor={encode_cursor(any_id(rows))}', None), False),
+        Route('GET /actors?include=movies', 'assistant',
+              lambda rows: ('GET', f'/actors?include=movies&limit=20&cursor={encode_cursor(any_id(rows))}', None),
+              False),
+        Route('GET /actors?name', 'assistant',
+              lambda rows: ('GET', f'/actors?name=ctor%20{any_id(rows)}&limit=20', None), False),
+        Route('GET /actors?sort=-name', 'assistant', lambda rows: ('GET', '/actors?sort=-name&limit=20', None), False),
+        Route('GET /actors?fields', 'assistant',
+              lambda rows: ('GET', f'/actors?fields=id,name&cursor={encode_cursor(any_id(rows))}', None), False),
+        Route('GET /actors/id', 'assistant', lambda rows: ('GET', f'/actors/{any_id(rows)}', None), False),
+        Route('GET /actors/id/movies', 'assistant', lambda rows: ('GET', f'/actors/{any_id(rows)}/movies', None), False),
+        Route('GET /actors/export', 'assistant', lambda rows: ('GET', '/actors/export', None), True),
+        Route('GET /actors/changes', 'assistant', lambda rows: ('GET', '/actors/changes?limit=100', None), False),
+        Route('GET /actors/changes?since', 'assistant',
+              lambda rows: ('GET', f'/actors/changes?limit=100&since={since(rows)}', None), False),
+
+        Route('GET /movies', 'assistant', lambda rows: ('GET', '/movies', None), False),
+        Route('GET /movies?include=actors', 'assistant',
+              lambda rows: ('GET', f'/movies?include=actors&limit=20&cursor={encode_cursor(any_id(rows))}', None),
+              False),
+        Route('GET /movies?release_date', 'assistant',
+              lambda rows: ('GET', '/movies?release_date_from=2000-01-01&release_date_to=2000-12-31&limit=20', None),
+              False),
+        Route('GET /movies/id', 'assistant', lambda rows: ('GET', f'/movies/{any_id(rows)}', None), False),
+        Route('GET /movies/id/actors', 'assistant', lambda rows: ('GET', f'/movies/{any_id(rows)}/actors', None), False),
+        Route('GET /movies/export', 'assistant', lambda rows: ('GET', '/movies/export', None), True),
+        Route('GET /movies/changes', 'assistant', lambda rows: ('GET', '/movies/changes?limit=100', None), False),
+        Route('GET /movies/changes?since', 'assistant',
+              lambda rows: ('GET', f'/movies/changes?limit=100&since={since(rows)}', None), False),
+
+        Route('GET /stats', 'assistant', lambda rows: ('GET', '/stats', None), False),
+        Route('GET /events', 'assistant', lambda rows: ('GET', '/events', None), False, True),
+
+        Route('POST /actors', 'director', lambda rows: ('POST', '/actors', actor(any_id(rows))), False),
+        Route('POST /actors/batch', 'director',
+              lambda rows: ('POST', '/actors/batch', [actor(n) for n in range(100)]), False),
+        Route('PATCH /actors/id', 'director',
+              lambda rows: ('PATCH', f'/actors/{any_id(rows)}', {'name': f'Bench Actor {any_id(rows)}'}), False),
+        Route('POST /actors/id/movies', 'director',
+              lambda rows: ('POST', f'/actors/{any_id(rows)}/movies', {'movie_ids': some_ids(rows)}), False),
+        Route('DELETE /actors/id/movies', 'director',
+              lambda rows: ('DELETE', f'/actors/{any_id(rows)}/movies', {'movie_ids': some_ids(rows)}), False),
+
+        Route('POST /movies', 'producer', lambda rows: ('POST', '/movies', movie(any_id(rows))), False),
+        Route('POST /movies/batch', 'producer',
+              lambda rows: ('POST', '/movies/batch', [movie(n) for n in range(100)]), False),
+        Route('PATCH /movies/id', 'producer',
+              lambda rows: ('PATCH', f'/movies/{any_id(rows)}', {'title': f'Bench Movie {any_id(rows)}'}), False),
+        Route('POST /movies/id/actors', 'producer',
+              lambda rows: ('POST', f'/movies/{any_id(rows)}/actors', {'actor_ids': some_ids(rows)}), False),
+        Route('DELETE /movies/id/actors', 'producer',
+              lambda rows: ('DELETE', f'/movies/{any_id(rows)}/actors', {'actor_ids': some_ids(rows)}), False),
+
+        Route('DELETE /actors/id', 'director', lambda rows: ('DELETE', f'/actors/{last_id("actors", rows)}', None),
+              False),
+        Route('DELETE /movies/id', 'producer', lambda rows: ('DELETE', f'/movies/{last_id("movies", rows)}', None),
+              False),
+    ]
+
+
+def encode_cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip('=')
+
+
+def seed(database_url, rows, casts, reset):
+    '''
+    Creates the schema and inserts `rows` actors and movies, each actor
+    cast in `casts` movies, SEED_CHUNK_SIZE rows per statement.
+    '''
+    os.environ['DATABASE_URL'] = database_url
+    sys.path.insert(0, ROOT)
+    from sqlalchemy import create_engine
+    from models import db, Actor, Movie, roles
+
+    options = {'executemany_mode': 'values'} if database_url.startswith('postgres') else {}
+    engine = create_engine(database_url, **options)
+    if reset:
+        db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+
+    first_day = datetime.date(1950, 1, 1)
+    for start in range(1, rows + 1, SEED_CHUNK_SIZE):
+        chunk = range(start, min(start + SEED_CHUNK_SIZE, rows + 1))
+        engine.execute(Actor.__table__.insert(), [
+            {'id': n, 'name': f'Actor {n}', 'age': str(20 + n % 60), 'gender': ('Female', 'Male')[n % 2]}
+            for n in chunk
+        ])
+        engine.execute(Movie.__table__.insert(), [
+            {'id': n, 'title': f'Movie {n}', 'release_date': first_day + datetime.timedelta(days=n % 25000)}
+            for n in chunk
+        ])
+        engine.execute(roles.insert(), [
+            {'actor_id': n, 'movie_id': movie_id}
+            for n in chunk for movie_id in random.sample(range(1, rows + 1), min(casts, rows))
+        ])
+
+    if engine.dialect.name == 'postgresql':
+        for table in ('actors', 'movies'):
+            engine.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), {rows})")
+        engine.execute('ANALYZE')
+    engine.dispose()
+
+
+def start_server(port, environment, workers, worker_class):
+    env = dict(os.environ, **environment,
+               WEB_CONCURRENCY=str(workers),
+               GUNICORN_WORKER_CLASS=worker_class)
+    # gunicorn 20.0 can't be run with -m
+    server = subprocess.Popen([sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()',
+                               '--config', 'gunicorn.conf.py',
+                               '--bind', f'127.0.0.1:{port}', 'app:app'],
+                              cwd=ROOT, env=env)
+
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('the server exited while starting')
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/')
+            if connection.getresponse().status == 200:
+                return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('the server did not start within 60 seconds')
+
+
+class Client(threading.local):
+    def __init__(self, port):
+        self.connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+
+    def call(self, method, path, body, headers, stream=False):
+        data = json.dumps(body).encode() if body is not None else None
+        start = time.perf_counter()
+        try:
+            self.connection.request(method, path, body=data, headers=headers)
+            response = self.connection.getresponse()
+            if stream and response.status == 200:
+                response.readline()
+                # the next request opens a new connection
+                self.connection.close()
+            else:
+                response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            status = None
+        return time.perf_counter() - start, status
+
+
+def percentile(latencies, fraction):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+
+def run_route(route, client, tokens, rows, concurrency, requests):
+    headers = {'Content-Type': 'application/json'}
+    if route.role:
+        headers['Authorization'] = 'Bearer ' + tokens[route.role]
+
+    def call(_):
+        method, path, body = route.request(rows)
+        return client.call(method, path, body, headers, route.stream)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        start = time.perf_counter()
+        results = list(executor.map(call, range(requests)))
+        elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _ in results)
+    return {
+        'route': route.name,
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': sum(1 for _, status in results if status is None or status >= 400),
+        'throughput': requests / elapsed,
+        'mean': sum(latencies) / len(latencies),
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99)
+    }
+
+
+def print_result(result, baseline=None):
+    line = (f"{result['route']:32} c={result['concurrency']:<4} {result['throughput']:9.1f} req/s  "
+            f"p50 {result['p50'] * 1000:8.1f} ms  p95 {result['p95'] * 1000:8.1f} ms  "
+            f"p99 {result['p99'] * 1000:8.1f} ms  {result['errors']} errors")
+    if baseline:
+        line += (f"  ({(result['throughput'] / baseline['throughput'] - 1) * 100:+.0f}% req/s, "
+                 f"{(result['p99'] / baseline['p99'] - 1) * 100:+.0f}% p99)")
+    print(line)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--rows', type=int, default=1000, help='actors and movies to seed (10^3 to 10^6)')
+    parser.add_argument('--casts', type=int, default=3, help='movies each seeded actor is cast in')
+    parser.add_argument('--reset', action='store_true', help='drop and recreate every table before seeding')
+    parser.add_argument('--skip-seed', action='store_true', help='benchmark the rows already in the database')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10])
+    parser.add_argument('--requests', type=int, default=200, help='requests per route and concurrency level')
+    parser.add_argument('--routes', nargs='*', help='only run routes whose name contains one of these')
+    parser.add_argument('--heavy', action='store_true', help='also run the export routes')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--worker-class', default='gevent')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--output', help='save the results as JSON to this file')
+    parser.add_argument('--compare', help='a JSON file saved by an earlier run to compare with')
+    args = parser.parse_args()
+
+    if not args.database_url:
+        parser.error('--database-url or DATABASE_URL is required')
+
+    selected = [route for route in routes()
+                if (args.heavy or not route.heavy)
+                and (not args.routes or any(name in route.name for name in args.routes))]
+
+    if not args.skip_seed:
+        start = time.perf_counter()
+        seed(args.database_url, args.rows, args.casts, args.reset)
+        print(f'seeded {args.rows} actors and movies in {time.perf_counter() - start:.1f}s')
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {(result['route'], result['concurrency']): result for result in json.load(f)['results']}
+
+    auth = LocalAuth().start()
+    tokens = {role: auth.token(role) for role in ('assistant', 'director', 'producer')}
+    # admission control would turn the benchmark's own load away
+    server = start_server(args.port, dict(auth.environment(), DATABASE_URL=args.database_url,
+                                          RATE_LIMIT='none', MAX_IN_FLIGHT='0'),
+                          args.workers, args.worker_class)
+
+    results = []
+    try:
+        client = Client(args.port)
+        for route in selected:
+            for concurrency in args.concurrency:
+                result = run_route(route, client, tokens, args.rows, concurrency, args.requests)
+                print_result(result, baseline.get((route.name, concurrency)))
+                results.append(result)
+    finally:
+        server.terminate()
+        server.wait()
+        auth.stop()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'commit': git_commit(),
+                'date': datetime.datetime.utcnow().isoformat(),
+                'rows': args.rows,
+                'casts': args.casts,
+                'workers': args.workers,
+                'worker_class': args.worker_class,
+                'results': results
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+'''
+Compares the rows/sec of building a list response the old way (ORM
+instances, format() and jsonify) with the fast path the read routes use
+(plain rows from row_query, format_row and dump_json), and checks both
+produce the same bytes.
+
+Uses the same environment as test_app.py (DATABASE_URL). The rows it
+creates are deleted again at the end.
+
+    python benchmarks/bench_serialization.py --rows 10000 --repeat 5
+'''
+import argparse
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import jsonify
+
+from app import create_app, row_query, dump_json
+from models import db, Movie
+
+
+def orm_path():
+    movies = Movie.query.order_by(Movie.id).all()
+    return jsonify({'movies': [movie.format() for movie in movies]}).get_data()
+
+
+def fast_path():
+    movies = row_query(Movie).order_by(Movie.id)
+    return dump_json({'movies': [Movie.format_row(movie) for movie in movies]})
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        db.session.expunge_all()
+        start = time.perf_counter()
+        body = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return body, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.test_request_context('/movies'):
+        ids = Movie.insert_many([{'title': f'Bench Movie {i}', 'release_date': datetime.date(2020, 1, 1)}
+                           for i in range(args.rows)])
+        rows = Movie.query.count()
+
+        try:
+            orm_body, orm_time = timed(orm_path, args.repeat)
+            fast_body, fast_time = timed(fast_path, args.repeat)
+        finally:
+            # through the write path, so tombstones, /stats and the versions follow
+            for id in ids:
+                Movie.delete_by_id(id)
+
+    print(f'orm:  {rows} rows in {orm_time:.3f}s, {rows / orm_time:.0f} rows/sec')
+    print(f'fast: {rows} rows in {fast_time:.3f}s, {rows / fast_time:.0f} rows/sec')
+    print(f'speedup: {orm_time / fast_time:.1f}x, identical output: {orm_body == fast_body}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+'''
+A stand-in for Auth0 for benchmarks: generates an RSA key pair, serves
+its public key as a JWKS over HTTP on localhost and mints tokens for the
+assistant, director and producer roles, signed with the private key.
+
+Point the server at it with environment()
+(JWKS_URL, AUTH0_DOMAIN and API_AUDIENCE).
+'''
+import base64
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from Crypto.PublicKey import RSA
+from jose import jwt
+
+ROLES = {
+    'assistant': ['get:actors', 'get:movies'],
+    'director': ['delete:actors', 'get:actors', 'get:movies', 'patch:actors', 'patch:movies', 'post:actors'],
+    'producer': ['delete:actors', 'delete:movies', 'get:actors', 'get:movies', 'patch:actors', 'patch:movies',
+                 'post:actors', 'post:movies']
+}
+
+
+def b64_int(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+class LocalAuth:
+    def __init__(self, domain='bench.local', audience='bench', kid='bench-key'):
+        self.domain = domain
+        self.audience = audience
+        self.kid = kid
+
+        key = RSA.generate(2048)
+        self.private_key = key.exportKey('PEM').decode()
+        self.jwks = json.dumps({'keys': [{
+            'kty': 'RSA',
+            'kid': kid,
+            'use': 'sig',
+            'alg': 'RS256',
+            'n': b64_int(key.n),
+            'e': b64_int(key.e)
+        }]}).encode()
+
+        self.server = None
+
+    def start(self):
+        jwks = self.jwks
+
+        class JWKSHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(jwks)))
+                self.end_headers()
+                self.wfile.write(jwks)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), JWKSHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    @property
+    def jwks_url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}/.well-known/jwks.json'
+
+    def environment(self):
+        return {
+            'JWKS_URL': self.jwks_url,
+            'AUTH0_DOMAIN': self.domain,
+            'API_AUDIENCE': self.audience
+        }
+
+    def token(self, role, expires_in=24 * 3600):
+        now = int(time.time())
+        claims = {
+            'iss': f'https://{self.domain}/',
+            'sub': f'bench|{role}',
+            'aud': self.audience,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': ROLES[role]
+        }
+        return jwt.encode(claims, self.private_key, algorithm='RS256', headers={'kid': self.kid})
@@ -0,0 +1,213 @@
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import time
+
+from sqlalchemy import create_engine, func
+from sqlalchemy import select as select_query
+from sqlalchemy.pool import NullPool
+
+from metrics import EVENT_CLIENTS
+
+logger = logging.getLogger(__name__)
+
+'''
+Change events
+Every committed insert, update, delete and cast change is published as
+an event and streamed to the clients of /events (Server-Sent Events).
+
+Each worker process holds one EventBroker that fans events out to its
+own clients through a bounded queue per client. With the `postgres`
+backend (the default on Postgres) every write sends its events as NOTIFY
+on the EVENTS_CHANNEL channel in its own transaction, so they are
+delivered when, and only if, it commits. Every worker LISTENs on one
+dedicated connection, so clients see the writes of every worker and dyno
+however many of them are connected. The `memory` backend publishes
+straight to the broker of the process that made the write, after the
+commit.
+
+A client that falls EVENTS_QUEUE_SIZE events behind is disconnected
+rather than buffered without limit; it reconnects and catches up from
+/actors/changes and /movies/changes.
+'''
+
+EVENTS_BACKEND = os.environ.get('EVENTS_BACKEND')
+EVENTS_CHANNEL = os.environ.get('EVENTS_CHANNEL', 'changes')
+EVENTS_QUEUE_SIZE = int(os.environ.get('EVENTS_QUEUE_SIZE', 100))
+EVENTS_MAX_CLIENTS = int(os.environ.get('EVENTS_MAX_CLIENTS', 1000))
+EVENTS_KEEPALIVE = int(os.environ.get('EVENTS_KEEPALIVE', 15))
+
+# the payload of a NOTIFY is limited to 8000 bytes
+NOTIFY_MAX_IDS = 500
+RECONNECT_MS = 1000
+
+EVENT_TYPES = {
+    'insert': 'create',
+    'update': 'update',
+    'delete': 'delete',
+    'link': 'cast',
+    'unlink': 'cast'
+}
+
+
+class Subscription:
+    def __init__(self, collections, size):
+        self.collections = collections
+        self.queue = queue.Queue(size)
+        self.overflowed = False
+
+    def put(self, event):
+        if event['collection'] not in self.collections:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventBroker:
+    def __init__(self, queue_size=EVENTS_QUEUE_SIZE, max_clients=EVENTS_MAX_CLIENTS):
+        self.queue_size = queue_size
+        self.max_clients = max_clients
+        self.subscriptions = set()
+        self.lock = threading.Lock()
+        self.listener = None
+
+    def publish(self, event):
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    def subscribe(self, collections):
+        '''
+        Returns a Subscription to the events of `collections`, or None if
+        the process already serves max_clients.
+        '''
+        if self.listener is not None:
+            self.listener.start()
+        with self.lock:
+            if len(self.subscriptions) >= self.max_clients:
+                return None
+            subscription = Subscription(set(collections), self.queue_size)
+            self.subscriptions.add(subscription)
+        EVENT_CLIENTS.inc()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            if subscription not in self.subscriptions:
+                return
+            self.subscriptions.discard(subscription)
+        EVENT_CLIENTS.dec()
+
+
+class PostgresListener:
+    '''
+    Publishes the notifications of one Postgres channel to a broker, from
+    a background thread holding one connection. Started lazily, so each
+    gunicorn worker gets its own, and reconnects after errors.
+    '''
+
+    def __init__(self, url, channel, broker, retry_interval=1):
+        self.engine = create_engine(url, poolclass=NullPool)
+        self.channel = channel
+        self.broker = broker
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self._listen()
+            except Exception as e:
+                logger.warning('Event listener disconnected: %s', e)
+            time.sleep(self.retry_interval)
+
+    def _listen(self):
+        connection = self.engine.raw_connection()
+        try:
+            dbapi_connection = connection.connection
+            dbapi_connection.autocommit = True
+            dbapi_connection.cursor().execute(f'LISTEN "{self.channel}"')
+            while True:
+                if select.select([dbapi_connection], [], [], EVENTS_KEEPALIVE) == ([], [], []):
+                    continue
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    notification = dbapi_connection.notifies.pop(0)
+                    self.broker.publish(json.loads(notification.payload))
+        finally:
+            connection.close()
+
+
+def make_event(collection, action, ids):
+    return {'collection': collection, 'type': EVENT_TYPES.get(action, action), 'ids': list(ids)}
+
+
+class ChangeEvents:
+    '''
+    The broker of this process, and the mutation listeners that publish
+    to it: stage() sends NOTIFY in the write's transaction with the
+    `postgres` backend, publish() publishes in process after the commit
+    with `memory`.
+    '''
+
+    def __init__(self):
+        self.broker = EventBroker()
+        self.backend = 'memory'
+
+    def init_engine(self, engine, backend=EVENTS_BACKEND):
+        if backend is None:
+            backend = 'postgres' if engine.dialect.name == 'postgresql' else 'memory'
+        self.backend = backend
+        if backend == 'postgres' and self.broker.listener is None:
+            self.broker.listener = PostgresListener(engine.url, EVENTS_CHANNEL, self.broker)
+
+    def stage(self, connection, collection, action, ids):
+        if self.backend != 'postgres':
+            return
+        ids = list(ids)
+        for start in range(0, len(ids), NOTIFY_MAX_IDS):
+            payload = json.dumps(make_event(collection, action, ids[start:start + NOTIFY_MAX_IDS]))
+            connection.execute(select_query([func.pg_notify(EVENTS_CHANNEL, payload)]))
+
+    def publish(self, collection, action, ids):
+        if self.backend != 'postgres':
+            self.broker.publish(make_event(collection, action, list(ids)))
+
+
+def format_event(event):
+    return f'event: {event["type"]}\ndata: {json.dumps(event, sort_keys=True)}\n\n'
+
+
+def stream_events(subscription, keepalive=EVENTS_KEEPALIVE):
+    '''
+    Yields the events of a subscription as Server-Sent Events, with a
+    comment every `keepalive` seconds so proxies keep the connection
+    open (and a gone client is noticed), until the client falls behind.
+    '''
+    yield f'retry: {RECONNECT_MS}\n\n'
+    while not subscription.overflowed:
+        event = subscription.get(keepalive)
+        yield ': keepalive\n\n' if event is None else format_event(event)
+    yield 'event: overflow\ndata: {}\n\n'
@@ -0,0 +1,130 @@
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+'''
+GroupCommit
+Coalesces single-row writes issued concurrently by separate requests
+into one transaction, so a burst of writes waits for one commit (and one
+fsync) instead of one each.
+
+A background thread takes the first queued write, then keeps collecting
+writes for up to `max_wait` seconds or until `max_batch` are queued, and
+runs them all in one transaction. A write is a function of the
+connection returning the written row (or None if no row matched). Every
+write runs in its own savepoint, so a failing write only fails its own
+caller. submit() returns the write's row, or raises its error, only
+after the shared commit has succeeded; if the commit fails every caller
+of the batch gets the error. A caller waits at most `timeout` seconds and
+then gets a TimeoutError, even though its write may still commit.
+
+`bump(connection, collections)` runs in the transaction before the
+writes, with the collections of the whole batch, `stage(connection,
+collection, action, ids)` in the savepoint of every write that matched a
+row, and `notify(collection, action, ids)` after the commit. A failing notify is logged and counted, but doesn't
+fail the write, which has already committed.
+'''
+
+
+class GroupCommit:
+    def __init__(self, engine, bump, notify, stage=None, max_batch=64, max_wait=0.002, timeout=60):
+        self.engine = engine
+        self.bump = bump
+        self.notify = notify
+        self.stage = stage
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.timeout = timeout
+
+        self.batch_sizes = Counter()
+        self.commits = 0
+        self.failed_commits = 0
+        self.failed_notifies = 0
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def submit(self, collection, action, write):
+        future = Future()
+        self._start()
+        self._queue.put((collection, action, write, future))
+        return future.result(timeout=self.timeout)
+
+    def stats(self):
+        return {
+            'commits': self.commits,
+            'failed_commits': self.failed_commits,
+            'failed_notifies': self.failed_notifies,
+            'batch_sizes': dict(sorted(self.batch_sizes.items()))
+        }
+
+    def _start(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive():
+                return
+            self._worker = threading.Thread(target=self._run, daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                deadline = time.monotonic() + self.max_wait
+                while len(batch) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    try:
+                        batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                self._commit(batch)
+            except Exception as e:
+                logger.exception('Group commit failed: %s', e)
+                # never leave a caller waiting, nor let the worker die
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _commit(self, batch):
+        results = []
+        try:
+            with self.engine.begin() as connection:
+                self.bump(connection, sorted({collection for collection, *_ in batch}))
+                for collection, action, write, future in batch:
+                    savepoint = connection.begin_nested()
+                    try:
+                        row = write(connection)
+                        if row is not None and self.stage is not None:
+                            self.stage(connection, collection, action, [row.id])
+                        savepoint.commit()
+                    except Exception as e:
+                        savepoint.rollback()
+                        results.append((collection, action, future, None, e))
+                        continue
+                    results.append((collection, action, future, row, None))
+        except Exception as e:
+            self.failed_commits += 1
+            for *_, future in batch:
+                future.set_exception(e)
+            return
+
+        self.commits += 1
+        self.batch_sizes[len(batch)] += 1
+        for collection, action, future, row, error in results:
+            if error is not None:
+                future.set_exception(error)
+                continue
+            if row is not None:
+                try:
+                    self.notify(collection, action, [row.id])
+                except Exception as e:
+                    self.failed_notifies += 1
+                    logger.exception('Group commit notify failed: %s', e)
+            future.set_result(row)
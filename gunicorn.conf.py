@@ -0,0 +1,48 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+'''
+Gunicorn settings
+Loaded automatically by `gunicorn app:app`.
+
+With the default gevent workers every request runs in a greenlet, so a
+request waiting on Auth0 (fetching the signing keys) or on Postgres
+yields to the other requests of its process instead of blocking it.
+Sockets are patched by the gevent worker, psycopg2 by psycogreen in
+post_fork below. One process then holds up to
+GUNICORN_WORKER_CONNECTIONS requests in flight, limited in practice by
+its database pool (DB_POOL_SIZE + DB_MAX_OVERFLOW).
+
+GUNICORN_WORKER_CLASS=sync restores one request per process.
+
+Every worker writes its Prometheus metrics to prometheus_multiproc_dir,
+which is emptied when the server starts, and /metrics adds them up.
+'''
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 100))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+# must be set before the app (and prometheus_client) is imported
+metrics_dir = os.environ.setdefault('prometheus_multiproc_dir',
+                                    os.path.join(tempfile.gettempdir(), 'prometheus-metrics'))
+
+
+def on_starting(server):
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
@@ -0,0 +1,345 @@
+import csv
+import datetime
+import json
+import re
+import time
+
+from sqlalchemy import Date, text
+
+from models import db, bump_collection_version, commit_mutations, reconcile_stats
+
+'''
+Bulk import
+Loads a CSV or newline delimited JSON file of actors or movies with
+Postgres COPY, for catalogue refreshes too big for the batch routes.
+
+The file is read a row at a time and every row validated with the same
+rules as POST /actors and POST /movies; valid rows are streamed through
+a single COPY ... FROM STDIN into a temporary staging table, so the file
+is never held in memory. From there one transaction:
+
+- gives rows without an id a new one from the table's sequence,
+- upserts the rows into the table by id (the last row wins when an id
+  appears twice), leaving unchanged rows untouched,
+- bumps the collection versions, and stamps the rows it changes with the
+  new version for the changes routes,
+- adds the cast links listed in movie_ids (actors) or actor_ids (movies)
+  to roles, skipping ids that don't exist and links that already do.
+
+Once it commits the changes are notified like the single-row routes
+do, as inserts, updates and new links of both collections. The /stats
+counts are then recounted, as for any load that bypasses the single-row
+write paths.
+'''
+
+FORMATS = ('csv', 'ndjson')
+
+# the cast column of each import, and the table its ids point to
+LINKS = {
+    'actors': ('movie_ids', 'movies', 'actor_id', 'movie_id'),
+    'movies': ('actor_ids', 'actors', 'movie_id', 'actor_id')
+}
+
+LIST_SEPARATOR = re.compile(r'[;,\s]+')
+
+# invalid rows listed in the report; the rest are only counted
+MAX_REPORTED_ERRORS = 20
+
+
+def file_format(path, format=None):
+    if format is None:
+        format = 'csv' if path.lower().endswith('.csv') else 'ndjson'
+    if format not in FORMATS:
+        raise ValueError(f'unknown format {format}, expected one of {", ".join(FORMATS)}')
+    return format
+
+
+def read_records(file, format):
+    '''
+    Yields (line, record) for every row of a CSV file with a header row or
+    of a newline delimited JSON file. Rows that can't be parsed are
+    yielded as None so they can be reported.
+    '''
+    if format == 'csv':
+        reader = csv.DictReader(file)
+        for record in reader:
+            # short rows leave the missing columns None
+            yield reader.line_num, {key: value for key, value in record.items() if value is not None}
+        return
+
+    for line, row in enumerate(file, 1):
+        if not row.strip():
+            continue
+        try:
+            yield line, json.loads(row)
+        except ValueError:
+            yield line, None
+
+
+def parse_id(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value)
+    raise ValueError
+
+
+def parse_ids(value):
+    if isinstance(value, str):
+        value = [id for id in LIST_SEPARATOR.split(value.strip()) if id]
+    if not isinstance(value, list):
+        raise ValueError
+    return [parse_id(id) for id in value]
+
+
+def validate_values(record, fields, date_fields=()):
+    '''
+    Checks the fields of a record and returns (values, error): the values
+    of `fields` in order, with dates parsed, numbers as strings and nulls
+    kept as POST /actors and POST /movies store them, or the reason the
+    record can't be stored. The batch routes check every item with it too.
+    '''
+    if not isinstance(record, dict):
+        return None, 'invalid item'
+
+    for field in fields:
+        if field not in record:
+            return None, f'{field} is required'
+
+    values = [record[field] for field in fields]
+    for index, field in enumerate(fields):
+        if values[index] is None:
+            continue
+        if field in date_fields:
+            try:
+                values[index] = datetime.date.fromisoformat(str(values[index]))
+            except ValueError:
+                return None, f'{field} must be a date (YYYY-MM-DD)'
+        elif isinstance(values[index], (dict, list)):
+            return None, f'{field} must be a string'
+        elif not isinstance(values[index], str):
+            values[index] = str(values[index])
+
+    return values, None
+
+
+def validate(record, fields, link_field, date_fields=()):
+    '''
+    Checks a record like the single item routes do, and returns
+    (row, error): the staging row (id, fields..., links) or the reason it
+    was skipped.
+    '''
+    values, error = validate_values(record, fields, date_fields)
+    if error:
+        return None, error
+
+    id = record.get('id')
+    if id in (None, ''):
+        id = None
+    else:
+        try:
+            id = parse_id(id)
+        except ValueError:
+            return None, 'id must be an integer'
+
+    links = record.get(link_field)
+    if links in (None, ''):
+        links = None
+    else:
+        try:
+            links = parse_ids(links)
+        except ValueError:
+            return None, f'{link_field} must be a list of integers'
+
+    return (id, *values, links), None
+
+
+def copy_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, list):
+        value = '{' + ','.join(str(id) for id in value) + '}'
+    return '"' + value.replace('"', '""') + '"'
+
+
+class CopyStream:
+    '''
+    A file for COPY ... FROM STDIN (FORMAT csv) that formats rows from an
+    iterator only as COPY reads them. Unquoted empty values are NULL,
+    quoted ones empty strings.
+    '''
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.pending = ''
+
+    def read(self, size=-1):
+        chunk = []
+        length = len(self.pending)
+        for row in self.rows:
+            line = ','.join(copy_value(value) for value in row) + '\n'
+            chunk.append(line)
+            length += len(line)
+            if 0 <= size <= length:
+                break
+
+        data = self.pending + ''.join(chunk)
+        if size < 0:
+            self.pending = ''
+            return data
+        self.pending = data[size:]
+        return data[:size]
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+class ImportReport:
+    def __init__(self):
+        self.read = 0
+        self.invalid = 0
+        self.errors = []
+        self.inserted = 0
+        self.updated = 0
+        self.links = 0
+        self.seconds = 0.0
+
+    def skip(self, line, error):
+        self.invalid += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f'line {line}: {error}')
+
+    @property
+    def rows_per_second(self):
+        return self.read / self.seconds if self.seconds else 0.0
+
+    def summary(self):
+        lines = [f'Read {self.read} rows in {self.seconds:.1f}s ({self.rows_per_second:.0f} rows/sec): '
+                 f'{self.inserted} inserted, {self.updated} updated, '
+                 f'{self.read - self.invalid - self.inserted - self.updated} unchanged, '
+                 f'{self.invalid} invalid, {self.links} cast links added']
+        lines.extend(self.errors)
+        if self.invalid > len(self.errors):
+            lines.append(f'... and {self.invalid - len(self.errors)} more invalid rows')
+        return '\n'.join(lines)
+
+
+def valid_rows(records, report, fields, link_field, date_fields):
+    for line, record in records:
+        report.read += 1
+        row, error = validate(record, fields, link_field, date_fields)
+        if error:
+            report.skip(line, error)
+            continue
+        yield (line, *row)
+
+
+def import_records(model, fields, records):
+    '''
+    Imports (line, record) pairs into the table of `model` in the current
+    transaction, and returns an ImportReport and the mutations to notify
+    once it commits.
+    '''
+    connection = db.session.connection()
+    if connection.dialect.name != 'postgresql':
+        raise RuntimeError('bulk import uses COPY and needs Postgres')
+
+    table = model.__table__
+    name = table.name
+    link_field, other_table, column, other_column = LINKS[name]
+    date_fields = [field for field in fields if isinstance(table.c[field].type, Date)]
+
+    report = ImportReport()
+    start = time.perf_counter()
+
+    staging = f'import_{name}'
+    types = ', '.join(f'{field} {table.c[field].type.compile(connection.dialect)}' for field in fields)
+    connection.execute(text(f'CREATE TEMPORARY TABLE {staging} '
+                            f'(line integer, id integer, {types}, links integer[]) ON COMMIT DROP'))
+
+    columns = ', '.join(fields)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(f'COPY {staging} (line, id, {columns}, links) FROM STDIN WITH (FORMAT csv)',
+                       CopyStream(valid_rows(records, report, fields, link_field, date_fields)))
+
+    sequence = connection.execute(text(f"SELECT pg_get_serial_sequence('{name}', 'id')")).scalar()
+    connection.execute(text(f"UPDATE {staging} SET id = nextval('{sequence}') WHERE id IS NULL"))
+
+    bump_collection_version('actors')
+    bump_collection_version('movies')
+
+    updates = ', '.join(f'{field} = excluded.{field}' for field in fields)
+    changed = ' OR '.join(f'{name}.{field} IS DISTINCT FROM excluded.{field}' for field in fields)
+    result = connection.execute(text(f'''
+        INSERT INTO {name} (id, {columns}, updated_at, change_version)
+        SELECT DISTINCT ON (id) id, {columns}, :now, (SELECT version FROM collection_versions WHERE name = :name)
+        FROM {staging} ORDER BY id, line DESC
+        ON CONFLICT (id) DO UPDATE
+        SET {updates}, version = {name}.version + 1, updated_at = excluded.updated_at,
+            change_version = excluded.change_version
+        WHERE {changed}
+        RETURNING id, xmax = 0 AS inserted
+    '''), now=datetime.datetime.utcnow(), name=name)
+    inserted, updated = [], []
+    for row in result:
+        (inserted if row.inserted else updated).append(row.id)
+    report.inserted = len(inserted)
+    report.updated = len(updated)
+
+    # explicit ids may be ahead of the sequence
+    connection.execute(text(f"SELECT setval('{sequence}', greatest((SELECT max(id) FROM {name}), "
+                            f"(SELECT last_value FROM {sequence})))"))
+
+    links = connection.execute(text(f'''
+        INSERT INTO roles ({column}, {other_column})
+        SELECT DISTINCT {staging}.id, link.id
+        FROM {staging} CROSS JOIN LATERAL unnest({staging}.links) AS link(id)
+        JOIN {other_table} ON {other_table}.id = link.id
+        WHERE NOT EXISTS (SELECT 1 FROM roles
+                          WHERE roles.{column} = {staging}.id AND roles.{other_column} = link.id)
+        ON CONFLICT (actor_id, movie_id) DO NOTHING
+        RETURNING {column}, {other_column}
+    ''')).fetchall()
+    report.links = len(links)
+
+    report.seconds = time.perf_counter() - start
+    return report, import_mutations(name, inserted, updated, links)
+
+
+def import_mutations(name, inserted, updated, links):
+    '''
+    The change notifications of an import, like the single-row routes
+    send them: the inserted and the updated rows, and the rows of both
+    collections that were linked by the (id, other id) pairs of `links`.
+    '''
+    other_table = LINKS[name][1]
+    mutations = [(name, 'insert', inserted), (name, 'update', updated),
+                 (name, 'link', sorted({id for id, _ in links})),
+                 (other_table, 'link', sorted({other_id for _, other_id in links}))]
+    return [(collection, action, ids) for collection, action, ids in mutations if ids]
+
+
+def import_file(model, fields, path, format=None):
+    '''
+    Imports a CSV or NDJSON file of actors or movies, commits and returns
+    the ImportReport.
+    '''
+    format = file_format(path, format)
+    start = time.perf_counter()
+
+    with open(path, newline='', encoding='utf-8') as file:
+        try:
+            report, mutations = import_records(model, fields, read_records(file, format))
+            commit_mutations(mutations)
+        except Exception:
+            db.session.rollback()
+            raise
+
+    reconcile_stats(wait=True)
+
+    report.seconds = time.perf_counter() - start
+    return report
@@ -0,0 +1,123 @@
+import json
+import logging
+import threading
+import time
+from urllib.request import urlopen
+
+logger = logging.getLogger(__name__)
+
+'''
+JWKSKeyStore
+Keeps the signing keys of a JWKS endpoint in memory so that verifying a
+token does not need a network round trip.
+
+- keys are fetched and parsed once, then cached for `ttl` seconds
+- once the ttl has passed the stale keys keep being served while a
+  background thread refreshes them
+- an unknown kid triggers a synchronous refetch, at most once every
+  `min_refresh_interval` seconds
+- if the endpoint can't be reached the last good keys are kept
+- `version` is bumped whenever a refresh returns a different key set, so
+  anything derived from the old keys can be dropped
+
+Any url urlopen understands works, so tests can point it at a file:// url
+or a local http server.
+'''
+
+
+class JWKSKeyStore:
+    def __init__(self, url, ttl=600, min_refresh_interval=30, timeout=5):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+
+        self.version = 0
+
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+
+    def fetch(self):
+        with urlopen(self.url, timeout=self.timeout) as response:
+            jwks = json.loads(response.read())
+
+        keys = {}
+        for key in jwks['keys']:
+            if key.get('kty') != 'RSA' or 'kid' not in key:
+                continue
+            keys[key['kid']] = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key.get('use', 'sig'),
+                'n': key['n'],
+                'e': key['e']
+            }
+        return keys
+
+    def refresh(self):
+        with self._lock:
+            self._last_attempt = time.monotonic()
+        return self._load()
+
+    def _load(self):
+        try:
+            keys = self.fetch()
+        except Exception as e:
+            logger.warning('JWKS refresh from %s failed, keeping cached keys: %s', self.url, e)
+            return False
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+        with self._lock:
+            if keys != self._keys:
+                self.version += 1
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+        return True
+
+    def get_key(self, kid):
+        if self._fetched_at is None:
+            self._refresh_if_allowed()
+        elif self._is_stale():
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None:
+            self._refresh_if_allowed()
+            key = self._keys.get(kid)
+        return key
+
+    def current_version(self):
+        if self._fetched_at is not None and self._is_stale():
+            self._refresh_in_background()
+        return self.version
+
+    def _is_stale(self):
+        return time.monotonic() - self._fetched_at >= self.ttl
+
+    def _recently_attempted(self):
+        return self._last_attempt is not None and \
+            time.monotonic() - self._last_attempt < self.min_refresh_interval
+
+    def _refresh_if_allowed(self):
+        # callers arriving during a fetch wait for it and use its keys
+        with self._fetch_lock:
+            with self._lock:
+                if self._recently_attempted():
+                    return False
+                self._last_attempt = time.monotonic()
+            return self._load()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing or self._recently_attempted():
+                return
+            self._refreshing = True
+            self._last_attempt = time.monotonic()
+        thread = threading.Thread(target=self._load, daemon=True)
+        thread.start()
@@ -0,0 +1,161 @@
+import hmac
+import ipaddress
+import os
+import time
+from contextlib import contextmanager
+
+from flask import Response, abort, g, has_request_context, request
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, \
+    generate_latest, multiprocess, REGISTRY
+
+from queries import request_queries
+
+'''
+Metrics
+Prometheus metrics of every request, served at /metrics:
+
+- http_request_duration_seconds, by route, method and status
+- http_request_phase_seconds, the time each request spent in every phase
+  (header, jwks, jwt, permissions, db, serialization) by route
+- http_request_queries, the number of SQL statements of each request
+- http_requests_in_flight
+- http_request_size_bytes and http_response_size_bytes, by route
+- events_clients, the clients connected to /events
+- http_requests_shed_total, requests turned away by admission control, by
+  reason (in_flight or rate_limit)
+- response_cache_lookups_total, by result (hit or miss),
+  response_cache_errors_total, response_cache_evictions_total and
+  response_cache_bytes, the size of the memory backends
+- token_cache_lookups_total, bearer tokens found in the verified token
+  cache or not, by result (hit or miss), and token_cache_evictions_total
+- db_pool_checkout_wait_seconds, the time checkouts waited for a pooled
+  connection, db_pool_timeouts_total, the checkouts that gave up, and
+  db_pool_checked_out and db_pool_capacity (size plus overflow), whose
+  ratio is the saturation of the pools
+- http_requests_coalesced_total, read requests that shared the response
+  of an identical request already in flight instead of querying, by route
+
+Under gunicorn every worker writes its metrics to the directory named by
+prometheus_multiproc_dir (set by gunicorn.conf.py) and /metrics adds up
+all of them, whichever worker serves it.
+
+/metrics answers requests from METRICS_ALLOWED_IPS (addresses or
+networks, loopback only by default) and requests sending METRICS_TOKEN as
+a bearer token, and 403 to anyone else.
+'''
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_ALLOWED_IPS = [ipaddress.ip_network(network.strip())
+                       for network in os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
+                       if network.strip()]
+
+PHASES = ('header', 'jwks', 'jwt', 'permissions', 'db', 'serialization')
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Time spent handling requests',
+                            ['route', 'method', 'status'])
+PHASE_LATENCY = Histogram('http_request_phase_seconds', 'Time requests spent in each phase',
+                          ['route', 'phase'])
+IN_FLIGHT = Gauge('http_requests_in_flight', 'Requests being handled', multiprocess_mode='livesum')
+REQUEST_SIZE = Histogram('http_request_size_bytes', 'Size of request bodies', ['route'], buckets=SIZE_BUCKETS)
+RESPONSE_SIZE = Histogram('http_response_size_bytes', 'Size of response bodies', ['route'], buckets=SIZE_BUCKETS)
+SHED_REQUESTS = Counter('http_requests_shed', 'Requests turned away by admission control', ['reason'])
+COALESCED_REQUESTS = Counter('http_requests_coalesced', 'Requests that shared an identical request in flight',
+                             ['route'])
+RESPONSE_CACHE_LOOKUPS = Counter('response_cache_lookups', 'Response cache lookups', ['result'])
+RESPONSE_CACHE_ERRORS = Counter('response_cache_errors', 'Response cache backend errors')
+RESPONSE_CACHE_EVICTIONS = Counter('response_cache_evictions', 'Responses evicted from the memory cache')
+RESPONSE_CACHE_BYTES = Gauge('response_cache_bytes', 'Size of the cached responses in memory',
+                             multiprocess_mode='livesum')
+TOKEN_CACHE_LOOKUPS = Counter('token_cache_lookups', 'Verified token cache lookups', ['result'])
+TOKEN_CACHE_EVICTIONS = Counter('token_cache_evictions', 'Tokens evicted from the verified token cache')
+DB_POOL_CHECKOUT_WAIT = Histogram('db_pool_checkout_wait_seconds', 'Time checkouts waited for a pooled connection',
+                                  buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30))
+DB_POOL_TIMEOUTS = Counter('db_pool_timeouts', 'Checkouts that gave up waiting for a pooled connection')
+DB_POOL_CHECKED_OUT = Gauge('db_pool_checked_out', 'Pooled connections in use', multiprocess_mode='livesum')
+DB_POOL_CAPACITY = Gauge('db_pool_capacity', 'Connections the pools may open', multiprocess_mode='livesum')
+EVENT_CLIENTS = Gauge('events_clients', 'Clients connected to /events', multiprocess_mode='livesum')
+QUERIES = Histogram('http_request_queries', 'SQL statements issued per request', ['route'],
+                    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+
+
+@contextmanager
+def phase(name):
+    '''
+    Adds the time spent in the block to phase `name` of the current
+    request. Does nothing outside a request.
+    '''
+    if not has_request_context() or 'phases' not in g:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        g.phases[name] += time.perf_counter() - start
+
+
+def route_label():
+    if request.url_rule is None:
+        return 'unmatched'
+    return request.url_rule.rule
+
+
+def metrics_allowed():
+    if METRICS_TOKEN:
+        authorization = request.headers.get('Authorization', '')
+        if hmac.compare_digest(authorization.encode(), f'Bearer {METRICS_TOKEN}'.encode()):
+            return True
+    try:
+        address = ipaddress.ip_address(request.remote_addr)
+    except ValueError:
+        return False
+    return any(address in network for network in METRICS_ALLOWED_IPS)
+
+
+def metrics_registry():
+    if 'prometheus_multiproc_dir' not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def init_metrics(app):
+    @app.before_request
+    def start_request():
+        g.request_start = time.perf_counter()
+        g.phases = dict.fromkeys(PHASES, 0.0)
+        IN_FLIGHT.inc()
+
+    @app.after_request
+    def record_request(response):
+        if 'request_start' not in g:
+            return response
+
+        route = route_label()
+        status = str(response.status_code)
+        REQUEST_LATENCY.labels(route, request.method, status).observe(time.perf_counter() - g.request_start)
+
+        queries = request_queries()
+        QUERIES.labels(route).observe(queries.count)
+        g.phases['db'] = queries.time
+        for name, seconds in g.phases.items():
+            PHASE_LATENCY.labels(route, name).observe(seconds)
+
+        REQUEST_SIZE.labels(route).observe(request.content_length or 0)
+        if response.content_length is not None:
+            RESPONSE_SIZE.labels(route).observe(response.content_length)
+        return response
+
+    @app.teardown_request
+    def finish_request(exception=None):
+        if g.pop('request_start', None) is not None:
+            IN_FLIGHT.dec()
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        if not metrics_allowed():
+            abort(403)
+        return Response(generate_latest(metrics_registry()), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,39 @@
+"""collection and row version stamps
+
+Revision ID: 3b1f5c2d8a47
+Revises: 6efc1a0399e7
+Create Date: 2026-10-18 18:40:12.513402
+
+"""
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b1f5c2d8a47'
+down_revision = '6efc1a0399e7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    collection_versions = op.create_table('collection_versions',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(collection_versions, [
+        {'name': 'actors', 'version': 0, 'updated_at': datetime.datetime.utcnow()},
+        {'name': 'movies', 'version': 0, 'updated_at': datetime.datetime.utcnow()}
+    ])
+    op.add_column('actors', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('movies', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('movies', 'version')
+    op.drop_column('actors', 'version')
+    op.drop_table('collection_versions')
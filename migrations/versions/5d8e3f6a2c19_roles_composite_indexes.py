@@ -0,0 +1,26 @@
+"""composite indexes on roles
+
+Revision ID: 5d8e3f6a2c19
+Revises: 9c4e2a7b1d03
+Create Date: 2026-10-18 19:32:08.774520
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d8e3f6a2c19'
+down_revision = '9c4e2a7b1d03'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_roles_actor_id_movie_id', 'roles', ['actor_id', 'movie_id'], unique=False)
+    op.create_index('ix_roles_movie_id_actor_id', 'roles', ['movie_id', 'actor_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_roles_movie_id_actor_id', table_name='roles')
+    op.drop_index('ix_roles_actor_id_movie_id', table_name='roles')
@@ -0,0 +1,30 @@
+"""cascade deletes from actors and movies to roles
+
+Revision ID: 9c4e2a7b1d03
+Revises: 3b1f5c2d8a47
+Create Date: 2026-10-18 19:05:31.208114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c4e2a7b1d03'
+down_revision = '3b1f5c2d8a47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_constraint('roles_actor_id_fkey', 'roles', type_='foreignkey')
+    op.drop_constraint('roles_movie_id_fkey', 'roles', type_='foreignkey')
+    op.create_foreign_key('roles_actor_id_fkey', 'roles', 'actors', ['actor_id'], ['id'], ondelete='CASCADE')
+    op.create_foreign_key('roles_movie_id_fkey', 'roles', 'movies', ['movie_id'], ['id'], ondelete='CASCADE')
+
+
+def downgrade():
+    op.drop_constraint('roles_movie_id_fkey', 'roles', type_='foreignkey')
+    op.drop_constraint('roles_actor_id_fkey', 'roles', type_='foreignkey')
+    op.create_foreign_key('roles_actor_id_fkey', 'roles', 'actors', ['actor_id'], ['id'])
+    op.create_foreign_key('roles_movie_id_fkey', 'roles', 'movies', ['movie_id'], ['id'])
@@ -0,0 +1,43 @@
+"""updated_at columns and tombstones for the changes routes
+
+Revision ID: a7d3e9f1b2c8
+Revises: f4c1d2e3a5b6
+Create Date: 2026-10-18 22:03:18.640271
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7d3e9f1b2c8'
+down_revision = 'f4c1d2e3a5b6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('actors', sa.Column('updated_at', sa.DateTime(), server_default=sa.text('CURRENT_TIMESTAMP'),
+                                      nullable=False))
+    op.add_column('movies', sa.Column('updated_at', sa.DateTime(), server_default=sa.text('CURRENT_TIMESTAMP'),
+                                      nullable=False))
+    op.create_index('ix_actors_updated_at_id', 'actors', ['updated_at', 'id'], unique=False)
+    op.create_index('ix_movies_updated_at_id', 'movies', ['updated_at', 'id'], unique=False)
+
+    op.create_table('tombstones',
+    sa.Column('collection', sa.String(), nullable=False),
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('deleted_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('collection', 'id')
+    )
+    op.create_index('ix_tombstones_collection_deleted_at_id', 'tombstones', ['collection', 'deleted_at', 'id'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_tombstones_collection_deleted_at_id', table_name='tombstones')
+    op.drop_table('tombstones')
+    op.drop_index('ix_movies_updated_at_id', table_name='movies')
+    op.drop_index('ix_actors_updated_at_id', table_name='actors')
+    op.drop_column('movies', 'updated_at')
+    op.drop_column('actors', 'updated_at')
@@ -0,0 +1,26 @@
+"""server default for collection_versions.updated_at
+
+Revision ID: b5e8c1d4f7a2
+Revises: a7d3e9f1b2c8
+Create Date: 2026-10-19 09:12:44.301587
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5e8c1d4f7a2'
+down_revision = 'a7d3e9f1b2c8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.alter_column('collection_versions', 'updated_at', existing_type=sa.DateTime(), existing_nullable=False,
+                    server_default=sa.text('CURRENT_TIMESTAMP'))
+
+
+def downgrade():
+    op.alter_column('collection_versions', 'updated_at', existing_type=sa.DateTime(), existing_nullable=False,
+                    server_default=None)
@@ -0,0 +1,44 @@
+"""order the changes routes by commit-ordered change versions
+
+Revision ID: c6f2a8d1e4b7
+Revises: b5e8c1d4f7a2
+Create Date: 2026-10-19 10:02:51.774219
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c6f2a8d1e4b7'
+down_revision = 'b5e8c1d4f7a2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('actors', sa.Column('change_version', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('movies', sa.Column('change_version', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('tombstones', sa.Column('change_version', sa.Integer(), server_default='0', nullable=False))
+
+    op.drop_index('ix_actors_updated_at_id', table_name='actors')
+    op.drop_index('ix_movies_updated_at_id', table_name='movies')
+    op.drop_index('ix_tombstones_collection_deleted_at_id', table_name='tombstones')
+    op.create_index('ix_actors_change_version_id', 'actors', ['change_version', 'id'], unique=False)
+    op.create_index('ix_movies_change_version_id', 'movies', ['change_version', 'id'], unique=False)
+    op.create_index('ix_tombstones_collection_change_version_id', 'tombstones',
+                    ['collection', 'change_version', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_tombstones_collection_change_version_id', table_name='tombstones')
+    op.drop_index('ix_movies_change_version_id', table_name='movies')
+    op.drop_index('ix_actors_change_version_id', table_name='actors')
+    op.create_index('ix_tombstones_collection_deleted_at_id', 'tombstones', ['collection', 'deleted_at', 'id'],
+                    unique=False)
+    op.create_index('ix_movies_updated_at_id', 'movies', ['updated_at', 'id'], unique=False)
+    op.create_index('ix_actors_updated_at_id', 'actors', ['updated_at', 'id'], unique=False)
+
+    op.drop_column('tombstones', 'change_version')
+    op.drop_column('movies', 'change_version')
+    op.drop_column('actors', 'change_version')
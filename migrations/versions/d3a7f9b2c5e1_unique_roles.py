@@ -0,0 +1,30 @@
+"""make each actor and movie pair unique in roles
+
+Revision ID: d3a7f9b2c5e1
+Revises: c6f2a8d1e4b7
+Create Date: 2026-10-19 14:21:37.402817
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3a7f9b2c5e1'
+down_revision = 'c6f2a8d1e4b7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # links added twice by concurrent requests; the cast_sizes they inflated
+    # are corrected by the next `flask reconcile-stats`
+    op.execute('DELETE FROM roles a USING roles b '
+               'WHERE a.ctid > b.ctid AND a.actor_id = b.actor_id AND a.movie_id = b.movie_id')
+    op.drop_index('ix_roles_actor_id_movie_id', table_name='roles')
+    op.create_index('ix_roles_actor_id_movie_id', 'roles', ['actor_id', 'movie_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_roles_actor_id_movie_id', table_name='roles')
+    op.create_index('ix_roles_actor_id_movie_id', 'roles', ['actor_id', 'movie_id'], unique=False)
@@ -0,0 +1,44 @@
+"""indexes for filtering, searching and sorting actors and movies
+
+Revision ID: e2a9b7c4f5d6
+Revises: 5d8e3f6a2c19
+Create Date: 2026-10-18 20:04:51.390127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2a9b7c4f5d6'
+down_revision = '5d8e3f6a2c19'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+    op.create_index('ix_actors_name_id', 'actors', ['name', 'id'], unique=False)
+    op.create_index('ix_actors_gender_id', 'actors', ['gender', 'id'], unique=False)
+    op.create_index('ix_actors_name_lower', 'actors', [sa.text('lower(name) text_pattern_ops')], unique=False)
+    op.create_index('ix_actors_name_trgm', 'actors', ['name'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+
+    op.create_index('ix_movies_title_id', 'movies', ['title', 'id'], unique=False)
+    op.create_index('ix_movies_release_date_id', 'movies', ['release_date', 'id'], unique=False)
+    op.create_index('ix_movies_title_lower', 'movies', [sa.text('lower(title) text_pattern_ops')], unique=False)
+    op.create_index('ix_movies_title_trgm', 'movies', ['title'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_movies_title_trgm', table_name='movies')
+    op.drop_index('ix_movies_title_lower', table_name='movies')
+    op.drop_index('ix_movies_release_date_id', table_name='movies')
+    op.drop_index('ix_movies_title_id', table_name='movies')
+
+    op.drop_index('ix_actors_name_trgm', table_name='actors')
+    op.drop_index('ix_actors_name_lower', table_name='actors')
+    op.drop_index('ix_actors_gender_id', table_name='actors')
+    op.drop_index('ix_actors_name_id', table_name='actors')
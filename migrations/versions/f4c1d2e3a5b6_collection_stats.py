@@ -0,0 +1,47 @@
+"""counts served by /stats
+
+Revision ID: f4c1d2e3a5b6
+Revises: e2a9b7c4f5d6
+Create Date: 2026-10-18 21:12:37.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4c1d2e3a5b6'
+down_revision = 'e2a9b7c4f5d6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('collection_stats',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('key', sa.String(), nullable=False),
+    sa.Column('value', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('name', 'key')
+    )
+    op.execute("""
+        INSERT INTO collection_stats (name, key, value)
+        SELECT 'actors_by_gender', coalesce(gender, 'unknown'), count(*)
+        FROM actors GROUP BY gender
+    """)
+    op.execute("""
+        INSERT INTO collection_stats (name, key, value)
+        SELECT 'movies_by_release_year', coalesce(extract(year FROM release_date)::integer::text, 'unknown'), count(*)
+        FROM movies GROUP BY 2
+    """)
+    op.execute("""
+        INSERT INTO collection_stats (name, key, value)
+        SELECT 'cast_sizes', cast_size::text, count(*)
+        FROM (SELECT count(roles.actor_id) AS cast_size
+              FROM movies LEFT OUTER JOIN roles ON roles.movie_id = movies.id
+              GROUP BY movies.id) AS cast_sizes
+        GROUP BY cast_size
+    """)
+
+
+def downgrade():
+    op.drop_table('collection_stats')
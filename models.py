@@ -1,28 +1,636 @@
 import os
+import datetime
+from collections import Counter
 
 from flask_migrate import Migrate
-from sqlalchemy import Column, String, create_engine, Integer, PickleType, Date
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Column, String, create_engine, Integer, PickleType, Date, DateTime, event, select, \
+    literal, exists, and_, func, DDL, cast, extract, text, inspect
+from sqlalchemy import orm
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.elements import TextClause
+from flask import has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 import json
 
+from pool import engine_options
+from replicas import ReplicaSet, replica_urls
+from queries import track_queries
+from group_commit import GroupCommit
+
 database_path = os.environ['DATABASE_URL']
 
-db = SQLAlchemy()
+GROUP_COMMIT = os.environ.get('GROUP_COMMIT', 'false').lower() in ('1', 'true', 'yes', 'on')
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get('GROUP_COMMIT_MAX_BATCH', 64))
+GROUP_COMMIT_MAX_WAIT_MS = float(os.environ.get('GROUP_COMMIT_MAX_WAIT_MS', 2))
+GROUP_COMMIT_TIMEOUT = float(os.environ.get('GROUP_COMMIT_TIMEOUT', 60))
+TOMBSTONE_RETENTION_DAYS = int(os.environ.get('TOMBSTONE_RETENTION_DAYS', 30))
+
+
+'''
+RoutingSession
+Sends the reads of GET and HEAD requests to a read replica when
+DATABASE_REPLICA_URLS is set. One replica is picked per session, so every
+query of a request (including the version stamps its ETag and cache key
+are built from) sees the same snapshot. Writes, flushes, raw SQL and any
+read after a write in the same session go to the primary, as does
+everything outside a request (CLI commands, migrations).
+'''
+READ_METHODS = ('GET', 'HEAD')
+
+
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        self.replicas = getattr(db, 'replicas', None)
+        self.reset_routing()
+
+    def reset_routing(self, current_request=None):
+        self.routed_request = current_request
+        self.replica = None
+        self.wrote = False
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self.replicas or not self.replicas.engines or not has_request_context():
+            return super().get_bind(mapper, clause)
+
+        # the session outlives a request when an app context is shared
+        current_request = request._get_current_object()
+        if self.routed_request is not current_request:
+            self.reset_routing(current_request)
+
+        if self.use_primary(clause):
+            self.wrote = self.wrote or self._flushing or isinstance(clause, UpdateBase)
+            return super().get_bind(mapper, clause)
 
-def setup_db(app, database_path=database_path):
+        if self.replica is None:
+            self.replica = self.replicas.choose()
+            if self.replica is None:
+                return super().get_bind(mapper, clause)
+        return self.replica
+
+    def pin_primary(self):
+        '''
+        Sends the remaining queries of the current request to the primary,
+        for reads that must not miss a write a replica hasn't replayed yet.
+        '''
+        if has_request_context():
+            self.reset_routing(request._get_current_object())
+            self.wrote = True
+
+    def use_primary(self, clause):
+        return (self.wrote or self._flushing or request.method not in READ_METHODS
+                or clause is None or isinstance(clause, (UpdateBase, TextClause))
+                or (self.replica is not None and self.replica not in self.replicas.healthy))
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    replicas = None
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+migrate = Migrate()
+
+def setup_db(app, database_path=database_path, replica_paths=None):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     db.app = app
     db.init_app(app)
+    migrate.init_app(app, db)
+    if replica_paths is None:
+        replica_paths = replica_urls()
+    db.replicas = ReplicaSet(replica_paths, engine_options) if replica_paths else None
+    track_queries()
+
+    global group_commit
+    if GROUP_COMMIT:
+        with app.app_context():
+            group_commit = GroupCommit(db.engine, bump_collection_versions, notify_mutation,
+                                       stage=stage_mutation, max_batch=GROUP_COMMIT_MAX_BATCH,
+                                       max_wait=GROUP_COMMIT_MAX_WAIT_MS / 1000, timeout=GROUP_COMMIT_TIMEOUT)
     #db.create_all()
 
 
+# substring search on actors.name and movies.title uses trigram indexes
+event.listen(db.metadata, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+
+
+'''
+collection_versions
+One row per collection holding a version stamp and the time it last
+changed. The stamp is bumped in the same transaction as every insert,
+update and delete, so conditional GETs can be answered from this single
+row without loading the collection.
+
+Writes bump it before changing any row and stamp the rows they write (and
+the tombstones of rows they delete) with the new version in
+change_version. The bumped row stays locked until the write commits, so
+versions commit in order: once a version is visible, every change stamped
+with it or an older one is too.
+'''
+collection_versions = db.Table('collection_versions',
+                               db.Column('name', db.String, primary_key=True),
+                               db.Column('version', db.Integer, nullable=False, default=0),
+                               db.Column('updated_at', db.DateTime, nullable=False, default=datetime.datetime.utcnow,
+                                         server_default=db.text('CURRENT_TIMESTAMP')),
+                               )
+
+
+@event.listens_for(collection_versions, 'after_create')
+def seed_collection_versions(target, connection, **kw):
+    connection.execute(target.insert(), [
+        {'name': 'actors', 'version': 0, 'updated_at': datetime.datetime.utcnow()},
+        {'name': 'movies', 'version': 0, 'updated_at': datetime.datetime.utcnow()}
+    ])
+
+
+def collection_version_bump(name):
+    return collection_versions.update() \
+        .where(collection_versions.c.name == name) \
+        .values(version=collection_versions.c.version + 1,
+                updated_at=datetime.datetime.utcnow())
+
+
+def current_version(name):
+    return select([collection_versions.c.version]).where(collection_versions.c.name == name).as_scalar()
+
+
+def bump_collection_version(name):
+    db.session.execute(collection_version_bump(name))
+
+
+def bump_collection_versions(connection, names):
+    for name in names:
+        connection.execute(collection_version_bump(name))
+
+
+'''
+Mutation listeners
+Functions registered with on_mutation are called after every committed
+insert, update, delete or cast change as listener(collection, action, ids).
+Functions registered with on_staged_mutation are called in the write's
+transaction just before it commits, as listener(connection, collection,
+action, ids), for work that must commit or roll back with the write.
+'''
+mutation_listeners = []
+staged_mutation_listeners = []
+
+
+def on_mutation(listener):
+    mutation_listeners.append(listener)
+    return listener
+
+
+def on_staged_mutation(listener):
+    staged_mutation_listeners.append(listener)
+    return listener
+
+
+def notify_mutation(collection, action, ids):
+    for listener in mutation_listeners:
+        listener(collection, action, ids)
+
+
+def stage_mutation(connection, collection, action, ids):
+    for listener in staged_mutation_listeners:
+        listener(connection, collection, action, ids)
+
+
+def commit_mutations(mutations):
+    '''
+    Stages a list of (collection, action, ids) in the session's
+    transaction, commits it and notifies the listeners.
+    '''
+    connection = db.session.connection()
+    for mutation in mutations:
+        stage_mutation(connection, *mutation)
+    db.session.commit()
+    for mutation in mutations:
+        notify_mutation(*mutation)
+
+
+'''
+tombstones
+One row per deleted actor or movie, written in the transaction of the
+delete, so /actors/changes and /movies/changes can report deletes.
+Tombstones older than TOMBSTONE_RETENTION_DAYS are removed by
+prune_tombstones(); clients that last synced before then start over.
+'''
+tombstones = db.Table('tombstones',
+                      db.Column('collection', db.String, primary_key=True),
+                      db.Column('id', db.Integer, primary_key=True),
+                      db.Column('deleted_at', db.DateTime, nullable=False, default=datetime.datetime.utcnow),
+                      db.Column('change_version', db.Integer, nullable=False, server_default='0'),
+                      db.Index('ix_tombstones_collection_change_version_id', 'collection', 'change_version', 'id'),
+                      )
+
+
+def add_tombstone(connection, collection, id):
+    '''
+    Records the delete of a row. An id the importer re-created may already
+    have a tombstone; it is moved to this delete.
+    '''
+    table = tombstones
+    values = {'deleted_at': datetime.datetime.utcnow(), 'change_version': current_version(collection)}
+    if connection.dialect.name == 'postgresql':
+        statement = postgresql.insert(table).values(collection=collection, id=id, **values)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[table.c.collection, table.c.id],
+            set_={'deleted_at': statement.excluded.deleted_at, 'change_version': statement.excluded.change_version}))
+        return
+
+    updated = connection.execute(
+        table.update().where(and_(table.c.collection == collection, table.c.id == id)).values(**values)
+    ).rowcount
+    if not updated:
+        connection.execute(table.insert().values(collection=collection, id=id, **values))
+
+
+def tombstone_horizon():
+    return datetime.datetime.utcnow() - datetime.timedelta(days=TOMBSTONE_RETENTION_DAYS)
+
+
+def prune_tombstones():
+    '''
+    Deletes the tombstones older than TOMBSTONE_RETENTION_DAYS and returns
+    how many were deleted.
+    '''
+    result = db.session.execute(tombstones.delete().where(tombstones.c.deleted_at < tombstone_horizon()))
+    db.session.commit()
+    return result.rowcount
+
+
+def get_collection_version(name):
+    row = db.session.execute(
+        select([collection_versions.c.version, collection_versions.c.updated_at])
+        .where(collection_versions.c.name == name)
+    ).first()
+    if row is None:
+        return 0, None
+    return row.version, row.updated_at
+
+
+BULK_INSERT_CHUNK_SIZE = 1000
+
+
+def bulk_insert(model, rows):
+    '''
+    Inserts a list of column dicts in a single transaction and returns the
+    new ids in the same order as the rows. On Postgres every chunk takes
+    its ids from the table's sequence first and is inserted with them in
+    one multi-row INSERT, so no id has to be matched to its row by the
+    order RETURNING happens to give; elsewhere the rows are inserted one
+    at a time.
+    '''
+    table = model.__table__
+    ids = []
+    bump_collection_version(model.__tablename__)
+    connection = db.session.connection()
+    for start in range(0, len(rows), BULK_INSERT_CHUNK_SIZE):
+        chunk = rows[start:start + BULK_INSERT_CHUNK_SIZE]
+        if connection.dialect.name == 'postgresql':
+            chunk_ids = allocate_ids(connection, table, len(chunk))
+            db.session.execute(table.insert().values([dict(row, id=id) for row, id in zip(chunk, chunk_ids)]))
+        else:
+            chunk_ids = [db.session.execute(table.insert().values(row)).inserted_primary_key[0] for row in chunk]
+        update_stats(connection, Counter(), count_stats(connection, **{stats_ids(model): chunk_ids}))
+        ids.extend(chunk_ids)
+
+    commit_mutations([(model.__tablename__, 'insert', ids)])
+    return ids
+
+
+def allocate_ids(connection, table, count):
+    '''
+    Takes `count` new ids from the sequence of `table`'s id column, in
+    ascending order.
+    '''
+    return [row.id for row in connection.execute(
+        text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) AS id "
+             "FROM generate_series(1, :count) ORDER BY id"),
+        table=table.name, count=count
+    )]
+
+
+'''
+Group commit
+With GROUP_COMMIT=true the single-row writes below are sent to a
+GroupCommit, which commits the writes of concurrent requests together
+(see group_commit.py), instead of each committing on its own.
+'''
+group_commit = None
+
+
+def run_write(model, action, write):
+    '''
+    Bumps the collection version and runs a single-row write, a function
+    of the connection returning the written row or None if no row
+    matched, then commits, or rolls back if no row matched. Returns the
+    row.
+    '''
+    collection = model.__tablename__
+    if group_commit is not None:
+        return group_commit.submit(collection, action, write)
+
+    bump_collection_version(collection)
+    row = write(db.session.connection())
+    if row is None:
+        db.session.rollback()
+        return row
+    commit_mutations([(collection, action, [row.id])])
+    return row
+
+
+def insert_returning(model, values):
+    '''
+    Inserts a row with a single INSERT ... RETURNING statement and returns
+    it.
+    '''
+    table = model.__table__
+
+    def write(connection):
+        row = connection.execute(table.insert().values(**values).returning(*table.c)).first()
+        update_stats(connection, Counter(), count_stats(connection, **{stats_ids(model): [row.id]}))
+        return row
+
+    return run_write(model, 'insert', write)
+
+
+def update_returning(model, id, values, version=None):
+    '''
+    Updates a row with a single UPDATE ... RETURNING statement and bumps
+    its version. If `version` is given the row is only updated if it is
+    still at that version. Returns the updated row, or None if no row
+    matched.
+    '''
+    table = model.__table__
+    statement = table.update() \
+        .where(table.c.id == id) \
+        .values(version=table.c.version + 1, **values)
+    if version is not None:
+        statement = statement.where(table.c.version == version)
+
+    def write(connection):
+        ids = {stats_ids(model): [id]}
+        before = count_stats(connection, **ids)
+        row = connection.execute(statement.returning(*table.c)).first()
+        if row is not None:
+            update_stats(connection, before, count_stats(connection, **ids))
+        return row
+
+    return run_write(model, 'update', write)
+
+
+def delete_returning(model, id, version=None):
+    '''
+    Deletes a row with a single DELETE ... RETURNING statement. Returns
+    the deleted id, or None if no row matched.
+    '''
+    table = model.__table__
+    statement = table.delete().where(table.c.id == id)
+    if version is not None:
+        statement = statement.where(table.c.version == version)
+
+    def write(connection):
+        ids = affected_by_delete(connection, model, id)
+        before = count_stats(connection, **ids)
+        row = connection.execute(statement.returning(table.c.id)).first()
+        if row is not None:
+            update_stats(connection, before, count_stats(connection, **ids))
+            add_tombstone(connection, model.__tablename__, row.id)
+        return row
+
+    row = run_write(model, 'delete', write)
+    return row.id if row is not None else None
+
+
 roles = db.Table('roles',
-                 db.Column('actor_id', db.Integer, db.ForeignKey('actors.id')),
-                 db.Column('movie_id', db.Integer, db.ForeignKey('movies.id')),
+                 db.Column('actor_id', db.Integer, db.ForeignKey('actors.id', ondelete='CASCADE')),
+                 db.Column('movie_id', db.Integer, db.ForeignKey('movies.id', ondelete='CASCADE')),
+                 db.Index('ix_roles_actor_id_movie_id', 'actor_id', 'movie_id', unique=True),
+                 db.Index('ix_roles_movie_id_actor_id', 'movie_id', 'actor_id'),
                  )
 
 
+def link_roles(column, id, other_model, other_column, other_ids):
+    '''
+    Links a row to many rows of the other model with a single
+    INSERT INTO roles ... SELECT statement. Ids that don't exist or are
+    already linked are skipped; on Postgres the unique index on roles
+    settles a link being added by two requests at once. Returns the
+    number of new links.
+    '''
+    bump_collection_version('actors')
+    bump_collection_version('movies')
+
+    select_new = select([literal(id, Integer), other_model.id]) \
+        .where(other_model.id.in_(other_ids)) \
+        .where(~exists().where(and_(column == id, other_column == other_model.id)))
+
+    connection = db.session.connection()
+    if connection.dialect.name == 'postgresql':
+        statement = postgresql.insert(roles).from_select([column.name, other_column.name], select_new) \
+            .on_conflict_do_nothing(index_elements=['actor_id', 'movie_id'])
+    else:
+        statement = roles.insert().from_select([column.name, other_column.name], select_new)
+
+    movie_ids = cast_movie_ids(column, id, other_ids)
+    before = count_stats(connection, movie_ids=movie_ids)
+    result = db.session.execute(statement)
+    update_stats(connection, before, count_stats(connection, movie_ids=movie_ids))
+    commit_mutations(cast_mutations(column, id, other_ids, 'link'))
+    return result.rowcount
+
+
+def unlink_roles(column, id, other_column, other_ids):
+    '''
+    Removes the links between a row and many rows of the other model with
+    a single DELETE statement. Returns the number of removed links.
+    '''
+    bump_collection_version('actors')
+    bump_collection_version('movies')
+
+    connection = db.session.connection()
+    movie_ids = cast_movie_ids(column, id, other_ids)
+    before = count_stats(connection, movie_ids=movie_ids)
+    result = db.session.execute(
+        roles.delete().where(column == id).where(other_column.in_(other_ids))
+    )
+    update_stats(connection, before, count_stats(connection, movie_ids=movie_ids))
+    commit_mutations(cast_mutations(column, id, other_ids, 'unlink'))
+    return result.rowcount
+
+
+def cast_movie_ids(column, id, other_ids):
+    return other_ids if column is roles.c.actor_id else [id]
+
+
+def cast_mutations(column, id, other_ids, action):
+    if column is roles.c.actor_id:
+        return [('actors', action, [id]), ('movies', action, other_ids)]
+    return [('movies', action, [id]), ('actors', action, other_ids)]
+
+
+'''
+collection_stats
+The counts served by /stats, one row per (name, key): actors per gender,
+movies per release year and movies per cast size (number of actors).
+Every write counts the stats of the rows it touches before and after the
+change, in its own transaction, and adds the difference, so the counts
+are never rebuilt from a full scan. reconcile_stats() recounts everything
+and corrects any drift, e.g. from two concurrent cast changes of a movie;
+it runs from `flask reconcile-stats` (e.g. on Heroku Scheduler), never in
+the web processes, as it holds up every write while it recounts.
+'''
+collection_stats = db.Table('collection_stats',
+                            db.Column('name', db.String, primary_key=True),
+                            db.Column('key', db.String, primary_key=True),
+                            db.Column('value', db.Integer, nullable=False, default=0),
+                            )
+
+STATS = ('actors_by_gender', 'movies_by_release_year', 'cast_sizes')
+
+# the advisory lock that keeps reconciliations from running at once
+STATS_RECONCILE_LOCK = 5461737
+
+
+def stats_key(value):
+    return 'unknown' if value is None else str(value)
+
+
+def stats_ids(model):
+    return 'actor_ids' if model.__tablename__ == 'actors' else 'movie_ids'
+
+
+def affected_by_delete(connection, model, id):
+    # deleting an actor changes the cast size of each of their movies
+    if model.__tablename__ == 'movies':
+        return {'movie_ids': [id]}
+    movie_ids = [row.movie_id for row in connection.execute(
+        select([roles.c.movie_id]).where(roles.c.actor_id == id))]
+    return {'actor_ids': [id], 'movie_ids': movie_ids}
+
+
+def count_stats(connection, actor_ids=(), movie_ids=()):
+    '''
+    Counts the stats of the given actors and movies, or of every row when
+    the ids are None, as a Counter of (name, key).
+    '''
+    counts = Counter()
+    actors = Actor.__table__
+    movies = Movie.__table__
+
+    if actor_ids is None or actor_ids:
+        query = select([actors.c.gender, func.count()]).group_by(actors.c.gender)
+        if actor_ids is not None:
+            query = query.where(actors.c.id.in_(actor_ids))
+        for gender, count in connection.execute(query):
+            counts['actors_by_gender', stats_key(gender)] += count
+
+    if movie_ids is None or movie_ids:
+        per_movie = select([cast(extract('year', movies.c.release_date), Integer).label('year'),
+                            func.count(roles.c.actor_id).label('cast_size')]) \
+            .select_from(movies.outerjoin(roles, roles.c.movie_id == movies.c.id)) \
+            .group_by(movies.c.id, movies.c.release_date)
+        if movie_ids is not None:
+            per_movie = per_movie.where(movies.c.id.in_(movie_ids))
+        per_movie = per_movie.alias()
+        query = select([per_movie.c.year, per_movie.c.cast_size, func.count()]) \
+            .group_by(per_movie.c.year, per_movie.c.cast_size)
+        for year, cast_size, count in connection.execute(query):
+            counts['movies_by_release_year', stats_key(year)] += count
+            counts['cast_sizes', stats_key(cast_size)] += count
+
+    return counts
+
+
+def update_stats(connection, before, after):
+    '''
+    Adds the difference between two count_stats() results to the stored
+    counts, in key order so concurrent writes lock rows in the same order.
+    '''
+    changes = after.copy()
+    changes.subtract(before)
+    for (name, key), delta in sorted(changes.items()):
+        if delta:
+            add_stat(connection, name, key, delta)
+
+
+def add_stat(connection, name, key, delta):
+    table = collection_stats
+    if connection.dialect.name == 'postgresql':
+        statement = postgresql.insert(table).values(name=name, key=key, value=delta)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[table.c.name, table.c.key],
+            set_={'value': table.c.value + statement.excluded.value}))
+        return
+
+    updated = connection.execute(
+        table.update().where(and_(table.c.name == name, table.c.key == key)).values(value=table.c.value + delta)
+    ).rowcount
+    if not updated:
+        connection.execute(table.insert().values(name=name, key=key, value=delta))
+
+
+def flush_with_stats(row, delete=False):
+    '''
+    Flushes the pending change of an actor or movie and adds its stats
+    change to the counts.
+    '''
+    model = type(row)
+    connection = db.session.connection()
+    # the identity doesn't load expired attributes, which would autoflush the change
+    identity = inspect(row).identity
+    if identity is None:
+        db.session.flush()
+        ids = {stats_ids(model): [row.id]}
+        before = Counter()
+    else:
+        id = identity[0]
+        ids = affected_by_delete(connection, model, id) if delete else {stats_ids(model): [id]}
+        before = count_stats(connection, **ids)
+        db.session.flush()
+    update_stats(connection, before, count_stats(connection, **ids))
+
+
+def get_stats():
+    stats = {name: {} for name in STATS}
+    for row in db.session.execute(select([collection_stats]).where(collection_stats.c.value != 0)):
+        stats.setdefault(row.name, {})[row.key] = row.value
+    return stats
+
+
+def reconcile_stats(wait=False):
+    '''
+    Recounts every stat with a full scan, corrects the stored counts and
+    returns the corrections as {(name, key): difference}. Returns None
+    without recounting if another process is reconciling, unless `wait`.
+    '''
+    connection = db.session.connection()
+    if connection.dialect.name == 'postgresql':
+        if wait:
+            connection.execute(select([func.pg_advisory_xact_lock(STATS_RECONCILE_LOCK)]))
+        elif not connection.execute(select([func.pg_try_advisory_xact_lock(STATS_RECONCILE_LOCK)])).scalar():
+            db.session.rollback()
+            return None
+        # waits for the writes in flight and holds new ones until the commit, so none is lost
+        connection.execute(text('LOCK TABLE collection_stats IN EXCLUSIVE MODE'))
+
+    stored = Counter({(row.name, row.key): row.value for row in connection.execute(select([collection_stats]))})
+    actual = count_stats(connection, None, None)
+    update_stats(connection, stored, actual)
+    db.session.commit()
+
+    drift = actual.copy()
+    drift.subtract(stored)
+    return {stat: delta for stat, delta in drift.items() if delta}
+
+
 class Actor(db.Model):
     __tablename__ = 'actors'
 
@@ -30,9 +638,15 @@ class Actor(db.Model):
     name = Column(String)
     age = Column(String)
     gender = Column(String)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    updated_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow,
+                        onupdate=datetime.datetime.utcnow, server_default=db.text('CURRENT_TIMESTAMP'))
+    change_version = Column(Integer, nullable=False, default=current_version('actors'),
+                            onupdate=current_version('actors'), server_default='0')
     movies = db.relationship('Movie',
                              secondary=roles,
-                             backref=db.backref('movies')
+                             order_by='Movie.id',
+                             backref=db.backref('actors', order_by='Actor.id')
                              )
 
     def __init__(self, name, age, gender):
@@ -41,22 +655,68 @@ class Actor(db.Model):
         self.gender = gender
 
     def insert(self):
+        bump_collection_version(self.__tablename__)
         db.session.add(self)
-        db.session.commit()
+        flush_with_stats(self)
+        commit_mutations([(self.__tablename__, 'insert', [self.id])])
 
     def update(self):
-        db.session.commit()
+        bump_collection_version(self.__tablename__)
+        self.version += 1
+        flush_with_stats(self)
+        commit_mutations([(self.__tablename__, 'update', [self.id])])
 
     def delete(self):
+        bump_collection_version(self.__tablename__)
         db.session.delete(self)
-        db.session.commit()
+        flush_with_stats(self, delete=True)
+        add_tombstone(db.session.connection(), self.__tablename__, self.id)
+        commit_mutations([(self.__tablename__, 'delete', [self.id])])
+
+    @classmethod
+    def insert_one(cls, values):
+        if group_commit is not None:
+            return insert_returning(cls, values)
+        row = cls(**values)
+        row.insert()
+        return row
+
+    @classmethod
+    def insert_many(cls, rows):
+        return bulk_insert(cls, rows)
+
+    @classmethod
+    def update_by_id(cls, id, values, version=None):
+        return update_returning(cls, id, values, version)
+
+    @classmethod
+    def delete_by_id(cls, id, version=None):
+        return delete_returning(cls, id, version)
+
+    @classmethod
+    def link_movies(cls, id, movie_ids):
+        return link_roles(roles.c.actor_id, id, Movie, roles.c.movie_id, movie_ids)
+
+    @classmethod
+    def unlink_movies(cls, id, movie_ids):
+        return unlink_roles(roles.c.actor_id, id, roles.c.movie_id, movie_ids)
+
+    @classmethod
+    def get_version(cls, id):
+        return db.session.execute(
+            select([cls.version]).where(cls.id == id)
+        ).scalar()
 
     def format(self):
+        return Actor.format_row(self)
+
+    @staticmethod
+    def format_row(row):
         return {
-            'id': self.id,
-            'name': self.name,
-            'age': self.age,
-            'gender': self.gender
+            'id': row.id,
+            'name': row.name,
+            'age': row.age,
+            'gender': row.gender
         }
 
 
@@ -66,25 +726,102 @@ class Movie(db.Model):
     id = Column(Integer, primary_key=True)
     title = Column(String)
     release_date = Column(Date)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    updated_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow,
+                        onupdate=datetime.datetime.utcnow, server_default=db.text('CURRENT_TIMESTAMP'))
+    change_version = Column(Integer, nullable=False, default=current_version('movies'),
+                            onupdate=current_version('movies'), server_default='0')
 
     def __init__(self, title, release_date):
         self.title = title
         self.release_date = release_date
 
     def insert(self):
+        bump_collection_version(self.__tablename__)
         db.session.add(self)
-        db.session.commit()
+        flush_with_stats(self)
+        commit_mutations([(self.__tablename__, 'insert', [self.id])])
 
     def update(self):
-        db.session.commit()
+        bump_collection_version(self.__tablename__)
+        self.version += 1
+        flush_with_stats(self)
+        commit_mutations([(self.__tablename__, 'update', [self.id])])
 
     def delete(self):
+        bump_collection_version(self.__tablename__)
         db.session.delete(self)
-        db.session.commit()
+        flush_with_stats(self, delete=True)
+        add_tombstone(db.session.connection(), self.__tablename__, self.id)
+        commit_mutations([(self.__tablename__, 'delete', [self.id])])
+
+    @classmethod
+    def insert_one(cls, values):
+        if group_commit is not None:
+            return insert_returning(cls, values)
+        row = cls(**values)
+        row.insert()
+        return row
+
+    @classmethod
+    def insert_many(cls, rows):
+        return bulk_insert(cls, rows)
+
+    @classmethod
+    def update_by_id(cls, id, values, version=None):
+        return update_returning(cls, id, values, version)
+
+    @classmethod
+    def delete_by_id(cls, id, version=None):
+        return delete_returning(cls, id, version)
+
+    @classmethod
+    def link_actors(cls, id, actor_ids):
+        return link_roles(roles.c.movie_id, id, Actor, roles.c.actor_id, actor_ids)
+
+    @classmethod
+    def unlink_actors(cls, id, actor_ids):
+        return unlink_roles(roles.c.movie_id, id, roles.c.actor_id, actor_ids)
+
+    @classmethod
+    def get_version(cls, id):
+        return db.session.execute(
+            select([cls.version]).where(cls.id == id)
+        ).scalar()
 
     def format(self):
+        return Movie.format_row(self)
+
+    @staticmethod
+    def format_row(row):
         return {
-            'id': self.id,
-            'title': self.title,
-            'release_date': self.release_date
+            'id': row.id,
+            'title': row.title,
+            'release_date': row.release_date
         }
+
+
+'''
+Search indexes
+Every filter and sort order the list routes accept is backed by one of
+these. On Postgres substring search uses pg_trgm GIN indexes and prefix
+search a lower(column) text_pattern_ops index; keyset pages sorted by a
+column use (column, id).
+'''
+db.Index('ix_actors_name_id', Actor.name, Actor.id)
+db.Index('ix_actors_gender_id', Actor.gender, Actor.id)
+db.Index('ix_actors_name_lower', func.lower(Actor.name).label('name_lower'),
+         postgresql_ops={'name_lower': 'text_pattern_ops'})
+db.Index('ix_actors_name_trgm', Actor.name,
+         postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+
+db.Index('ix_movies_title_id', Movie.title, Movie.id)
+db.Index('ix_movies_release_date_id', Movie.release_date, Movie.id)
+db.Index('ix_movies_title_lower', func.lower(Movie.title).label('title_lower'),
+         postgresql_ops={'title_lower': 'text_pattern_ops'})
+db.Index('ix_movies_title_trgm', Movie.title,
+         postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'})
+
+# the changes routes read (change_version, id) ranges
+db.Index('ix_actors_change_version_id', Actor.change_version, Actor.id)
+db.Index('ix_movies_change_version_id', Movie.change_version, Movie.id)
@@ -0,0 +1,150 @@
+import os
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool, NullPool
+from sqlalchemy.exc import TimeoutError
+
+from metrics import DB_POOL_CHECKOUT_WAIT, DB_POOL_TIMEOUTS, DB_POOL_CHECKED_OUT, DB_POOL_CAPACITY
+
+'''
+Connection pool configuration
+Builds the SQLAlchemy engine options for setup_db from the environment:
+
+- DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE and
+  DB_POOL_PRE_PING tune the pool of every worker process
+- DB_CONNECT_TIMEOUT limits how long opening a connection may take
+- DB_STATEMENT_TIMEOUT (milliseconds, 0 disables it) cancels runaway
+  queries on the server
+- PGBOUNCER=true makes the settings safe for PgBouncer in transaction
+  pooling mode: no startup parameters and no session state, the
+  statement timeout is set per transaction with SET LOCAL instead, and
+  with DB_POOL_SIZE=0 pooling is left to PgBouncer entirely
+
+The pool records how long checkouts wait and how full it is, in
+PoolMetrics and in the db_pool_* metrics served at /metrics.
+'''
+
+
+def env_flag(name, default):
+    return os.environ.get(name, default).lower() in ('1', 'true', 'yes', 'on')
+
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = env_flag('DB_POOL_PRE_PING', 'true')
+DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', 10))
+DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 30000))
+PGBOUNCER = env_flag('PGBOUNCER', 'false')
+
+
+class PoolMetrics:
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, wait, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+        DB_POOL_CHECKOUT_WAIT.observe(wait)
+        if timed_out:
+            DB_POOL_TIMEOUTS.inc()
+
+
+class TimedQueuePool(QueuePool):
+    '''
+    A QueuePool that records how long every checkout waited for a
+    connection, and how many gave up after DB_POOL_TIMEOUT.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+        DB_POOL_CAPACITY.inc(self.capacity())
+
+    def capacity(self):
+        return self.size() + max(self._max_overflow, 0)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        DB_POOL_CAPACITY.dec(self.capacity())
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except TimeoutError:
+            self.metrics.record(time.perf_counter() - start, timed_out=True)
+            raise
+        self.metrics.record(time.perf_counter() - start)
+        DB_POOL_CHECKED_OUT.inc()
+        return connection
+
+    def _do_return_conn(self, connection):
+        DB_POOL_CHECKED_OUT.dec()
+        super()._do_return_conn(connection)
+
+    def stats(self):
+        capacity = self.capacity()
+        checked_out = self.checkedout()
+        return {
+            'size': self.size(),
+            'max_overflow': self._max_overflow,
+            'checked_out': checked_out,
+            'overflow': self.overflow(),
+            'saturation': checked_out / capacity if capacity else 0.0,
+            'checkouts': self.metrics.checkouts,
+            'timeouts': self.metrics.timeouts,
+            'checkout_wait_total': self.metrics.wait_total,
+            'checkout_wait_max': self.metrics.wait_max
+        }
+
+
+def engine_options(database_uri):
+    if not database_uri.startswith('postgres'):
+        return {}
+
+    connect_args = {'connect_timeout': DB_CONNECT_TIMEOUT}
+    if DB_STATEMENT_TIMEOUT and not PGBOUNCER:
+        connect_args['options'] = f'-c statement_timeout={DB_STATEMENT_TIMEOUT}'
+
+    options = {
+        'connect_args': connect_args,
+        'pool_pre_ping': DB_POOL_PRE_PING
+    }
+
+    if PGBOUNCER and DB_POOL_SIZE == 0:
+        options['poolclass'] = NullPool
+    else:
+        options.update({
+            'poolclass': TimedQueuePool,
+            'pool_size': DB_POOL_SIZE,
+            'max_overflow': DB_MAX_OVERFLOW,
+            'pool_timeout': DB_POOL_TIMEOUT,
+            'pool_recycle': DB_POOL_RECYCLE
+        })
+
+    return options
+
+
+@event.listens_for(Engine, 'begin')
+def set_local_statement_timeout(connection):
+    if not (PGBOUNCER and DB_STATEMENT_TIMEOUT) or connection.dialect.name != 'postgresql':
+        return
+    cursor = connection.connection.cursor()
+    cursor.execute('SET LOCAL statement_timeout = %s', (DB_STATEMENT_TIMEOUT,))
+    cursor.close()
@@ -0,0 +1,125 @@
+import logging
+import os
+import re
+import time
+import traceback
+from contextlib import contextmanager
+
+from flask import _request_ctx_stack, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+'''
+Query accounting
+Counts the SQL statements of every request and the time they take
+(request_queries(), exported by metrics.py), and logs every statement
+slower than SLOW_QUERY_MS milliseconds as a warning, with its normalised
+SQL and the line of our code that issued it.
+
+assert_max_queries() fails a test when a block issues more statements
+than expected, so N+1 queries are caught before they ship.
+'''
+
+SLOW_QUERY_MS = int(os.environ.get('SLOW_QUERY_MS', 500))
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+logger = logging.getLogger(__name__)
+
+LITERALS = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'%\(\w+\)s|%s|\$\d+'), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(?)'),
+    (re.compile(r'\s+'), ' ')
+]
+
+
+class QueryStats:
+    def __init__(self, keep_statements=False):
+        self.count = 0
+        self.time = 0.0
+        self.statements = [] if keep_statements else None
+
+    def record(self, statement, elapsed):
+        self.count += 1
+        self.time += elapsed
+        if self.statements is not None:
+            self.statements.append(statement)
+
+
+# counters of the assert_max_queries blocks currently running
+counters = []
+
+
+def normalize_sql(statement):
+    '''
+    Replaces literals and bound parameters with ? (and IN lists with a
+    single (?)), so the same query always logs the same text.
+    '''
+    for pattern, replacement in LITERALS:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+def call_site():
+    for frame in reversed(traceback.extract_stack()):
+        filename = os.path.abspath(frame.filename)
+        if filename.startswith(ROOT) and filename != os.path.abspath(__file__) \
+                and 'site-packages' not in filename:
+            return f'{os.path.relpath(filename, ROOT)}:{frame.lineno} in {frame.name}'
+    return 'unknown'
+
+
+def request_queries():
+    '''
+    Returns the QueryStats of the current request.
+    '''
+    ctx = _request_ctx_stack.top
+    if not hasattr(ctx, 'query_stats'):
+        ctx.query_stats = QueryStats()
+    return ctx.query_stats
+
+
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    context.query_start = time.perf_counter()
+
+
+def finish_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context.query_start
+
+    if has_request_context():
+        request_queries().record(statement, elapsed)
+    for counter in counters:
+        counter.record(statement, elapsed)
+
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        logger.warning('Slow query (%.0f ms) at %s: %s', elapsed * 1000, call_site(), normalize_sql(statement))
+
+
+def track_queries():
+    '''
+    Listens to the statements of every engine, the primary and the
+    replicas alike. Safe to call more than once.
+    '''
+    if not event.contains(Engine, 'before_cursor_execute', start_query):
+        event.listen(Engine, 'before_cursor_execute', start_query)
+        event.listen(Engine, 'after_cursor_execute', finish_query)
+
+
+@contextmanager
+def assert_max_queries(limit):
+    '''
+    Fails with AssertionError, listing the statements, if the block
+    issues more than `limit` SQL statements.
+    '''
+    counter = QueryStats(keep_statements=True)
+    counters.append(counter)
+    try:
+        yield counter
+    finally:
+        counters.remove(counter)
+
+    if counter.count > limit:
+        raise AssertionError(f'{counter.count} queries issued, expected at most {limit}:\n'
+                             + '\n'.join(normalize_sql(statement) for statement in counter.statements))
@@ -0,0 +1,212 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from metrics import SHED_REQUESTS
+
+'''
+Admission control
+Runs in requires_auth before any database work, cheapest check first:
+
+- a limit on the requests each worker process handles at once
+  (MAX_IN_FLIGHT). Requests above it are shed at once with 503 instead of
+  queueing for a database connection, so a burst can't push up latency
+  for everyone already being served. A streamed response (the exports)
+  counts until its last byte is sent.
+- token buckets per subject (the JWT `sub`) and, optionally, per subject
+  and permission, answered with 429 when empty. A bucket refills at
+  `rate` tokens per second up to `burst`; every request takes one.
+
+Both answers carry Retry-After. Buckets live in this process (`memory`)
+or in Redis (`redis`), so limits hold across every worker and dyno. A
+failing Redis lets requests through rather than failing them.
+'''
+
+
+class Overloaded(Exception):
+    def __init__(self, status_code, retry_after, message):
+        self.status_code = status_code
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.message = message
+
+
+def parse_limit(value):
+    '''
+    Parses a `rate/burst` limit, e.g. 20/40 for 20 requests a second with
+    bursts of up to 40, or a plain rate with a burst of the same size.
+    '''
+    rate, _, burst = value.partition('/')
+    rate = float(rate)
+    return rate, float(burst) if burst else rate
+
+
+def parse_permission_limits(value):
+    '''
+    Parses `permission=rate/burst` pairs separated by commas, e.g.
+    post:actors=2/10,get:movies=10/20.
+    '''
+    limits = {}
+    for item in value.split(','):
+        if item.strip():
+            permission, _, limit = item.partition('=')
+            limits[permission.strip()] = parse_limit(limit)
+    return limits
+
+
+class MemoryBuckets:
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, now=None):
+        '''
+        Takes a token from the bucket `key`. Returns 0 if there was one, or
+        the seconds until there will be.
+        '''
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+
+            self._buckets[key] = (tokens, now)
+            # the least recently used buckets are the most likely to be full again
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+TAKE_SCRIPT = '''
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'time')
+local tokens = tonumber(state[1]) or burst
+local last = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - last) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'time', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+'''
+
+
+class RedisBuckets:
+    def __init__(self, url=None, prefix='ratelimit:', client=None):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+
+        self.client = client
+        self.prefix = prefix
+        self._take = client.register_script(TAKE_SCRIPT)
+
+    def take(self, key, rate, burst, now=None):
+        now = time.time() if now is None else now
+        return float(self._take(keys=[self.prefix + key], args=[rate, burst, now]))
+
+
+class Admission:
+    def __init__(self, buckets=None, subject_limit=None, permission_limits=None, max_in_flight=0):
+        self.buckets = buckets
+        self.subject_limit = subject_limit
+        self.permission_limits = permission_limits or {}
+        self.max_in_flight = max_in_flight
+
+        self.in_flight = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def enter(self):
+        '''
+        Takes a place among the requests in flight, or raises Overloaded
+        (503) if there is none.
+        '''
+        with self._lock:
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                SHED_REQUESTS.labels('in_flight').inc()
+                raise Overloaded(503, 1, 'server overloaded')
+            self.in_flight += 1
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def leave_after(self, response):
+        '''
+        Gives the place back once `response` is sent: at once, or when it is
+        closed if its body is streamed after the view returns.
+        '''
+        if response.is_streamed:
+            response.call_on_close(self.leave)
+        else:
+            self.leave()
+        return response
+
+    @contextmanager
+    def admit(self):
+        '''
+        Holds a place among the requests in flight for the block.
+        '''
+        self.enter()
+        try:
+            yield
+        finally:
+            self.leave()
+
+    def check_rate(self, subject, permission):
+        '''
+        Takes a token from the caller's buckets, or raises Overloaded (429)
+        if one of them is empty.
+        '''
+        if self.buckets is None:
+            return
+
+        limits = []
+        if self.subject_limit:
+            limits.append((f'subject:{subject}', self.subject_limit))
+        if permission in self.permission_limits:
+            limits.append((f'permission:{subject}:{permission}', self.permission_limits[permission]))
+
+        for key, (rate, burst) in limits:
+            try:
+                wait = self.buckets.take(key, rate, burst)
+            except Exception:
+                self.errors += 1
+                continue
+            if wait:
+                SHED_REQUESTS.labels('rate_limit').inc()
+                raise Overloaded(429, wait, 'too many requests')
+
+
+def create_admission():
+    '''
+    Builds the admission control from the environment:
+    RATE_LIMIT is memory (default), redis or none.
+    '''
+    backend = os.environ.get('RATE_LIMIT', 'memory')
+    if backend == 'memory':
+        buckets = MemoryBuckets()
+    elif backend == 'redis':
+        buckets = RedisBuckets(os.environ['REDIS_URL'])
+    else:
+        buckets = None
+
+    subject_limit = os.environ.get('RATE_LIMIT_PER_SUBJECT', '20/40')
+    return Admission(buckets,
+                     subject_limit=parse_limit(subject_limit) if subject_limit else None,
+                     permission_limits=parse_permission_limits(os.environ.get('RATE_LIMIT_PER_PERMISSION', '')),
+                     max_in_flight=int(os.environ.get('MAX_IN_FLIGHT', 50)))
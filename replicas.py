@@ -0,0 +1,126 @@
+import itertools
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import create_engine, event, text
+
+logger = logging.getLogger(__name__)
+
+'''
+ReplicaSet
+The read replicas GET requests are routed to (see RoutingSession in
+models.py).
+
+- DATABASE_REPLICA_URLS is a comma separated list of replica URLs
+- DB_REPLICA_STRATEGY picks a replica per request: round_robin (default)
+  or least_connections, the replica with the fewest checked out
+  connections
+- a background thread runs SELECT 1 on every replica each
+  DB_REPLICA_HEALTH_INTERVAL seconds; replicas that fail, lose their
+  connection mid-query or (on Postgres) lag more than
+  DB_REPLICA_MAX_LAG seconds behind the primary are taken out of
+  rotation until they pass again
+- with no healthy replica, reads go to the primary
+'''
+
+DB_REPLICA_STRATEGY = os.environ.get('DB_REPLICA_STRATEGY', 'round_robin')
+DB_REPLICA_HEALTH_INTERVAL = int(os.environ.get('DB_REPLICA_HEALTH_INTERVAL', 5))
+DB_REPLICA_MAX_LAG = int(os.environ.get('DB_REPLICA_MAX_LAG', 0))
+
+
+def replica_urls():
+    urls = os.environ.get('DATABASE_REPLICA_URLS', '')
+    return [url.strip() for url in urls.split(',') if url.strip()]
+
+
+class ReplicaSet:
+    def __init__(self, urls, engine_options=None, strategy=DB_REPLICA_STRATEGY,
+                 health_interval=DB_REPLICA_HEALTH_INTERVAL, max_lag=DB_REPLICA_MAX_LAG):
+        self.engines = [create_engine(url, **(engine_options(url) if engine_options else {}))
+                        for url in urls]
+        self.strategy = strategy
+        self.health_interval = health_interval
+        self.max_lag = max_lag
+
+        self.healthy = list(self.engines)
+        self.connections = {engine: 0 for engine in self.engines}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._checker = None
+
+        for engine in self.engines:
+            event.listen(engine, 'handle_error', self._on_error)
+            # counted here rather than read from the pool, NullPool has no count
+            event.listen(engine.pool, 'checkout', self._counter_for(engine, 1))
+            event.listen(engine.pool, 'checkin', self._counter_for(engine, -1))
+
+    def choose(self):
+        self._start_health_checks()
+
+        healthy = self.healthy
+        if not healthy:
+            return None
+
+        if self.strategy == 'least_connections':
+            return min(healthy, key=lambda engine: self.connections[engine])
+        return healthy[next(self._counter) % len(healthy)]
+
+    def mark_unhealthy(self, engine):
+        with self._lock:
+            if engine in self.healthy:
+                self.healthy = [healthy for healthy in self.healthy if healthy is not engine]
+                logger.warning('Replica %r failed, removed from rotation', engine.url)
+
+    def mark_healthy(self, engine):
+        with self._lock:
+            if engine not in self.healthy:
+                self.healthy = [e for e in self.engines if e in self.healthy or e is engine]
+                logger.info('Replica %r is back in rotation', engine.url)
+
+    def check(self, engine):
+        try:
+            with engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+                if self.max_lag and engine.dialect.name == 'postgresql':
+                    lag = connection.execute(text(
+                        'SELECT COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)'
+                    )).scalar()
+                    if lag > self.max_lag:
+                        return False
+            return True
+        except Exception:
+            return False
+
+    def check_all(self):
+        for engine in self.engines:
+            if self.check(engine):
+                self.mark_healthy(engine)
+            else:
+                self.mark_unhealthy(engine)
+
+    def _counter_for(self, engine, delta):
+        def count(*args):
+            with self._lock:
+                self.connections[engine] += delta
+        return count
+
+    def _on_error(self, context):
+        if context.is_disconnect and context.engine is not None:
+            self.mark_unhealthy(context.engine)
+
+    def _start_health_checks(self):
+        # started lazily so every gunicorn worker gets its own thread
+        if self._checker is not None and self._checker.is_alive():
+            return
+        with self._lock:
+            if self._checker is not None and self._checker.is_alive():
+                return
+            self._checker = threading.Thread(target=self._run_health_checks, daemon=True)
+            self._checker.start()
+
+    def _run_health_checks(self):
+        while True:
+            time.sleep(self.health_interval)
+            self.check_all()
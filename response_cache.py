@@ -0,0 +1,193 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+from metrics import RESPONSE_CACHE_LOOKUPS, RESPONSE_CACHE_ERRORS, RESPONSE_CACHE_EVICTIONS, RESPONSE_CACHE_BYTES
+
+'''
+ResponseCache
+A read-through cache of serialised response bodies for the read routes.
+
+Keys are built from the route path, the normalised query string, the
+caller's permissions and the version stamps of every collection or row
+the response was built from. The stamps are bumped in the same
+transaction as every write, so a body cached before a write can never be
+served after it. Entries are also tagged with their collections (and
+rows) and dropped by invalidate(), which the model mutation hooks call
+after every commit, so dead entries don't sit in the cache.
+
+Two backends store the bodies:
+- MemoryBackend, an in-process LRU bounded by the total size of the bodies
+- RedisBackend, shared by every worker, for anything speaking the Redis
+  protocol
+'''
+
+
+class MemoryBackend:
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, body, tags):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (body, tags)
+            self.size += len(body)
+            RESPONSE_CACHE_BYTES.inc(len(body))
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+
+            while self.size > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+                RESPONSE_CACHE_EVICTIONS.inc()
+
+    def invalidate(self, tags):
+        with self._lock:
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        body, tags = entry
+        self.size -= len(body)
+        RESPONSE_CACHE_BYTES.dec(len(body))
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class RedisBackend:
+    def __init__(self, url=None, ttl=300, prefix='response:', client=None):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, body, tags):
+        self.client.set(self.prefix + key, body, ex=self.ttl)
+        for tag in tags:
+            self.client.sadd(self.prefix + 'tag:' + tag, key)
+            self.client.expire(self.prefix + 'tag:' + tag, self.ttl)
+
+    def invalidate(self, tags):
+        for tag in tags:
+            tag_key = self.prefix + 'tag:' + tag
+            keys = [key.decode() if isinstance(key, bytes) else key
+                    for key in self.client.smembers(tag_key)]
+            if keys:
+                self.client.delete(*[self.prefix + key for key in keys])
+            self.client.delete(tag_key)
+
+
+class ResponseCache:
+    def __init__(self, backend=None):
+        self.backend = backend
+
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @staticmethod
+    def key(path, args, permissions, version):
+        query = urlencode(sorted(args.items(multi=True)))
+        scope = ','.join(sorted(permissions))
+        raw = f'{path}?{query}|{scope}|{version}'
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get_or_build(self, key, tags, build):
+        '''
+        Returns the cached body for `key`, or calls build() to make it and
+        stores it. A failing backend is counted and skipped, never fatal.
+        '''
+        if self.backend is None:
+            return build()
+
+        try:
+            body = self.backend.get(key)
+        except Exception:
+            self.count_error()
+            body = None
+
+        if body is not None:
+            self.hits += 1
+            RESPONSE_CACHE_LOOKUPS.labels('hit').inc()
+            return body
+
+        self.misses += 1
+        RESPONSE_CACHE_LOOKUPS.labels('miss').inc()
+        body = build()
+        try:
+            self.backend.set(key, body, tags)
+        except Exception:
+            self.count_error()
+        return body
+
+    def invalidate(self, collection, action=None, ids=()):
+        if self.backend is None:
+            return
+        tags = [collection] + [f'{collection}:{id}' for id in ids]
+        try:
+            self.backend.invalidate(tags)
+        except Exception:
+            self.count_error()
+
+    def count_error(self):
+        self.errors += 1
+        RESPONSE_CACHE_ERRORS.inc()
+
+    def stats(self):
+        stats = {
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors
+        }
+        if isinstance(self.backend, MemoryBackend):
+            stats['size'] = self.backend.size
+            stats['max_bytes'] = self.backend.max_bytes
+            stats['evictions'] = self.backend.evictions
+        return stats
+
+
+def create_response_cache():
+    '''
+    Builds the response cache from the environment:
+    RESPONSE_CACHE is memory (default), redis or none.
+    '''
+    backend = os.environ.get('RESPONSE_CACHE', 'memory')
+    if backend == 'memory':
+        return ResponseCache(MemoryBackend(int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))))
+    if backend == 'redis':
+        return ResponseCache(RedisBackend(os.environ['REDIS_URL'],
+                                          ttl=int(os.environ.get('RESPONSE_CACHE_TTL', 300))))
+    return ResponseCache()
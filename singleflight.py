@@ -0,0 +1,77 @@
+import copy
+import threading
+
+'''
+SingleFlight
+Collapses concurrent calls for the same key into one: the first caller
+runs the function and every caller that arrives while it is running
+waits for it and gets the same result instead of running it again. An
+exception is raised to each waiter as its own copy, chained to the
+original, since an exception object raised in several threads at once
+would have their tracebacks mixed up. Once the call returns the key is forgotten, so results
+are never reused after the fact; that is the response cache's job.
+
+The read routes use it around building a response body, so a burst of
+identical requests (same path, query string, permissions and collection
+version) costs one query and one serialisation per process. Each request
+still reads the version itself: sharing that lookup could hand a request
+made after a write the version read before it.
+'''
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        '''
+        Returns (result, shared): fn()'s result, and whether it came from a
+        call made by another caller.
+        '''
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = Call()
+                self.calls += 1
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise copy.copy(call.error) from call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.done.set()
+        return call.result, False
+
+    def stats(self):
+        with self._lock:
+            in_flight = len(self._in_flight)
+        return {
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+            'in_flight': in_flight
+        }
@@ -1,10 +1,43 @@
+import io
 import os
+import select
 import unittest
+from unittest import mock
 import json
+import datetime
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from flask_sqlalchemy import SQLAlchemy
+from werkzeug.datastructures import ImmutableMultiDict
+from werkzeug.exceptions import BadRequest, Gone, PreconditionFailed
 
-from app import create_app
-from models import setup_db, Actor, Movie
+# the route tests send requests faster than the default rate limits allow
+os.environ.setdefault('RATE_LIMIT', 'none')
+
+import app as app_module
+from app import create_app, page_query, filter_actors, filter_movies, encode_cursor, dump_json, changes, \
+    encode_change_token, not_modified, with_validators, if_match_version, DEFAULT_PAGE_SIZE
+from models import setup_db, db, Actor, Movie, get_stats, reconcile_stats, collection_stats, stage_mutation, \
+    collection_version_bump
+from jwks import JWKSKeyStore
+from token_cache import TokenCache
+from response_cache import ResponseCache, MemoryBackend, RedisBackend
+from pool import TimedQueuePool, engine_options
+from replicas import ReplicaSet
+from group_commit import GroupCommit
+import metrics
+from metrics import init_metrics, phase
+from prometheus_client import REGISTRY
+from queries import assert_max_queries, normalize_sql, track_queries
+from events import EventBroker, ChangeEvents, stream_events, EVENTS_CHANNEL
+from importer import CopyStream, read_records, validate, validate_values, import_mutations
+from singleflight import SingleFlight
+from rate_limit import Admission, MemoryBuckets, Overloaded, parse_limit, parse_permission_limits
+from flask import Flask, Response, jsonify
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import TimeoutError
 
 
 class HerokuTestCase(unittest.TestCase):
@@ -74,6 +107,167 @@ class HerokuTestCase(unittest.TestCase):
         data = json.loads(res.data)
         self.assertEqual(res.status_code, 200)
 
+    def test_get_actors_paginated(self):
+        for i in range(3):
+            self.client().post('/actors',
+                               data=json.dumps(self.new_actor),
+                               headers={'Content-Type': 'application/json',
+                                        'Authorization': 'Bearer ' + self.jwt_director})
+
+        res = self.client().get('/actors?limit=2', headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['actors']), 2)
+        self.assertIsNotNone(data['next_cursor'])
+
+        res2 = self.client().get('/actors?limit=2&cursor=' + data['next_cursor'],
+                                 headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        data2 = json.loads(res2.data)
+        self.assertEqual(res2.status_code, 200)
+        self.assertGreater(data2['actors'][0]['id'], data['actors'][-1]['id'])
+
+    def test_search_actors_by_name(self):
+        self.client().post('/actors',
+                           data=json.dumps(self.new_actor),
+                           headers={'Content-Type': 'application/json',
+                                    'Authorization': 'Bearer ' + self.jwt_director})
+
+        res = self.client().get('/actors?name=barrow', headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['actors'])
+        for actor in data['actors']:
+            self.assertIn('barrow', actor['name'].lower())
+
+        res2 = self.client().get('/actors?name_prefix=bart&gender=Male',
+                                 headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        for actor in json.loads(res2.data)['actors']:
+            self.assertTrue(actor['name'].lower().startswith('bart'))
+            self.assertEqual(actor['gender'], 'Male')
+
+    def test_get_actors_sorted_by_name(self):
+        res = self.client().get('/actors?sort=-name&limit=5', headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        names = [actor['name'] for actor in data['actors'] if actor['name'] is not None]
+        self.assertEqual(names, sorted(names, reverse=True))
+
+    def test_get_actors_sorted_by_unknown_column(self):
+        res = self.client().get('/actors?sort=age', headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_actors_with_fields(self):
+        res = self.client().get('/actors?fields=id,name&sort=-name&limit=2',
+                                headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        for actor in data['actors']:
+            self.assertEqual(set(actor), {'id', 'name'})
+
+    def test_get_actor_changes(self):
+        res = self.client().get('/actors/changes?limit=5', headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertLessEqual(len(data['actors']) + len(data['deleted']), 5)
+        self.assertTrue(data['next_token'])
+
+    def test_get_actor_changes_with_expired_token(self):
+        token = encode_change_token(1, 0, datetime.datetime(2000, 1, 1))
+        res = self.client().get(f'/actors/changes?since={token}',
+                                headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        self.assertEqual(res.status_code, 410)
+
+    def test_get_events(self):
+        res = self.client().get('/events', headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/event-stream')
+        res.close()
+
+    def test_get_actors_with_unknown_field(self):
+        res = self.client().get('/actors?fields=id,salary', headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        self.assertEqual(res.status_code, 400)
+
+    def test_search_actors_with_short_text(self):
+        res = self.client().get('/actors?name=ba', headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_actors_with_invalid_limit(self):
+        res = self.client().get('/actors?limit=0', headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_actors_with_invalid_cursor(self):
+        res = self.client().get('/actors?cursor=not-a-cursor', headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_actors_not_modified(self):
+        res = self.client().get('/actors', headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNotNone(res.headers.get('ETag'))
+        self.assertIsNotNone(res.headers.get('Last-Modified'))
+
+        res2 = self.client().get('/actors', headers={'Authorization': 'Bearer ' + self.jwt_assistant,
+                                                     'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res2.status_code, 304)
+
+    def test_get_actors_modified_after_insert(self):
+        res = self.client().get('/actors', headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        self.client().post('/actors',
+                           data=json.dumps(self.new_actor),
+                           headers={'Content-Type': 'application/json',
+                                    'Authorization': 'Bearer ' + self.jwt_director})
+
+        res2 = self.client().get('/actors', headers={'Authorization': 'Bearer ' + self.jwt_assistant,
+                                                     'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res2.status_code, 200)
+
+    def test_get_actor(self):
+        res = self.client().post('/actors',
+                                 data=json.dumps(self.new_actor),
+                                 headers={'Content-Type': 'application/json',
+                                          'Authorization': 'Bearer ' + self.jwt_director})
+        id = json.loads(res.data)['actor']['id']
+
+        res2 = self.client().get('/actors/' + str(id), headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        data2 = json.loads(res2.data)
+        self.assertEqual(res2.status_code, 200)
+        self.assertEqual(data2['actor']['name'], self.new_actor['name'])
+
+        res3 = self.client().get('/actors/' + str(id), headers={'Authorization': 'Bearer ' + self.jwt_assistant,
+                                                                'If-None-Match': res2.headers['ETag']})
+        self.assertEqual(res3.status_code, 304)
+
+    def test_get_unknown_actor(self):
+        res = self.client().get('/actors/100000', headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        self.assertEqual(res.status_code, 404)
+
+    def test_get_actors_after_update_is_not_stale(self):
+        res = self.client().post('/actors',
+                                 data=json.dumps(self.new_actor),
+                                 headers={'Content-Type': 'application/json',
+                                          'Authorization': 'Bearer ' + self.jwt_director})
+        id = json.loads(res.data)['actor']['id']
+        url = '/actors/' + str(id)
+
+        self.client().get(url, headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        self.client().patch(url,
+                            data=json.dumps(self.patch_actor),
+                            headers={'Content-Type': 'application/json',
+                                     'Authorization': 'Bearer ' + self.jwt_producer})
+
+        res2 = self.client().get(url, headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        self.assertEqual(json.loads(res2.data)['actor']['name'], self.patch_actor['name'])
+
+    def test_export_actors(self):
+        res = self.client().get('/actors/export', headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        for line in res.data.decode().splitlines():
+            self.assertIn('id', json.loads(line))
+
+    def test_export_actors_without_auth(self):
+        res = self.client().get('/actors/export')
+        self.assertEqual(res.status_code, 401)
+
     def test_add_new_actor_as_assistant(self):
         print(self.jwt_assistant)
         res = self.client().post('/actors',
@@ -94,6 +288,42 @@ class HerokuTestCase(unittest.TestCase):
         self.assertEqual(data['actor']['age'], self.new_actor['age'])
         self.assertEqual(data['actor']['gender'], self.new_actor['gender'])
 
+    def test_add_actors_batch_as_director(self):
+        res = self.client().post('/actors/batch',
+                                 data=json.dumps([self.new_actor, self.new_actor_without_name, self.new_actor]),
+                                 headers={'Content-Type': 'application/json',
+                                          'Authorization': 'Bearer ' + self.jwt_director})
+        data = json.loads(res.data)
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(data['inserted'], 2)
+        self.assertTrue(data['results'][0]['success'])
+        self.assertFalse(data['results'][1]['success'])
+        self.assertTrue(data['results'][2]['success'])
+
+    def test_add_actors_batch_as_ndjson(self):
+        body = '\n'.join(json.dumps(actor) for actor in [self.new_actor, self.new_actor])
+        res = self.client().post('/actors/batch',
+                                 data=body,
+                                 headers={'Content-Type': 'application/x-ndjson',
+                                          'Authorization': 'Bearer ' + self.jwt_director})
+        data = json.loads(res.data)
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(data['inserted'], 2)
+
+    def test_add_actors_batch_as_assistant(self):
+        res = self.client().post('/actors/batch',
+                                 data=json.dumps([self.new_actor]),
+                                 headers={'Content-Type': 'application/json',
+                                          'Authorization': 'Bearer ' + self.jwt_assistant})
+        self.assertEqual(403, res.status_code)
+
+    def test_add_actors_batch_without_array(self):
+        res = self.client().post('/actors/batch',
+                                 data=json.dumps(self.new_actor),
+                                 headers={'Content-Type': 'application/json',
+                                          'Authorization': 'Bearer ' + self.jwt_director})
+        self.assertEqual(400, res.status_code)
+
     def test_add_new_actor_as_producer_incomplete_data(self):
         res = self.client().post('/actors',
                                  data=json.dumps(self.new_actor_without_name),
@@ -136,12 +366,137 @@ class HerokuTestCase(unittest.TestCase):
                                             'Authorization': 'Bearer ' + self.jwt_producer})
         self.assertEqual(200, res.status_code)
 
+    def test_update_actor_with_if_match(self):
+        res = self.client().post('/actors',
+                                 data=json.dumps(self.new_actor),
+                                 headers={'Content-Type': 'application/json',
+                                          'Authorization': 'Bearer ' + self.jwt_director})
+        id = json.loads(res.data)['actor']['id']
+        etag = self.client().get('/actors/' + str(id),
+                                 headers={'Authorization': 'Bearer ' + self.jwt_producer}).headers['ETag']
+
+        res2 = self.client().patch('/actors/' + str(id),
+                                   data=json.dumps(self.patch_actor),
+                                   headers={'Content-Type': 'application/json',
+                                            'Authorization': 'Bearer ' + self.jwt_producer,
+                                            'If-Match': etag})
+        data2 = json.loads(res2.data)
+        self.assertEqual(200, res2.status_code)
+        self.assertEqual(data2['actor']['name'], self.patch_actor['name'])
+
+        res3 = self.client().patch('/actors/' + str(id),
+                                   data=json.dumps(self.patch_actor),
+                                   headers={'Content-Type': 'application/json',
+                                            'Authorization': 'Bearer ' + self.jwt_producer,
+                                            'If-Match': etag})
+        self.assertEqual(412, res3.status_code)
+
+    def test_update_unknown_actor_as_producer(self):
+        res = self.client().patch('/actors/100000',
+                                  data=json.dumps(self.patch_actor),
+                                  headers={'Content-Type': 'application/json',
+                                           'Authorization': 'Bearer ' + self.jwt_producer})
+        self.assertEqual(404, res.status_code)
+
+    def test_delete_actor_with_stale_if_match(self):
+        res = self.client().post('/actors',
+                                 data=json.dumps(self.new_actor),
+                                 headers={'Content-Type': 'application/json',
+                                          'Authorization': 'Bearer ' + self.jwt_director})
+        id = json.loads(res.data)['actor']['id']
+
+        res2 = self.client().delete('/actors/' + str(id),
+                                    headers={'Content-Type': 'application/json',
+                                             'Authorization': 'Bearer ' + self.jwt_producer,
+                                             'If-Match': '"actors-' + str(id) + '-100"'})
+        self.assertEqual(412, res2.status_code)
+
     def test_update_actor_as_producer_without_data(self):
         res = self.client().patch('/actors/1',
                                    headers={'Content-Type': 'application/json',
                                             'Authorization': 'Bearer ' + self.jwt_producer})
         self.assertEqual(400, res.status_code)
 
+    # CAST ENDPOINTS
+
+    def test_link_and_get_actor_movies_as_producer(self):
+        res = self.client().post('/actors',
+                                 data=json.dumps(self.new_actor),
+                                 headers={'Content-Type': 'application/json',
+                                          'Authorization': 'Bearer ' + self.jwt_producer})
+        actor_id = json.loads(res.data)['actor']['id']
+        res = self.client().post('/movies',
+                                 data=json.dumps(self.new_movie),
+                                 headers={'Content-Type': 'application/json',
+                                          'Authorization': 'Bearer ' + self.jwt_producer})
+        movie_id = json.loads(res.data)['movie']['id']
+
+        res2 = self.client().post('/actors/' + str(actor_id) + '/movies',
+                                  data=json.dumps({'movie_ids': [movie_id]}),
+                                  headers={'Content-Type': 'application/json',
+                                           'Authorization': 'Bearer ' + self.jwt_producer})
+        self.assertEqual(200, res2.status_code)
+        self.assertEqual(json.loads(res2.data)['linked'], 1)
+
+        res3 = self.client().get('/actors/' + str(actor_id) + '/movies',
+                                 headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        data3 = json.loads(res3.data)
+        self.assertEqual(200, res3.status_code)
+        self.assertEqual([movie['id'] for movie in data3['movies']], [movie_id])
+
+        res4 = self.client().get('/movies/' + str(movie_id) + '/actors',
+                                 headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        data4 = json.loads(res4.data)
+        self.assertEqual([actor['id'] for actor in data4['actors']], [actor_id])
+
+        res5 = self.client().delete('/actors/' + str(actor_id) + '/movies',
+                                    data=json.dumps({'movie_ids': [movie_id]}),
+                                    headers={'Content-Type': 'application/json',
+                                             'Authorization': 'Bearer ' + self.jwt_producer})
+        self.assertEqual(json.loads(res5.data)['unlinked'], 1)
+
+    def test_link_actor_movies_as_assistant(self):
+        res = self.client().post('/actors/1/movies',
+                                 data=json.dumps({'movie_ids': [1]}),
+                                 headers={'Content-Type': 'application/json',
+                                          'Authorization': 'Bearer ' + self.jwt_assistant})
+        self.assertEqual(403, res.status_code)
+
+    def test_get_unknown_actor_movies(self):
+        res = self.client().get('/actors/100000/movies', headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        self.assertEqual(404, res.status_code)
+
+    def test_unlink_unknown_actor_movies(self):
+        res = self.client().delete('/actors/100000/movies',
+                                   data=json.dumps({'movie_ids': [1]}),
+                                   headers={'Content-Type': 'application/json',
+                                            'Authorization': 'Bearer ' + self.jwt_producer})
+        self.assertEqual(404, res.status_code)
+
+    def test_get_actors_including_movies(self):
+        res = self.client().get('/actors?include=movies', headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        data = json.loads(res.data)
+        self.assertEqual(200, res.status_code)
+        for actor in data['actors']:
+            self.assertIn('movies', actor)
+
+    def test_get_actors_including_movies_query_count(self):
+        # versions of both collections, one page of actors, their movies
+        with assert_max_queries(4):
+            res = self.client().get('/actors?include=movies&limit=50',
+                                    headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        self.assertEqual(200, res.status_code)
+
+    def test_get_movies_including_actors_query_count(self):
+        with assert_max_queries(4):
+            res = self.client().get('/movies?include=actors&limit=50',
+                                    headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        self.assertEqual(200, res.status_code)
+
+    def test_get_movies_including_unknown_relationship(self):
+        res = self.client().get('/movies?include=directors', headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        self.assertEqual(400, res.status_code)
+
     # MOVIE ENDPOINTS
 
     def test_get_all_movies_without_auth(self):
@@ -154,6 +509,40 @@ class HerokuTestCase(unittest.TestCase):
         data = json.loads(res.data)
         self.assertEqual(res.status_code, 200)
 
+    def test_get_movies_not_modified(self):
+        res = self.client().get('/movies', headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        self.assertEqual(res.status_code, 200)
+
+        res2 = self.client().get('/movies', headers={'Authorization': 'Bearer ' + self.jwt_assistant,
+                                                     'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res2.status_code, 304)
+
+    def test_get_movies_in_release_date_range(self):
+        res = self.client().get('/movies?release_date_from=2020-05-01&release_date_to=2020-05-31',
+                                headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        self.assertEqual(res.status_code, 200)
+
+    def test_get_movie_with_fields(self):
+        res = self.client().post('/movies', data=json.dumps(self.new_movie),
+                                 headers={'Content-Type': 'application/json',
+                                          'Authorization': 'Bearer ' + self.jwt_producer})
+        id = json.loads(res.data)['movie']['id']
+
+        res = self.client().get(f'/movies/{id}?fields=title', headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie'], {'title': self.new_movie['title']})
+
+    def test_get_movies_with_invalid_release_date(self):
+        res = self.client().get('/movies?release_date_from=yesterday',
+                                headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        self.assertEqual(res.status_code, 400)
+
+    def test_export_movies(self):
+        res = self.client().get('/movies/export', headers={'Authorization': 'Bearer ' + self.jwt_assistant})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+
     def test_add_new_movie_as_assistant(self):
         print(self.jwt_assistant)
         res = self.client().post('/movies',
@@ -172,6 +561,16 @@ class HerokuTestCase(unittest.TestCase):
         self.assertTrue(data['success'])
         self.assertEqual(data['movie']['title'], self.new_movie['title'])
 
+    def test_add_movies_batch_as_producer(self):
+        res = self.client().post('/movies/batch',
+                                 data=json.dumps([self.new_movie, self.new_movie_without_title]),
+                                 headers={'Content-Type': 'application/json',
+                                          'Authorization': 'Bearer ' + self.jwt_producer})
+        data = json.loads(res.data)
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(data['inserted'], 1)
+        self.assertFalse(data['results'][1]['success'])
+
     def test_add_new_movie_as_producer_incomplete_data(self):
         res = self.client().post('/actors',
                                  data=json.dumps(self.new_movie_without_title),
@@ -214,6 +613,13 @@ class HerokuTestCase(unittest.TestCase):
                                            'Authorization': 'Bearer ' + self.jwt_producer})
         self.assertEqual(200, res.status_code)
 
+    def test_update_unknown_movie_as_producer(self):
+        res = self.client().patch('/movies/100000',
+                                  data=json.dumps(self.patch_movie),
+                                  headers={'Content-Type': 'application/json',
+                                           'Authorization': 'Bearer ' + self.jwt_producer})
+        self.assertEqual(404, res.status_code)
+
     def test_update_movie_as_producer_without_data(self):
         res = self.client().patch('/movies/1',
                                   headers={'Content-Type': 'application/json',
@@ -260,6 +666,983 @@ class HerokuTestCase(unittest.TestCase):
 
 
 
+class QueryPlanTestCase(unittest.TestCase):
+    """This class checks every supported filter and sort is served by an index"""
+
+    rows = 100000
+
+    actor_queries = [
+        {'name': 'abc'},
+        {'name_prefix': 'actor 12'},
+        {'gender': 'Female'},
+        {'sort': 'name'},
+        {'sort': '-name'},
+        {'sort': 'name', 'cursor': encode_cursor(['Actor 5', 50000])},
+        {'gender': 'Male', 'sort': '-id'}
+    ]
+
+    movie_queries = [
+        {'title': 'abc'},
+        {'title_prefix': 'movie 12'},
+        {'release_date_from': '2001-03-01', 'release_date_to': '2001-03-31'},
+        {'sort': 'title'},
+        {'sort': 'release_date'},
+        {'sort': '-release_date', 'cursor': encode_cursor(['2001-03-01', 50000])}
+    ]
+
+    def setUp(self):
+        self.app = create_app()
+        if not self.app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgres'):
+            self.skipTest('query plans are only checked on Postgres')
+
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+        # seed inside a transaction that is rolled back in tearDown
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.connection.execute(
+            "INSERT INTO actors (name, age, gender) "
+            "SELECT 'Actor ' || i || ' ' || md5(i::text), (i % 80)::text, "
+            "CASE WHEN i % 2 = 0 THEN 'Female' ELSE 'Male' END "
+            "FROM generate_series(1, %s) AS i", (self.rows,))
+        self.connection.execute(
+            "INSERT INTO movies (title, release_date) "
+            "SELECT 'Movie ' || i || ' ' || md5(i::text), DATE '1950-01-01' + (i % 25000) "
+            "FROM generate_series(1, %s) AS i", (self.rows,))
+        self.connection.execute('ANALYZE actors')
+        self.connection.execute('ANALYZE movies')
+
+    def tearDown(self):
+        self.transaction.rollback()
+        self.connection.close()
+        self.context.pop()
+
+    def explain(self, query):
+        statement = query.statement.compile(dialect=db.engine.dialect)
+        plan = self.connection.execute('EXPLAIN ' + str(statement), statement.params)
+        return '\n'.join(row[0] for row in plan)
+
+    def assertIndexBacked(self, model, filter_query, args):
+        query, column = page_query(model, filter_query(model.query, args), args, DEFAULT_PAGE_SIZE)
+        plan = self.explain(query)
+        self.assertNotIn('Seq Scan', plan, f'{model.__tablename__} {args}:\n{plan}')
+
+    def test_actor_filters_use_indexes(self):
+        for args in self.actor_queries:
+            self.assertIndexBacked(Actor, filter_actors, args)
+
+    def test_movie_filters_use_indexes(self):
+        for args in self.movie_queries:
+            self.assertIndexBacked(Movie, filter_movies, args)
+
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+    """This class tests the in-process JWKS cache against a local file"""
+
+    def setUp(self):
+        self.jwks_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+        self.write_keys('key-1')
+        self.store = JWKSKeyStore('file://' + self.jwks_file.name,
+                                  ttl=600,
+                                  min_refresh_interval=0)
+
+    def tearDown(self):
+        os.remove(self.jwks_file.name)
+
+    def write_keys(self, *kids):
+        with open(self.jwks_file.name, 'w') as f:
+            json.dump({'keys': [{
+                'kty': 'RSA',
+                'kid': kid,
+                'use': 'sig',
+                'n': 'n-' + kid,
+                'e': 'AQAB'
+            } for kid in kids]}, f)
+
+    def test_get_known_key(self):
+        key = self.store.get_key('key-1')
+        self.assertEqual(key['kid'], 'key-1')
+        self.assertEqual(key['n'], 'n-key-1')
+
+    def test_keys_are_cached(self):
+        self.store.get_key('key-1')
+        os.remove(self.jwks_file.name)
+        self.assertEqual(self.store.get_key('key-1')['kid'], 'key-1')
+        self.write_keys('key-1')
+
+    def test_unknown_kid_refetches(self):
+        self.store.get_key('key-1')
+        self.write_keys('key-1', 'key-2')
+        self.assertEqual(self.store.get_key('key-2')['kid'], 'key-2')
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        self.store.min_refresh_interval = 60
+        self.store.get_key('key-1')
+        self.write_keys('key-1', 'key-2')
+        self.assertIsNone(self.store.get_key('key-2'))
+
+    def test_stale_keys_served_when_endpoint_unreachable(self):
+        self.store.get_key('key-1')
+        self.store.url = 'file:///does/not/exist.json'
+        with self.assertLogs('jwks', 'WARNING'):
+            self.assertFalse(self.store.refresh())
+        self.assertEqual(self.store.get_key('key-1')['kid'], 'key-1')
+
+    def test_concurrent_first_requests_wait_for_the_fetch(self):
+        store = JWKSKeyStore('file://' + self.jwks_file.name, min_refresh_interval=30)
+        fetch = store.fetch
+
+        def slow_fetch():
+            time.sleep(0.2)
+            return fetch()
+        store.fetch = slow_fetch
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            keys = list(executor.map(lambda _: store.get_key('key-1'), range(4)))
+        self.assertTrue(all(key is not None for key in keys))
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class tests the verified token cache"""
+
+    def setUp(self):
+        self.key_version = 1
+        self.cache = TokenCache(maxsize=2, max_ttl=300,
+                                key_version=lambda: self.key_version)
+        self.payload = {'sub': 'tester', 'exp': time.time() + 60}
+
+    def test_miss_then_hit(self):
+        hits = REGISTRY.get_sample_value('token_cache_lookups_total', {'result': 'hit'}) or 0
+        self.assertIsNone(self.cache.get('token'))
+        self.cache.set('token', self.payload)
+        self.assertEqual(self.cache.get('token'), self.payload)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+        self.assertEqual(REGISTRY.get_sample_value('token_cache_lookups_total', {'result': 'hit'}), hits + 1)
+
+    def test_expired_token_is_not_served(self):
+        self.cache.set('token', {'sub': 'tester', 'exp': time.time() - 1})
+        self.assertIsNone(self.cache.get('token'))
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.set('token-1', self.payload)
+        self.cache.set('token-2', self.payload)
+        self.cache.get('token-1')
+        self.cache.set('token-3', self.payload)
+        self.assertIsNone(self.cache.get('token-2'))
+        self.assertIsNotNone(self.cache.get('token-1'))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_key_rotation_drops_entries(self):
+        self.cache.set('token', self.payload)
+        self.key_version = 2
+        self.assertIsNone(self.cache.get('token'))
+
+
+class PoolTestCase(unittest.TestCase):
+    """This class tests the connection pool settings and metrics"""
+
+    def test_engine_options_for_postgres(self):
+        options = engine_options('postgres://user@localhost/db')
+        self.assertIs(options['poolclass'], TimedQueuePool)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertIn('connect_timeout', options['connect_args'])
+
+    def test_pool_records_saturation_and_timeouts(self):
+        timeouts = REGISTRY.get_sample_value('db_pool_timeouts_total')
+        checked_out = REGISTRY.get_sample_value('db_pool_checked_out')
+        engine = create_engine('sqlite://', poolclass=TimedQueuePool,
+                               pool_size=1, max_overflow=0, pool_timeout=0.1)
+        connection = engine.connect()
+        self.assertEqual(engine.pool.stats()['saturation'], 1.0)
+        self.assertEqual(REGISTRY.get_sample_value('db_pool_checked_out'), checked_out + 1)
+
+        with self.assertRaises(TimeoutError):
+            engine.connect()
+
+        stats = engine.pool.stats()
+        self.assertEqual(stats['checkouts'], 1)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertGreaterEqual(stats['checkout_wait_max'], 0.1)
+        self.assertEqual(REGISTRY.get_sample_value('db_pool_timeouts_total'), timeouts + 1)
+        connection.close()
+        self.assertEqual(REGISTRY.get_sample_value('db_pool_checked_out'), checked_out)
+
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+    """This class tests routing reads to a replica, with two local databases"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.primary_path = f'sqlite:///{self.directory.name}/primary.db'
+        self.replica_path = f'sqlite:///{self.directory.name}/replica.db'
+
+        self.app = Flask(__name__)
+        setup_db(self.app, self.primary_path, [self.replica_path])
+        self.replicas = db.replicas
+
+        with self.app.app_context():
+            db.create_all()
+            db.metadata.create_all(self.replicas.engines[0])
+            db.session.execute(Actor.__table__.insert().values(name='On Primary', age='30', gender='Female'))
+            db.session.commit()
+            self.replicas.engines[0].execute(
+                Actor.__table__.insert().values(name='On Replica', age='30', gender='Female'))
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+        for engine in self.replicas.engines:
+            engine.dispose()
+        db.replicas = None
+        self.directory.cleanup()
+
+    def names(self, method='GET'):
+        with self.app.test_request_context('/actors', method=method):
+            return [actor.name for actor in Actor.query.all()]
+
+    def test_get_reads_from_replica(self):
+        self.assertEqual(self.names(), ['On Replica'])
+
+    def test_writes_read_from_primary(self):
+        self.assertEqual(self.names('POST'), ['On Primary'])
+
+    def test_read_after_write_stays_on_primary(self):
+        with self.app.test_request_context('/actors', method='GET'):
+            db.session.add(Actor('Written', '40', 'Male'))
+            db.session.flush()
+            self.assertEqual([actor.name for actor in Actor.query.all()], ['On Primary', 'Written'])
+            db.session.rollback()
+
+    def test_unhealthy_replica_falls_back_to_primary(self):
+        self.replicas.mark_unhealthy(self.replicas.engines[0])
+        self.assertEqual(self.names(), ['On Primary'])
+
+        self.replicas.check_all()
+        self.assertEqual(self.names(), ['On Replica'])
+
+    def test_failing_replica_leaves_rotation(self):
+        replicas = ReplicaSet([self.replica_path, f'sqlite:///{self.directory.name}/missing/replica.db'])
+        replicas.check_all()
+        self.assertEqual(replicas.healthy, replicas.engines[:1])
+        self.assertIs(replicas.choose(), replicas.engines[0])
+
+    def test_strategies(self):
+        replicas = ReplicaSet([self.replica_path, self.replica_path])
+        self.assertEqual({replicas.choose(), replicas.choose()}, set(replicas.engines))
+
+        replicas = ReplicaSet([self.replica_path, self.replica_path], strategy='least_connections')
+        connection = replicas.engines[0].connect()
+        self.assertIs(replicas.choose(), replicas.engines[1])
+        connection.close()
+
+
+class GroupCommitTestCase(unittest.TestCase):
+    """This class tests committing concurrent writes together"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = create_engine(f'sqlite:///{self.directory.name}/group.db')
+        self.engine.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT NOT NULL)')
+        self.bumped = []
+        self.notified = []
+        self.group_commit = GroupCommit(self.engine,
+                                        lambda connection, names: self.bumped.append(names),
+                                        lambda *mutation: self.notified.append(mutation),
+                                        max_wait=0.05)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def insert(self, name):
+        def write(connection):
+            id = connection.execute(text('INSERT INTO items (name) VALUES (:name)'), name=name).lastrowid
+            return connection.execute(text('SELECT id, name FROM items WHERE id = :id'), id=id).first()
+        return self.group_commit.submit('items', 'insert', write)
+
+    def test_concurrent_writes_share_a_commit(self):
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(self.insert, [f'Item {i}' for i in range(8)]))
+
+        self.assertEqual(self.engine.execute('SELECT count(*) FROM items').scalar(), 8)
+        stats = self.group_commit.stats()
+        self.assertEqual(sum(size * count for size, count in stats['batch_sizes'].items()), 8)
+        self.assertLess(stats['commits'], 8)
+
+    def test_failing_write_only_fails_its_caller(self):
+        with ThreadPoolExecutor(3) as executor:
+            good = executor.submit(self.insert, 'Good')
+            bad = executor.submit(self.insert, None)
+            other = executor.submit(self.insert, 'Other')
+
+            with self.assertRaises(Exception):
+                bad.result()
+            good.result()
+            other.result()
+
+        names = [row.name for row in self.engine.execute('SELECT name FROM items ORDER BY name')]
+        self.assertEqual(names, ['Good', 'Other'])
+        self.assertEqual(self.group_commit.stats()['failed_commits'], 0)
+
+    def test_returns_the_returned_row_after_the_commit(self):
+        row = self.group_commit.submit('items', 'update',
+                                       lambda connection: connection.execute(text("SELECT 7 AS id, 'Seven' AS name")).first())
+        self.assertEqual((row.id, row.name), (7, 'Seven'))
+        self.assertEqual(self.notified, [('items', 'update', [7])])
+        self.assertEqual(self.bumped, [['items']])
+
+    def test_failing_notify_does_not_fail_the_write(self):
+        def notify(*mutation):
+            raise RuntimeError('listener failed')
+        self.group_commit.notify = notify
+
+        self.assertEqual(self.insert('First').name, 'First')
+        self.assertEqual(self.insert('Second').name, 'Second')
+        self.assertEqual(self.group_commit.stats()['failed_notifies'], 2)
+
+    def test_callers_stop_waiting_after_the_timeout(self):
+        self.group_commit.timeout = 0.01
+        release = threading.Event()
+
+        def slow_write(connection):
+            release.wait(5)
+
+        with self.assertRaises(FutureTimeoutError):
+            self.group_commit.submit('items', 'update', slow_write)
+        release.set()
+        self.group_commit.timeout = 5
+        self.assertEqual(self.insert('After').name, 'After')
+
+
+class StatsTestCase(unittest.TestCase):
+    """This class tests keeping the /stats counts up to date"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = Flask(__name__)
+        setup_db(self.app, f'sqlite:///{self.directory.name}/stats.db')
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        self.context.pop()
+        self.directory.cleanup()
+
+    def test_writes_update_the_counts(self):
+        actors = [Actor('Stats Actor', '30', gender) for gender in ('Female', 'Male', 'Female')]
+        for actor in actors:
+            actor.insert()
+        movies = [Movie('Stats Movie', datetime.date(year, 1, 1)) for year in (1999, 1999, 2005)]
+        for movie in movies:
+            movie.insert()
+        Actor.link_movies(actors[0].id, [movies[0].id, movies[1].id])
+        Movie.link_actors(movies[0].id, [actors[1].id])
+
+        actors[1].gender = 'Other'
+        actors[1].update()
+        movies[2].delete()
+
+        self.assertEqual(get_stats(), {
+            'actors_by_gender': {'Female': 2, 'Other': 1},
+            'movies_by_release_year': {'1999': 2},
+            'cast_sizes': {'1': 1, '2': 1}
+        })
+
+        actors[0].delete()
+        self.assertEqual(get_stats()['cast_sizes'], {'0': 1, '1': 1})
+        self.assertEqual(reconcile_stats(), {})
+
+    def test_bulk_insert_returns_the_ids_in_order(self):
+        rows = [{'title': f'Batch Movie {n}', 'release_date': datetime.date(2000 + n, 1, 1)} for n in range(3)]
+        ids = Movie.insert_many(rows)
+        self.assertEqual([Movie.query.get(id).title for id in ids], ['Batch Movie 0', 'Batch Movie 1', 'Batch Movie 2'])
+        self.assertEqual(get_stats()['movies_by_release_year'], {'2000': 1, '2001': 1, '2002': 1})
+
+    def test_reconcile_corrects_drift(self):
+        Actor('Stats Actor', '30', 'Female').insert()
+        db.session.execute(collection_stats.update().values(value=5))
+        db.session.execute(collection_stats.insert().values(name='actors_by_gender', key='Male', value=1))
+        db.session.commit()
+
+        self.assertEqual(reconcile_stats(), {('actors_by_gender', 'Female'): -4, ('actors_by_gender', 'Male'): -1})
+        self.assertEqual(get_stats()['actors_by_gender'], {'Female': 1})
+
+
+class ChangesTestCase(unittest.TestCase):
+    """This class tests the changes feeds built from change versions and tombstones"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = Flask(__name__)
+        setup_db(self.app, f'sqlite:///{self.directory.name}/changes.db')
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        self.context.pop()
+        self.directory.cleanup()
+
+    def changes(self, query=''):
+        with self.app.test_request_context(f'/actors/changes?{query}'):
+            return changes(Actor)
+
+    def test_returns_only_what_changed_since_the_token(self):
+        actors = [Actor(f'Changes Actor {i}', '30', 'Female') for i in range(3)]
+        for actor in actors:
+            actor.insert()
+
+        first = self.changes('limit=2')
+        self.assertEqual([actor['id'] for actor in first['actors']], [actors[0].id, actors[1].id])
+        self.assertTrue(first['has_more'])
+
+        rest = self.changes(f'since={first["next_token"]}')
+        self.assertEqual([actor['id'] for actor in rest['actors']], [actors[2].id])
+        self.assertFalse(rest['has_more'])
+
+        actors[0].name = 'Renamed'
+        actors[0].update()
+        deleted_id = actors[1].id
+        actors[1].delete()
+
+        latest = self.changes(f'since={rest["next_token"]}')
+        self.assertEqual(latest['actors'], [Actor.format_row(actors[0])])
+        self.assertEqual(latest['deleted'], [deleted_id])
+
+        self.assertEqual(self.changes(f'since={latest["next_token"]}')['actors'], [])
+
+    def test_writes_committed_late_are_not_skipped(self):
+        Actor('Committed Actor', '30', 'Female').insert()
+
+        # a write stamped before the next call but committed after it
+        late = db.engine.connect()
+        transaction = late.begin()
+        late.execute(collection_version_bump('actors'))
+        late.execute(Actor.__table__.insert().values(name='Late Actor', age='30', gender='Male'))
+        first = self.changes()
+        transaction.commit()
+        late.close()
+
+        self.assertEqual([actor['name'] for actor in first['actors']], ['Committed Actor'])
+        rest = self.changes(f'since={first["next_token"]}')
+        self.assertEqual([actor['name'] for actor in rest['actors']], ['Late Actor'])
+
+    def test_deletes_an_id_again_after_it_was_re_created(self):
+        actor = Actor('Deleted Actor', '30', 'Female')
+        actor.insert()
+        id = actor.id
+        actor.delete()
+        # the importer can bring an id back with an explicit id
+        db.session.execute(Actor.__table__.insert().values(id=id, name='Imported Actor', age='30', gender='Male'))
+        db.session.commit()
+
+        Actor.query.get(id).delete()
+        self.assertEqual(self.changes()['deleted'], [id])
+
+    def test_pages_through_rows_older_than_the_tombstones(self):
+        long_ago = datetime.datetime.utcnow() - datetime.timedelta(days=365)
+        for i in range(5):
+            Actor(f'Old Actor {i}', '30', 'Female').insert()
+        db.session.execute(Actor.__table__.update().values(updated_at=long_ago))
+        db.session.commit()
+
+        ids = []
+        page = self.changes('limit=2')
+        ids.extend(actor['id'] for actor in page['actors'])
+        while page['has_more']:
+            page = self.changes(f'limit=2&since={page["next_token"]}')
+            ids.extend(actor['id'] for actor in page['actors'])
+        self.assertEqual(len(ids), 5)
+
+    def test_old_and_invalid_tokens(self):
+        old = encode_cursor([datetime.datetime.utcnow().isoformat(), 0])
+        self.assertRaises(Gone, self.changes, f'since={old}')
+        self.assertRaises(BadRequest, self.changes, 'since=bm90IGEgdG9rZW4')
+        self.assertRaises(BadRequest, self.changes, 'limit=%C2%B2')
+
+
+class EventsTestCase(unittest.TestCase):
+    """This class tests fanning change events out to /events clients"""
+
+    def test_events_reach_subscribers_of_their_collection(self):
+        events = ChangeEvents()
+        actors = events.broker.subscribe(['actors'])
+        everything = events.broker.subscribe(['actors', 'movies'])
+
+        events.publish('movies', 'delete', [2])
+        events.publish('actors', 'insert', [1])
+
+        self.assertEqual(actors.get(0), {'collection': 'actors', 'type': 'create', 'ids': [1]})
+        self.assertIsNone(actors.get(0))
+        self.assertEqual([everything.get(0)['collection'], everything.get(0)['collection']], ['movies', 'actors'])
+
+    def test_stream_format_and_overflow(self):
+        broker = EventBroker(queue_size=1)
+        subscription = broker.subscribe(['actors'])
+        stream = stream_events(subscription, keepalive=0)
+        self.assertEqual(next(stream), 'retry: 1000\n\n')
+        self.assertEqual(next(stream), ': keepalive\n\n')
+
+        broker.publish({'collection': 'actors', 'type': 'update', 'ids': [1]})
+        self.assertEqual(next(stream), 'event: update\ndata: {"collection": "actors", "ids": [1], "type": "update"}\n\n')
+
+        broker.publish({'collection': 'actors', 'type': 'update', 'ids': [2]})
+        broker.publish({'collection': 'actors', 'type': 'update', 'ids': [3]})
+        self.assertEqual(next(stream), 'event: overflow\ndata: {}\n\n')
+        self.assertEqual(list(stream), [])
+
+    def test_max_clients(self):
+        broker = EventBroker(max_clients=1)
+        subscription = broker.subscribe(['actors'])
+        self.assertIsNone(broker.subscribe(['actors']))
+
+        broker.unsubscribe(subscription)
+        broker.unsubscribe(subscription)
+        self.assertIsNotNone(broker.subscribe(['actors']))
+
+    def test_postgres_backend_notifies_on_the_write_connection(self):
+        events = app_module.change_events
+        backend = events.backend
+        directory = tempfile.TemporaryDirectory()
+        app = Flask(__name__)
+        setup_db(app, f'sqlite:///{directory.name}/events.db')
+        try:
+            with app.app_context():
+                db.create_all()
+                events.backend = 'postgres'
+                subscription = events.broker.subscribe(['actors'])
+                notifications = []
+                db.session.connection().connection.create_function(
+                    'pg_notify', 2, lambda channel, payload: notifications.append((channel, json.loads(payload))))
+
+                actor = Actor('Events Actor', '30', 'Female')
+                actor.insert()
+
+                self.assertEqual(notifications, [(EVENTS_CHANNEL, {'collection': 'actors', 'type': 'create',
+                                                                   'ids': [actor.id]})])
+                # published by the listening connection, not by the writer after its commit
+                self.assertIsNone(subscription.get(0))
+                events.broker.unsubscribe(subscription)
+                db.session.remove()
+        finally:
+            events.backend = backend
+            directory.cleanup()
+
+    def test_postgres_notifications_are_sent_only_on_commit(self):
+        app = create_app()
+        if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgres'):
+            self.skipTest('NOTIFY needs Postgres')
+
+        with app.app_context():
+            db.create_all()
+            listener = db.engine.raw_connection()
+            try:
+                listener.connection.autocommit = True
+                listener.cursor().execute(f'LISTEN "{EVENTS_CHANNEL}"')
+
+                stage_mutation(db.session.connection(), 'actors', 'insert', [0])
+                db.session.rollback()
+                actor = Actor.insert_one({'name': 'Events Actor', 'age': '30', 'gender': 'Female'})
+
+                select.select([listener.connection], [], [], 5)
+                listener.connection.poll()
+                payloads = [json.loads(notification.payload) for notification in listener.connection.notifies]
+                self.assertEqual(payloads, [{'collection': 'actors', 'type': 'create', 'ids': [actor.id]}])
+                Actor.delete_by_id(actor.id)
+            finally:
+                listener.close()
+                db.session.remove()
+
+
+class ImportTestCase(unittest.TestCase):
+    """This class tests reading and validating bulk import files"""
+
+    def test_reads_csv_and_ndjson(self):
+        csv_file = io.StringIO('name,age,gender,movie_ids\nBart,21,Male,1;2\nJerry,23\n')
+        self.assertEqual(list(read_records(csv_file, 'csv')), [
+            (2, {'name': 'Bart', 'age': '21', 'gender': 'Male', 'movie_ids': '1;2'}),
+            (3, {'name': 'Jerry', 'age': '23'})
+        ])
+
+        ndjson_file = io.StringIO('{"title": "Boo", "release_date": "2020-05-12"}\n\nnot json\n')
+        self.assertEqual(list(read_records(ndjson_file, 'ndjson')), [
+            (1, {'title': 'Boo', 'release_date': '2020-05-12'}),
+            (3, None)
+        ])
+
+    def test_validates_like_the_routes(self):
+        fields = ('name', 'age', 'gender')
+        self.assertEqual(validate({'id': '7', 'name': 'Bart', 'age': 21, 'gender': 'Male', 'movie_ids': '1;2'},
+                                  fields, 'movie_ids'),
+                         ((7, 'Bart', '21', 'Male', [1, 2]), None))
+        self.assertEqual(validate({'name': 'Bart', 'age': '21'}, fields, 'movie_ids'), (None, 'gender is required'))
+        self.assertEqual(validate({'name': 'Bart', 'age': '21', 'gender': 'Male', 'movie_ids': 'one'},
+                                  fields, 'movie_ids'),
+                         (None, 'movie_ids must be a list of integers'))
+        self.assertEqual(validate({'title': 'Boo', 'release_date': '12/05/2020'},
+                                  ('title', 'release_date'), 'actor_ids', ['release_date']),
+                         (None, 'release_date must be a date (YYYY-MM-DD)'))
+
+    def test_validates_batch_items(self):
+        fields = ('title', 'release_date')
+        self.assertEqual(validate_values({'title': 7, 'release_date': '2020-05-12'}, fields, ['release_date']),
+                         (['7', datetime.date(2020, 5, 12)], None))
+        self.assertEqual(validate_values({'title': ['Boo'], 'release_date': '2020-05-12'}, fields, ['release_date']),
+                         (None, 'title must be a string'))
+        self.assertEqual(validate_values({'title': 'Boo', 'release_date': None}, fields, ['release_date']),
+                         (['Boo', None], None))
+        self.assertEqual(validate_values(None, fields), (None, 'invalid item'))
+
+    def test_copy_stream(self):
+        stream = CopyStream([(2, None, 'Say "Boo"', '', [1, 2]), (3, 5, 'Jerry', '23', None)])
+        chunks = iter(lambda: stream.read(8), '')
+        self.assertEqual(''.join(chunks), '2,,"Say ""Boo""","","{1,2}"\n3,5,"Jerry","23",\n')
+
+    def test_notifies_inserts_updates_and_links_of_both_collections(self):
+        self.assertEqual(import_mutations('actors', [5, 6], [2], [(5, 1), (5, 3), (2, 1)]), [
+            ('actors', 'insert', [5, 6]),
+            ('actors', 'update', [2]),
+            ('actors', 'link', [2, 5]),
+            ('movies', 'link', [1, 3])
+        ])
+        self.assertEqual(import_mutations('movies', [], [4], []), [('movies', 'update', [4])])
+
+
+class RateLimitTestCase(unittest.TestCase):
+    """This class tests the token buckets and the in-flight limit"""
+
+    def test_token_bucket(self):
+        buckets = MemoryBuckets()
+        self.assertEqual([buckets.take('key', 1, 2, now=0) for _ in range(2)], [0, 0])
+        self.assertEqual(buckets.take('key', 1, 2, now=0), 1)
+        self.assertEqual(buckets.take('key', 1, 2, now=0.5), 0.5)
+        self.assertEqual(buckets.take('key', 1, 2, now=1.5), 0)
+        self.assertEqual(buckets.take('other', 1, 2, now=1.5), 0)
+
+    def test_limits_per_subject_and_permission(self):
+        admission = Admission(MemoryBuckets(), subject_limit=(0.001, 3),
+                              permission_limits=parse_permission_limits('post:actors=0.001/1, get:movies=5'))
+        admission.check_rate('auth0|a', 'post:actors')
+        with self.assertRaises(Overloaded) as raised:
+            admission.check_rate('auth0|a', 'post:actors')
+        self.assertEqual(raised.exception.status_code, 429)
+        self.assertGreater(raised.exception.retry_after, 1)
+
+        admission.check_rate('auth0|b', 'post:actors')
+        admission.check_rate('auth0|a', 'get:actors')
+        with self.assertRaises(Overloaded):
+            admission.check_rate('auth0|a', 'get:actors')
+
+        self.assertEqual(parse_limit('5'), (5.0, 5.0))
+
+    def test_sheds_requests_above_the_in_flight_limit(self):
+        admission = Admission(max_in_flight=1)
+        with admission.admit():
+            with self.assertRaises(Overloaded) as raised:
+                with admission.admit():
+                    pass
+        self.assertEqual((raised.exception.status_code, raised.exception.retry_after), (503, 1))
+        self.assertEqual(admission.in_flight, 0)
+
+        with admission.admit():
+            admission.check_rate('auth0|a', 'get:actors')
+
+    def test_streamed_responses_hold_their_place_until_closed(self):
+        admission = Admission(max_in_flight=1)
+        admission.enter()
+        response = admission.leave_after(Response(iter(['row\n'])))
+        with self.assertRaises(Overloaded):
+            admission.enter()
+
+        response.close()
+        self.assertEqual(admission.in_flight, 0)
+        admission.enter()
+        admission.leave_after(Response('done'))
+        self.assertEqual(admission.in_flight, 0)
+
+
+class SerializationTestCase(unittest.TestCase):
+    """This class tests the fast JSON encoder matches jsonify byte for byte"""
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+    def test_dump_json_matches_jsonify(self):
+        payload = {
+            'success': True,
+            'next_cursor': None,
+            'movies': [
+                {'id': 1, 'title': 'Am\u00e9lie \U0001f600 \u2028', 'release_date': datetime.date(2001, 4, 25)},
+                {'id': 2, 'title': 'Quotes " \\ / \n\t\x01\x7f', 'release_date': None}
+            ]
+        }
+        with self.app.app_context():
+            self.assertEqual(dump_json(payload), jsonify(payload).get_data())
+
+    def test_dump_json_follows_debug_pretty_printing(self):
+        self.app.debug = True
+        payload = {'b': [1, 2], 'a': 'x'}
+        with self.app.app_context():
+            self.assertEqual(dump_json(payload), jsonify(payload).get_data())
+
+
+class ValidatorsTestCase(unittest.TestCase):
+    """This class tests conditional requests by ETag and Last-Modified"""
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+    def check(self, headers, last_modified=datetime.datetime(2020, 5, 12, 10, 0, 0, 500000)):
+        with self.app.test_request_context('/actors', headers=headers):
+            return not_modified('actors-3', last_modified) is not None
+
+    def test_if_none_match_takes_precedence(self):
+        self.assertTrue(self.check({'If-None-Match': 'W/"actors-3"',
+                                    'If-Modified-Since': 'Mon, 11 May 2020 00:00:00 GMT'}))
+        self.assertFalse(self.check({'If-None-Match': 'W/"actors-2"',
+                                     'If-Modified-Since': 'Wed, 13 May 2020 00:00:00 GMT'}))
+
+    def test_if_modified_since_rounds_up_to_the_second(self):
+        self.assertFalse(self.check({'If-Modified-Since': 'Tue, 12 May 2020 10:00:00 GMT'}))
+        self.assertTrue(self.check({'If-Modified-Since': 'Tue, 12 May 2020 10:00:01 GMT'}))
+
+    def test_if_match_versions_must_be_ascii_digits(self):
+        with self.app.test_request_context('/actors/1', headers={'If-Match': '"actors-1-\u00b2"'}):
+            self.assertRaises(PreconditionFailed, if_match_version, 'actors', 1)
+        with self.app.test_request_context('/actors/1', headers={'If-Match': '"actors-1-2"'}):
+            self.assertEqual(if_match_version('actors', 1), 2)
+
+    def test_last_modified_is_never_in_the_future(self):
+        with self.app.test_request_context('/actors'):
+            response = with_validators(Response(), 'actors-3', datetime.datetime(2020, 5, 12, 10, 0, 0, 500000))
+            self.assertEqual(response.last_modified, datetime.datetime(2020, 5, 12, 10, 0, 1))
+
+            now = datetime.datetime.utcnow()
+            response = with_validators(Response(), 'actors-3', now)
+            self.assertLessEqual(response.last_modified, now)
+
+
+class MetricsTestCase(unittest.TestCase):
+    """This class tests the request metrics served at /metrics"""
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        init_metrics(self.app)
+
+        @self.app.route('/metrics-test')
+        def metrics_test():
+            with phase('serialization'):
+                return 'ok'
+
+        self.client = self.app.test_client
+
+    def test_requests_are_recorded_by_route_and_phase(self):
+        self.client().get('/metrics-test')
+        res = self.client().get('/metrics')
+        self.assertEqual(res.status_code, 200)
+
+        body = res.get_data(as_text=True)
+        self.assertIn('http_request_duration_seconds_count{method="GET",route="/metrics-test",status="200"}', body)
+        self.assertIn('http_request_phase_seconds_count{phase="serialization",route="/metrics-test"}', body)
+        self.assertIn('http_response_size_bytes_count{route="/metrics-test"}', body)
+        self.assertIn('http_requests_in_flight 1.0', body)
+
+    def test_metrics_are_only_served_to_allowed_clients(self):
+        remote = {'REMOTE_ADDR': '203.0.113.7'}
+        self.assertEqual(self.client().get('/metrics', environ_base=remote).status_code, 403)
+
+        token = metrics.METRICS_TOKEN
+        metrics.METRICS_TOKEN = 'scraper-token'
+        try:
+            self.assertEqual(self.client().get('/metrics', environ_base=remote,
+                                               headers={'Authorization': 'Bearer wrong'}).status_code, 403)
+            self.assertEqual(self.client().get('/metrics', environ_base=remote,
+                                               headers={'Authorization': 'Bearer scraper-token'}).status_code, 200)
+        finally:
+            metrics.METRICS_TOKEN = token
+
+    def test_response_cache_lookups_are_exported(self):
+        hits = REGISTRY.get_sample_value('response_cache_lookups_total', {'result': 'hit'}) or 0
+        cache = ResponseCache(MemoryBackend())
+        cache.get_or_build('key', ['actors'], lambda: b'{}')
+        cache.get_or_build('key', ['actors'], lambda: b'{}')
+        self.assertEqual(REGISTRY.get_sample_value('response_cache_lookups_total', {'result': 'hit'}), hits + 1)
+
+
+class QueriesTestCase(unittest.TestCase):
+    """This class tests the SQL query accounting"""
+
+    def setUp(self):
+        track_queries()
+        self.engine = create_engine('sqlite://')
+
+    def test_normalize_sql(self):
+        self.assertEqual(normalize_sql("SELECT *\n  FROM actors WHERE name = 'Bob' AND id IN (?, ?, ?) LIMIT 10"),
+                         'SELECT * FROM actors WHERE name = ? AND id IN (?) LIMIT ?')
+        self.assertEqual(normalize_sql('SELECT * FROM actors_1 WHERE id = %(id_1)s'),
+                         'SELECT * FROM actors_1 WHERE id = ?')
+
+    def test_assert_max_queries(self):
+        with assert_max_queries(2) as queries:
+            self.engine.execute('SELECT 1')
+            self.engine.execute('SELECT 2')
+        self.assertEqual(queries.count, 2)
+
+        with self.assertRaises(AssertionError):
+            with assert_max_queries(1):
+                self.engine.execute('SELECT 1')
+                self.engine.execute('SELECT 2')
+
+    def test_logs_slow_queries(self):
+        with mock.patch('queries.SLOW_QUERY_MS', 0.000001), self.assertLogs('queries', 'WARNING') as logs:
+            self.engine.execute("SELECT 'Bob'")
+        self.assertIn('test_app.py', logs.output[0])
+        self.assertIn('SELECT ?', logs.output[0])
+
+
+class FakeRedis:
+    """A stand-in for the parts of the Redis client the response cache uses"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def sadd(self, key, member):
+        self.data.setdefault(key, set()).add(member.encode())
+
+    def smembers(self, key):
+        return self.data.get(key, set())
+
+    def expire(self, key, seconds):
+        pass
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    """This class tests the response cache and its backends"""
+
+    def build(self):
+        self.builds += 1
+        return b'{"success": true}'
+
+    def setUp(self):
+        self.builds = 0
+
+    def check_backend(self, backend):
+        cache = ResponseCache(backend)
+        self.assertEqual(cache.get_or_build('key', ['actors', 'actors:1'], self.build), b'{"success": true}')
+        cache.get_or_build('key', ['actors', 'actors:1'], self.build)
+        self.assertEqual(self.builds, 1)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+        cache.invalidate('actors', 'update', [1])
+        cache.get_or_build('key', ['actors', 'actors:1'], self.build)
+        self.assertEqual(self.builds, 2)
+
+    def test_memory_backend(self):
+        self.check_backend(MemoryBackend())
+
+    def test_redis_backend(self):
+        self.check_backend(RedisBackend(client=FakeRedis()))
+
+    def test_memory_backend_is_size_bounded(self):
+        backend = MemoryBackend(max_bytes=10)
+        backend.set('a', b'12345', ['actors'])
+        backend.set('b', b'12345', ['actors'])
+        backend.get('a')
+        backend.set('c', b'12345', ['movies'])
+        self.assertIsNone(backend.get('b'))
+        self.assertIsNotNone(backend.get('a'))
+        self.assertEqual(backend.size, 10)
+
+    def test_key_depends_on_query_and_permissions(self):
+        args = ImmutableMultiDict([('limit', '5'), ('cursor', 'MQ')])
+        key = ResponseCache.key('/actors', args, ['get:actors'], 'actors-1')
+        self.assertEqual(key, ResponseCache.key('/actors', ImmutableMultiDict([('cursor', 'MQ'), ('limit', '5')]),
+                                                ['get:actors'], 'actors-1'))
+        self.assertNotEqual(key, ResponseCache.key('/actors', args, ['get:actors', 'get:movies'], 'actors-1'))
+        self.assertNotEqual(key, ResponseCache.key('/actors', args, ['get:actors'], 'actors-2'))
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    """This class tests the coalescing of identical concurrent reads"""
+
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.builds = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def build(self):
+        self.builds += 1
+        self.started.set()
+        self.release.wait(5)
+        return b'{"success": true}'
+
+    def test_concurrent_calls_share_one_build(self):
+        with ThreadPoolExecutor(8) as executor:
+            leader = executor.submit(self.flights.do, 'key', self.build)
+            self.started.wait(5)
+            followers = [executor.submit(self.flights.do, 'key', self.build) for _ in range(7)]
+            while self.flights.stats()['coalesced'] < 7:
+                time.sleep(0.001)
+            self.release.set()
+
+            self.assertEqual(leader.result(), (b'{"success": true}', False))
+            for follower in followers:
+                self.assertEqual(follower.result(), (b'{"success": true}', True))
+        self.assertEqual(self.builds, 1)
+        self.assertEqual(self.flights.stats(), {'calls': 1, 'coalesced': 7, 'in_flight': 0})
+
+    def test_calls_after_the_build_run_again(self):
+        self.release.set()
+        self.flights.do('key', self.build)
+        self.assertEqual(self.flights.do('key', self.build), (b'{"success": true}', False))
+        self.assertEqual(self.builds, 2)
+
+    def test_different_keys_are_not_shared(self):
+        self.release.set()
+        self.flights.do('key', self.build)
+        self.flights.do('other', self.build)
+        self.assertEqual(self.builds, 2)
+        self.assertEqual(self.flights.stats()['coalesced'], 0)
+
+    def test_errors_are_shared(self):
+        def fail():
+            self.started.set()
+            self.release.wait(5)
+            raise ValueError('failed')
+
+        with ThreadPoolExecutor(2) as executor:
+            leader = executor.submit(self.flights.do, 'key', fail)
+            self.started.wait(5)
+            follower = executor.submit(self.flights.do, 'key', self.build)
+            while self.flights.stats()['coalesced'] < 1:
+                time.sleep(0.001)
+            self.release.set()
+
+            self.assertRaises(ValueError, leader.result)
+            self.assertRaises(ValueError, follower.result)
+            # every waiter raises its own copy, chained to the original
+            self.assertIsNot(follower.exception(), leader.exception())
+            self.assertIs(follower.exception().__cause__, leader.exception())
+        self.assertEqual(self.builds, 0)
+        self.assertEqual(self.flights.stats()['in_flight'], 0)
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
@@ -0,0 +1,90 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import TOKEN_CACHE_LOOKUPS, TOKEN_CACHE_EVICTIONS
+
+'''
+TokenCache
+A bounded LRU of verified token payloads, so a bearer token that has
+already passed signature verification doesn't go through RS256 again.
+
+- entries are keyed on the sha256 of the token, the raw token is not kept
+- an entry expires at the token's `exp` claim, or after `max_ttl` seconds
+  if that comes first
+- `key_version` is a callable returning the current signing key version;
+  when it changes every entry is dropped
+- hits, misses and evictions are counted, see stats() and the
+  token_cache_* metrics
+'''
+
+
+class TokenCache:
+    def __init__(self, maxsize=1024, max_ttl=300, key_version=None):
+        self.maxsize = maxsize
+        self.max_ttl = max_ttl
+        self.key_version = key_version or (lambda: 0)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._version = self.key_version()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            self._check_version()
+            entry = self._entries.get(key)
+            if entry is not None:
+                payload, expires_at = entry
+                if time.time() < expires_at:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    TOKEN_CACHE_LOOKUPS.labels('hit').inc()
+                    return payload
+                del self._entries[key]
+            self.misses += 1
+            TOKEN_CACHE_LOOKUPS.labels('miss').inc()
+            return None
+
+    def set(self, token, payload):
+        if self.maxsize <= 0 or 'exp' not in payload:
+            return
+        expires_at = min(payload['exp'], time.time() + self.max_ttl)
+        key = self._key(token)
+        with self._lock:
+            self._check_version()
+            self._entries[key] = (payload, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+                TOKEN_CACHE_EVICTIONS.inc()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+    def _check_version(self):
+        version = self.key_version()
+        if version != self._version:
+            self._entries.clear()
+            self._version = version